@@ -0,0 +1,76 @@
+"""
+Measure how long the command line tools take to start: importing each of their modules, as `python -X importtime`
+reports it, and running `CSVConvert.py --help`. Each is measured in a new interpreter, the best of a number of runs,
+with the packages that take longest to import, so that a dependency that's imported before it's needed shows up.
+
+    python benchmarks/import_benchmark.py --runs 5
+"""
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SRC_DIR = os.path.join(REPO_DIR, "src")
+
+MODULES = [
+    "clinical_etl.mappings",
+    "clinical_etl.schema",
+    "clinical_etl.validate_coverage",
+    "clinical_etl.completeness_table",
+    "clinical_etl.CSVConvert"
+]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5, help="Number of times to measure each, keeping the fastest")
+    parser.add_argument('--top', type=int, default=5, help="Number of the slowest packages to list for each module")
+    args = parser.parse_args()
+    return args
+
+
+def run_python(args):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([SRC_DIR, os.environ.get("PYTHONPATH", "")]))
+    return subprocess.run([sys.executable] + args, capture_output=True, text=True, env=env, check=True)
+
+
+def import_times(module):
+    """Import module in a new interpreter, returning the microseconds that importing it and each of the packages it
+    imported took, including what they imported. Without a module, return the ones that the interpreter imports
+    when it starts."""
+    times = {}
+    code = "pass" if module is None else f"import {module}"
+    for line in run_python(["-X", "importtime", "-c", code]).stderr.splitlines():
+        line_match = re.match(r"import time:\s+(\d+) \|\s+(\d+) \|\s+(\S+)", line)
+        if line_match is not None:
+            times[line_match.group(3)] = int(line_match.group(2))
+    return times
+
+
+def help_time():
+    """The seconds that running CSVConvert.py --help takes, including starting the interpreter."""
+    start = time.perf_counter()
+    run_python([os.path.join(SRC_DIR, "clinical_etl", "CSVConvert.py"), "--help"])
+    return time.perf_counter() - start
+
+
+def main(args):
+    startup = import_times(None)
+    print("module\timport ms\tslowest packages (ms)")
+    for module in MODULES:
+        runs = [import_times(module) for _ in range(args.runs)]
+        best = min(runs, key=lambda times: times[module])
+        # the packages that module imported, rather than the interpreter or modules inside packages
+        packages = [(name, us) for name, us in best.items()
+                    if "." not in name and name != "clinical_etl" and name not in startup]
+        packages = sorted(packages, key=lambda item: item[1], reverse=True)[:args.top]
+        print(f"{module}\t{best[module] / 1000:.0f}\t{', '.join(f'{name} {us / 1000:.0f}' for name, us in packages)}")
+    print(f"\nCSVConvert.py --help\t{min(help_time() for _ in range(args.runs)) * 1000:.0f} ms")
+
+
+if __name__ == '__main__':
+    main(parse_args())
@@ -0,0 +1,79 @@
+"""
+Measure how long it takes to map the donors of a cohort with each mapping engine. The cohort is the test data in
+tests/raw_data, copied as many times as needed, with the identifiers of each copy made unique.
+
+    python benchmarks/mapping_benchmark.py --copies 1000
+"""
+
+import argparse
+import csv
+import os
+import sys
+import tempfile
+import time
+from copy import deepcopy
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_DIR, "src"))
+from clinical_etl import CSVConvert, mappings
+
+TEST_DIR = os.path.join(REPO_DIR, "tests")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--copies', type=int, default=1000, help="Number of copies of the test donors to map")
+    parser.add_argument('--engines', nargs="*", default=["donor", "level", "compiled"],
+                        choices=["donor", "level", "compiled"], help="Mapping engines to measure")
+    args = parser.parse_args()
+    return args
+
+
+def copy_test_data(raw_data_dir, copies):
+    """Write the test data to raw_data_dir copies times over, adding the number of the copy to every identifier."""
+    os.makedirs(raw_data_dir)
+    for name in os.listdir(os.path.join(TEST_DIR, "raw_data")):
+        with open(os.path.join(TEST_DIR, "raw_data", name), newline="") as f:
+            reader = csv.reader(f)
+            header = next(reader)
+            rows = list(reader)
+        id_columns = [i for i, col in enumerate(header) if col.strip().endswith("_id")]
+        with open(os.path.join(raw_data_dir, name), "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            for copy in range(copies):
+                for row in rows:
+                    row = list(row)
+                    for i in id_columns:
+                        if i < len(row) and row[i].strip() != "":
+                            row[i] = f"{row[i]}_{copy}"
+                    writer.writerow(row)
+
+
+def main(args):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        raw_data_dir = os.path.join(tmp_dir, "raw_data")
+        copy_test_data(raw_data_dir, args.copies)
+        manifest = CSVConvert.load_manifest(os.path.join(TEST_DIR, "manifest.yml"))
+        mappings.IDENTIFIER_FIELD = manifest["identifier"]
+        mappings.DATE_FORMAT = manifest["date_format"]
+        template_lines = CSVConvert.read_mapping_template(manifest["mapping"])
+        raw_csv_dfs, mappings.OUTPUT_FILE = CSVConvert.ingest_raw_data(raw_data_dir)
+        indexed_data = CSVConvert.process_data(raw_csv_dfs, False)
+        mapping_scaffold = CSVConvert.create_scaffold_from_template(template_lines)
+        individuals = indexed_data["individuals"]
+        print(f"Mapping {len(individuals)} donors:")
+        print("engine\tmap s\tdonors/s")
+        for engine in args.engines:
+            mappings.INDEXED_DATA = deepcopy(indexed_data)
+            mappings.INDEX_STACK = mappings.IndexStack()
+            start = time.perf_counter()
+            mapper = CSVConvert.donor_mapper(engine, manifest, mapping_scaffold, individuals)
+            for indiv in individuals:
+                mapper(indiv)
+            elapsed = time.perf_counter() - start
+            print(f"{engine}\t{elapsed:.2f}\t{len(individuals) / elapsed:.0f}")
+
+
+if __name__ == '__main__':
+    main(parse_args())
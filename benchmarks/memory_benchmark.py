@@ -0,0 +1,60 @@
+"""
+Measure the memory that the indexed data of a cohort takes, with and without the repeated values of the inputs
+sharing one string. The cohort is the test data in tests/raw_data, copied as many times as needed, with the
+identifiers of each copy made unique.
+
+    python benchmarks/memory_benchmark.py --copies 1000
+"""
+
+import argparse
+import gc
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_DIR, "src"))
+from clinical_etl import CSVConvert, mappings
+from mapping_benchmark import TEST_DIR, copy_test_data
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--copies', type=int, default=1000, help="Number of copies of the test donors to index")
+    args = parser.parse_args()
+    return args
+
+
+def measure(raw_csv_dfs, intern):
+    """Index raw_csv_dfs, returning the memory that the indexed data keeps, the peak memory while indexing, and the
+    time it took."""
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    indexed_data = CSVConvert.process_data(raw_csv_dfs, False, intern=intern)
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del indexed_data
+    return current, peak, elapsed
+
+
+def main(args):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        raw_data_dir = os.path.join(tmp_dir, "raw_data")
+        copy_test_data(raw_data_dir, args.copies)
+        manifest = CSVConvert.load_manifest(os.path.join(TEST_DIR, "manifest.yml"))
+        mappings.IDENTIFIER_FIELD = manifest["identifier"]
+        raw_csv_dfs, mappings.OUTPUT_FILE = CSVConvert.ingest_raw_data(raw_data_dir)
+        results = {intern: measure(raw_csv_dfs, intern) for intern in (False, True)}
+        print(f"\nIndexing {sum(len(df) for df in raw_csv_dfs.values())} rows:")
+        print("values\tkept MB\tpeak MB\tindex s")
+        for intern, (current, peak, elapsed) in results.items():
+            print(f"{'shared' if intern else 'copied'}\t{current / 2**20:.1f}\t{peak / 2**20:.1f}\t{elapsed:.2f}")
+
+
+if __name__ == '__main__':
+    main(parse_args())
@@ -0,0 +1,53 @@
+"""
+Measure how long it takes to write and read a map file of synthetic donor packets with each of the installed json
+backends, with and without compression.
+
+    python benchmarks/serialization_benchmark.py --donors 10000
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_DIR, "src"))
+from clinical_etl import serializer
+from synthetic_data import synthetic_packets
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--donors', type=int, default=10000, help="Number of synthetic donors to write")
+    parser.add_argument('--seed', type=int, default=0, help="Seed for the synthetic donors")
+    parser.add_argument('--minify', action="store_true", help="Write minified json instead of pretty-printed json")
+    parser.add_argument('--compress', nargs="*", default=["gzip"], choices=list(serializer.COMPRESSION_SUFFIXES.keys()),
+                        help="Compressions to measure, as well as uncompressed output")
+    args = parser.parse_args()
+    return args
+
+
+def main(args):
+    map_json = {
+        "openapi_url": "https://example.com/schema.yml",
+        "schema_class": "MoHSchemaV3",
+        "donors": synthetic_packets(args.donors, seed=args.seed)
+    }
+    print(f"Writing and reading {args.donors} synthetic donors:")
+    print("backend\tcompress\twrite s\tread s\tMB")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for backend in serializer.available_backends():
+            for compress in [None] + args.compress:
+                start = time.perf_counter()
+                path = serializer.dump(map_json, os.path.join(tmp_dir, "synthetic_map.json"), pretty=not args.minify,
+                                       compress=compress, backend=backend)
+                written = time.perf_counter()
+                serializer.load(path, backend=backend)
+                read = time.perf_counter()
+                print(f"{backend}\t{compress}\t{written - start:.2f}\t{read - written:.2f}\t"
+                      f"{os.path.getsize(path) / 1e6:.1f}")
+
+
+if __name__ == '__main__':
+    main(parse_args())
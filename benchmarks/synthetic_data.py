@@ -0,0 +1,111 @@
+"""
+Synthetic MoH v3 donor packets for benchmarking, shaped like the output of CSVConvert.
+"""
+
+import random
+
+
+def month(interval):
+    return {"month_interval": interval, "day_interval": interval * 30}
+
+
+def synthetic_donor(i, rng):
+    """Return a donor packet with a few diagnoses, treatments and followups. Roughly one in ten donors has a
+    validation problem, so that warnings and errors are reported as well."""
+    donor_id = f"DONOR_{i}"
+    is_deceased = rng.choice(["Yes", "No"])
+    donor = {
+        "submitter_donor_id": donor_id,
+        "program_id": "SYNTHETIC",
+        "gender": rng.choice(["Man", "Woman", "Non-binary"]),
+        "sex_at_birth": rng.choice(["Male", "Female"]),
+        "is_deceased": is_deceased,
+        "date_resolution": "month",
+        "date_of_birth": month(-rng.randint(300, 900)),
+        "primary_diagnoses": [],
+        "comorbidities": [],
+        "exposures": [{"tobacco_smoking_status": rng.choice(["Current smoker", "Lifelong non-smoker (<100 cigarettes smoked in lifetime)"])}],
+        "biomarkers": [],
+        "followups": []
+    }
+    last_date = 0
+    for p in range(rng.randint(1, 3)):
+        pd_id = f"{donor_id}_PD_{p}"
+        diagnosis = {
+            "submitter_primary_diagnosis_id": pd_id,
+            "date_of_diagnosis": month(p * 6),
+            "cancer_type_code": "C02.2",
+            "primary_site": "Base of tongue",
+            "basis_of_diagnosis": "Clinical investigation",
+            "clinical_tumour_staging_system": "AJCC 8th edition",
+            "clinical_t_category": "T1",
+            "clinical_n_category": "N0",
+            "clinical_m_category": "M0",
+            "specimens": [],
+            "treatments": [],
+            "followups": []
+        }
+        for s in range(rng.randint(0, 2)):
+            diagnosis["specimens"].append({
+                "submitter_specimen_id": f"{pd_id}_SP_{s}",
+                "specimen_collection_date": month(p * 6 + rng.randint(0, 3)),
+                "specimen_storage": "Frozen in liquid nitrogen",
+                "specimen_anatomic_location": "C02.2",
+                "sample_registrations": [{
+                    "submitter_sample_id": f"{pd_id}_SP_{s}_SA_0",
+                    "specimen_tissue_source": "Blood derived",
+                    "specimen_type": "Primary tumour",
+                    "sample_type": "Total DNA"
+                }]
+            })
+        for t in range(rng.randint(1, 4)):
+            start = p * 6 + rng.randint(0, 6)
+            end = start + rng.randint(1, 12)
+            last_date = max(last_date, end)
+            treatment = {
+                "submitter_treatment_id": f"{pd_id}_TR_{t}",
+                "treatment_type": ["Systemic therapy"],
+                "is_primary_treatment": "Yes",
+                "treatment_start_date": month(start),
+                "treatment_end_date": month(end),
+                "treatment_intent": "Curative",
+                "systemic_therapies": [{
+                    "systemic_therapy_type": "Chemotherapy",
+                    "start_date": month(start),
+                    "end_date": month(rng.randint(start, end)),
+                    "drug_reference_database": "PubChem",
+                    "drug_reference_identifier": "5311",
+                    "drug_name": "Docetaxel",
+                    "prescribed_cumulative_drug_dose": 100,
+                    "drug_dose_units": "mg/m2"
+                }],
+                "followups": []
+            }
+            diagnosis["treatments"].append(treatment)
+        for f in range(rng.randint(0, 2)):
+            diagnosis["followups"].append({
+                "submitter_follow_up_id": f"{pd_id}_FU_{f}",
+                "date_of_followup": month(last_date + rng.randint(1, 12)),
+                "disease_status_at_followup": "Complete remission"
+            })
+        donor["primary_diagnoses"].append(diagnosis)
+    if is_deceased == "Yes":
+        donor["cause_of_death"] = "Died of cancer"
+        donor["date_of_death"] = month(last_date + rng.randint(13, 48))
+
+    if rng.random() < 0.1:
+        treatment = rng.choice(donor["primary_diagnoses"])["treatments"][0]
+        match rng.randint(0, 2):
+            case 0:
+                treatment["systemic_therapies"][0].pop("drug_dose_units")
+            case 1:
+                treatment["treatment_end_date"] = month(treatment["treatment_start_date"]["month_interval"] - 1)
+            case 2:
+                donor["date_of_death"] = month(-1)
+    return donor
+
+
+def synthetic_packets(donors, seed=0):
+    """Return a list of synthetic donor packets. The same seed always generates the same packets."""
+    rng = random.Random(seed)
+    return [synthetic_donor(i, rng) for i in range(donors)]
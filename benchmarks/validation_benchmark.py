@@ -0,0 +1,81 @@
+"""
+Measure the throughput of BaseSchema.validate_ingest_map on synthetic donor packets, comparing direct dispatch to
+the validate_ methods with the eval-by-repr dispatch that was used before.
+
+    python benchmarks/validation_benchmark.py --donors 10000
+"""
+
+import argparse
+import os
+import sys
+import time
+from copy import deepcopy
+
+import yaml
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_DIR, "src"))
+from clinical_etl.mohschemav3 import MoHSchemaV3
+from clinical_etl.schema import IdentifierRegistry
+from synthetic_data import synthetic_packets
+
+
+def parse_args():
+    with open(os.path.join(REPO_DIR, "tests", "manifest.yml")) as f:
+        default_schema = yaml.safe_load(f)["schema"]
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--schema', type=str, default=default_schema, help="URL of the openapi schema to validate against")
+    parser.add_argument('--donors', type=int, default=10000, help="Number of synthetic donors to validate")
+    parser.add_argument('--seed', type=int, default=0, help="Seed for the synthetic donors")
+    parser.add_argument('--repeat', type=int, default=3, help="Number of timed runs for each dispatch; the best is reported")
+    parser.add_argument('--jsonschema', action="store_true", help="Include the jsonschema validation of each donor")
+    args = parser.parse_args()
+    return args
+
+
+def eval_validator(schema, schema_name):
+    """The dispatch that validate_schema_object used to do: the object is passed through its repr."""
+    return lambda map_json: eval(f"schema.validate_{schema_name}({map_json})", {"schema": schema})
+
+
+def reset(schema):
+    schema.validation_warnings = []
+    schema.validation_errors = []
+    schema.identifier_registry = IdentifierRegistry()
+    schema.stack_location = []
+    schema.validators = {}
+
+
+def run(schema, packets, dispatch, repeat):
+    timings = []
+    for _ in range(repeat):
+        reset(schema)
+        if dispatch == "eval":
+            schema.get_validator = lambda schema_name: eval_validator(schema, schema_name)
+        else:
+            vars(schema).pop("get_validator", None)
+        map_json = {"donors": deepcopy(packets)}
+        start = time.perf_counter()
+        schema.validate_ingest_map(map_json)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main(args):
+    schema = MoHSchemaV3(args.schema)
+    if schema.json_schema is None:
+        sys.exit(f"Did not find an openapi schema at {args.schema}")
+    if not args.jsonschema:
+        schema.validate_jsonschema = lambda map_json, index: None
+
+    packets = synthetic_packets(args.donors, seed=args.seed)
+    print(f"Validating {args.donors} synthetic donors, best of {args.repeat}:")
+    print("dispatch\tseconds\tdonors/s\twarnings\terrors")
+    for dispatch in ["eval", "direct"]:
+        elapsed = run(schema, packets, dispatch, args.repeat)
+        print(f"{dispatch}\t{elapsed:.2f}\t{args.donors / elapsed:.0f}\t"
+              f"{len(schema.validation_warnings)}\t{len(schema.validation_errors)}")
+
+
+if __name__ == '__main__':
+    main(parse_args())
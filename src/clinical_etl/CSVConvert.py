@@ -3,21 +3,49 @@
 
 import sys
 import os
+from collections import deque
 from copy import deepcopy
 import importlib.util
 import json
-import pandas
 import csv
 import re
-import yaml
 import argparse
-from tqdm import tqdm
+import heapq
+import multiprocessing
+import multiprocessing.connection
+import queue
+import random
+import shutil
+import threading
+import time
+import zlib
 from clinical_etl import mappings
+from clinical_etl import serializer
+from clinical_etl import codegen
+from clinical_etl import readers
+from clinical_etl import validate_coverage
+from clinical_etl.checkpoint import Checkpoint, fingerprint
+from clinical_etl.indexed_store import IndexedStore
+from clinical_etl.schema import IdentifierRegistry, ValidationStats
+from clinical_etl.lazy import lazy_import
+from clinical_etl.shard_parts import ShardParts
 # Include clinical_etl parent directory in the module search path.
 current_dir = os.path.dirname(os.path.abspath(__file__))
 parent_dir = os.path.dirname(current_dir)
 sys.path.append(parent_dir)
 
+# imported when they're first used, since they take a while to import
+pandas = lazy_import("pandas")
+yaml = lazy_import("yaml")
+
+
+def tqdm(*args, **kwargs):
+    """A tqdm progress bar: tqdm is imported when the first one is shown."""
+    from tqdm import tqdm as progress_bar
+    # without its monitor thread, since processes are forked while progress bars are shown
+    progress_bar.monitor_interval = 0
+    return progress_bar(*args, **kwargs)
+
 
 def verbose_print(message):
     if mappings.VERBOSE:
@@ -26,7 +54,8 @@ def verbose_print(message):
 
 def parse_args():
     parser = argparse.ArgumentParser()
-    parser.add_argument('--input', type=str, required=True, help="Path to either an xlsx file or a directory of csv files for ingest")
+    parser.add_argument('command', nargs="?", choices=["convert", "merge"], default="convert", help="convert (the default) converts the input; merge combines the shards of the input converted with --shard into the outputs of converting all of it at once.")
+    parser.add_argument('--input', type=str, required=True, help="Path to either an xlsx file or a directory of csv files for ingest. The directory can also have csv.gz, csv.zst, parquet, arrow or feather files.")
     # parser.add_argument('--api_key', type=str, help="BioPortal API key found in BioPortal personal account settings")
     # parser.add_argument('--email', type=str, help="Contact email to access NCBI clinvar API. Required by Entrez")
     # parser.add_argument('--schema', type=str, help="Schema to use for template; default is mCodePacket")
@@ -35,6 +64,20 @@ def parse_args():
     parser.add_argument('--verbose', '--v', action="store_true", help="Print extra information, useful for debugging and understanding how the code runs.")
     parser.add_argument('--index', '--i', action="store_true", help="Output 'indexed' file, useful for debugging and seeing relationships.")
     parser.add_argument('--minify', action="store_true", help="Remove white space and line breaks from json outputs to reduce file size. Less readable for humans.")
+    parser.add_argument('--continue-on-error', action="store_true", help="If mapping a donor fails, leave it out of the map and carry on with the other donors. The errors are written to <INPUT_DIR>_errors.json.")
+    parser.add_argument('--checkpoint', type=int, help="Save the progress of the conversion every CHECKPOINT donors, so that it can be continued with --resume if it's interrupted.")
+    parser.add_argument('--resume', action="store_true", help="Continue an interrupted conversion from its last checkpoint. The inputs, manifest and mapping functions must not have changed.")
+    parser.add_argument('--shards', type=int, help="Convert a cohort that doesn't fit in memory by splitting the donors into SHARDS parts on disk and mapping one part at a time.")
+    parser.add_argument('--shard', type=str, help="Convert only the donors in shard I of N (I/N, counting from 0), or each shard of N that no other job has started (next/N), into <INPUT_DIR>_parts, for jobs on machines that share a filesystem to convert a cohort together. Combine the shards with merge once they're all converted.")
+    parser.add_argument('--sqlite', action="store_true", help="Keep the indexed data in a SQLite database, <INPUT_DIR>_indexed.db, instead of in memory. The database is reused by later conversions of the same inputs.")
+    parser.add_argument('--engine', choices=["donor", "level", "compiled"], default="donor", help="How donors are mapped: one donor at a time (donor), all of the donors a level of the template at a time (level), or one donor at a time with Python code generated from the template (compiled). level and compiled are faster for large cohorts.")
+    parser.add_argument('--pipeline', action="store_true", help="Validate and write the packets in another process and thread while the donors after them are mapped, and with --shards, index each shard while the one before it is mapped.")
+    parser.add_argument('--workers', type=int, default=1, help="Map the donors in WORKERS processes, largest donors first. Not with --engine level or --sqlite.")
+    parser.add_argument('--used-columns-only', action="store_true", help="Only keep the columns of the input sheets that the template and manifest use, and Donor.date_resolution, which int_to_date_interval_json reads.")
+    parser.add_argument('--donors', type=str, help="Only convert the donors with these identifiers, separated by commas, to try out a template on a few donors. The outputs are written to <INPUT_DIR>_sample_map.json and so on.")
+    parser.add_argument('--sample', type=int, help="Only convert SAMPLE donors picked at random, and estimate how long converting all of them would take and how much memory it would need.")
+    parser.add_argument('--seed', type=int, help="The seed of the random --sample, to pick the same donors again.")
+    parser.add_argument('--compress', choices=list(serializer.COMPRESSION_SUFFIXES.keys()), help="Compress the map and indexed json outputs. zstd needs the zstandard package to be installed.")
     args = parser.parse_args()
     return args
 
@@ -59,40 +102,45 @@ def map_data_to_scaffold(node, line, rownum):
         mappings.CURRENT_LINE = line
         verbose_print(f"Mapping line '{mappings.CURRENT_LINE}' for {mappings.IDENTIFIER}")
     # if we're looking at an array of objects:
-    if "dict" in str(type(node)) and "INDEX" in node:
+    if isinstance(node, dict) and "INDEX" in node:
         result = map_indexed_scaffold(node, line)
         if result is not None and len(result) == 0:
             return None
         return result
-    if "str" in str(type(node)) and node != "":
+    if isinstance(node, str) and node != "":
         result = eval_mapping(node, rownum)
         verbose_print(f"Evaluated result is {result}, {node}, {rownum}")
         return result
-    if "dict" in str(type(node)):
+    if isinstance(node, dict):
         result = {}
         for key in node.keys():
             linekey = key
             if line is not None:
                 linekey = f"{line}.{key}"
-            dict = map_data_to_scaffold(node[key], f"{linekey}", rownum)
-            if dict is not None:
-                if "CALCULATED" not in mappings.INDEXED_DATA["data"]:
-                    mappings.INDEXED_DATA["data"]["CALCULATED"] = {}
-                if mappings.IDENTIFIER not in mappings.INDEXED_DATA["data"]["CALCULATED"]:
-                    mappings.INDEXED_DATA["data"]["CALCULATED"][mappings.IDENTIFIER] = {}
-                if key not in mappings.INDEXED_DATA["data"]["CALCULATED"][mappings.IDENTIFIER]:
-                    mappings.INDEXED_DATA["data"]["CALCULATED"][mappings.IDENTIFIER][key] = []
-                mappings.INDEXED_DATA["data"]["CALCULATED"][mappings.IDENTIFIER][key].append(dict)
-                if key not in mappings.INDEXED_DATA["columns"]:
-                    mappings.INDEXED_DATA["columns"][key] = []
-                if "CALCULATED" not in mappings.INDEXED_DATA["columns"][key]:
-                    mappings.INDEXED_DATA["columns"][key].append("CALCULATED")
-                result[key] = dict
+            sub_result = map_data_to_scaffold(node[key], f"{linekey}", rownum)
+            if sub_result is not None:
+                add_calculated(key, sub_result)
+                result[key] = sub_result
         if result is not None and len(result) == 0:
             return None
         return result
 
 
+def add_calculated(key, value):
+    """Add a value mapped for the current IDENTIFIER to its CALCULATED values in INDEXED_DATA."""
+    if "CALCULATED" not in mappings.INDEXED_DATA["data"]:
+        mappings.INDEXED_DATA["data"]["CALCULATED"] = {}
+    if mappings.IDENTIFIER not in mappings.INDEXED_DATA["data"]["CALCULATED"]:
+        mappings.INDEXED_DATA["data"]["CALCULATED"][mappings.IDENTIFIER] = {}
+    if key not in mappings.INDEXED_DATA["data"]["CALCULATED"][mappings.IDENTIFIER]:
+        mappings.INDEXED_DATA["data"]["CALCULATED"][mappings.IDENTIFIER][key] = []
+    mappings.INDEXED_DATA["data"]["CALCULATED"][mappings.IDENTIFIER][key].append(value)
+    if key not in mappings.INDEXED_DATA["columns"]:
+        mappings.INDEXED_DATA["columns"][key] = []
+    if "CALCULATED" not in mappings.INDEXED_DATA["columns"][key]:
+        mappings.INDEXED_DATA["columns"][key].append("CALCULATED")
+
+
 def map_indexed_scaffold(node, line):
     """
     Given a node that is indexed on some array of values, populate the array with the node's values.
@@ -108,66 +156,58 @@ def map_indexed_scaffold(node, line):
         # evaluate INDEX, using None as rownum to indicate that we're calculating an index and not a specific row
         index_values = eval_mapping(node["INDEX"], None)
         verbose_print(f"  Indexing on  {index_values}")
-        if index_values is None:
-            return None
-        index_field = index_values["field"]
-        index_sheet = index_values["sheet"]
-        index_values = index_values["values"]
     else:
         raise Exception(f"An indexed_on notation is required for {line}")
 
-    # only process if there is data for this IDENTIFIER in the index_sheet
-    if mappings.IDENTIFIER in mappings.INDEXED_DATA['data'][index_sheet]:
-        if index_values is not None:
-            # add this new indexed value into the indexed_data table
-            mappings.INDEXED_DATA['data'][index_sheet][mappings.IDENTIFIER][index_field] = index_values
-        top_frame = mappings._peek_at_top_of_stack()
-
-        # FIRST PASS: when we've passed in None for the sheet in the stack
-        if top_frame["sheet"] is None:
-            mappings.INDEX_STACK[-1]["sheet"] = index_sheet
-            mappings.INDEX_STACK[-1]["id"] = index_field
-            top_frame = mappings._peek_at_top_of_stack()
-
-        row = get_row_for_stack_top(top_frame["sheet"], top_frame["rownum"])
-        verbose_print(f"  Comparing to index_values {index_values} to top_frame[{index_field}] {row[index_field]}")
-
-        possible_values = []
-
-        # for each value in index_sheet.index_field, is it in index_values?
-        for i in range(0, len(index_values)):
-            if index_values[i] == row[index_field]:
-                possible_values.append(index_values[i])
-            else:
-                possible_values.append(None)
-        verbose_print(f"  Possible values are {possible_values}")
-
-        if index_values is not None:
-            for i in range(0, len(possible_values)):
-                mappings._push_to_stack(index_sheet, index_field, i)
-                index_val = possible_values[i]
-                verbose_print(f"  Mapping {i}th row for {possible_values}")
-                if index_val is not None:
-                    sub_res = map_data_to_scaffold(node["NODES"], f"{line}.INDEX", i)
-                    if sub_res is not None:
-                        result.append(sub_res)
-                else:
-                    verbose_print(f"  Skipping {i}th row")
-                mappings._pop_from_stack()
+    index = index_rows(index_values)
+    if index is not None:
+        index_sheet, index_field, rows = index
+        for i in rows:
+            with mappings.INDEX_STACK.frame(index_sheet, index_field, i):
+                verbose_print(f"  Mapping {i}th row")
+                sub_res = map_data_to_scaffold(node["NODES"], f"{line}.INDEX", i)
+                if sub_res is not None:
+                    result.append(sub_res)
     if len(result) == 0:
         return None
     return result
 
 
-def parse_sheet_from_field(param):
+def index_rows(index_values):
     """
-    If the parameter specifies a sheet, return just that sheet and the parameter's base name.
-    Returns None, None if the parameter is not found.
+    Given the evaluated INDEX of a node, return its sheet, field and the numbers of the rows that the node has a value
+    for, or None if there's no data for this IDENTIFIER in the index sheet.
     """
-    if param is None:
-        return None, None
-    param = param.strip()
+    if index_values is None:
+        return None
+    index_field = index_values["field"]
+    index_sheet = index_values["sheet"]
+    index_values = index_values["values"]
+
+    # only process if there is data for this IDENTIFIER in the index_sheet
+    if mappings.IDENTIFIER not in mappings.INDEXED_DATA['data'][index_sheet]:
+        return None
+    # add this new indexed value into the indexed_data table
+    mappings.INDEXED_DATA['data'][index_sheet][mappings.IDENTIFIER][index_field] = index_values
+    top_frame = mappings.INDEX_STACK.top
+
+    # FIRST PASS: when we've passed in None for the sheet in the stack
+    if top_frame.sheet is None:
+        top_frame.sheet = index_sheet
+        top_frame.id = index_field
+
+    row = get_row_for_stack_top(top_frame.sheet, top_frame.rownum)
+    verbose_print(f"  Comparing to index_values {index_values} to top_frame[{index_field}] {row[index_field]}")
+
+    # for each value in index_sheet.index_field, is it in index_values?
+    rows = [i for i in range(0, len(index_values)) if index_values[i] is not None and index_values[i] == row[index_field]]
+    verbose_print(f"  Rows to map are {rows}")
+    return index_sheet, index_field, rows
+
 
+def split_sheet_from_field(param):
+    """Split a parameter into the sheet it specifies, or None if it doesn't specify one, and its base name."""
+    param = param.strip()
     sheet = None
     # possible matches for sheet/column:
     # ((\"|\')(.+?)\2)\.((\"|\')(.+)\5): "MOH.CCN"."treatment.id" (group 3).(group 6)
@@ -187,6 +227,17 @@ def parse_sheet_from_field(param):
         if sheet_match is not None:
             sheet = sheet_match.group(1)
             param = sheet_match.group(2)
+    return sheet, param
+
+
+def parse_sheet_from_field(param):
+    """
+    If the parameter specifies a sheet, return just that sheet and the parameter's base name.
+    Returns None, None if the parameter is not found.
+    """
+    if param is None:
+        return None, None
+    sheet, param = split_sheet_from_field(param)
     if sheet is not None:
         if param in mappings.INDEXED_DATA["columns"]:
             if sheet in mappings.INDEXED_DATA["columns"][param]:
@@ -223,45 +274,55 @@ def get_row_for_stack_top(sheet, rownum):
     if mappings.IDENTIFIER in mappings.INDEXED_DATA["data"][sheet]:
         for param in mappings.INDEXED_DATA["data"][sheet][mappings.IDENTIFIER].keys():
             result[param] = mappings.INDEXED_DATA["data"][sheet][mappings.IDENTIFIER][param][rownum]
-    verbose_print(f"get_row_for_stack_top {sheet} is {result}")
+    if mappings.VERBOSE:
+        verbose_print(f"get_row_for_stack_top {sheet} is {result}")
     return result
 
 
-def populate_data_for_params(params, rownum):
+def populate_data_for_params(params, rownum, resolved=None):
     """
     Given a list of params, return a dictionary of the
-    values for each parameter.
+    values for each parameter. If resolved is a dict, the sheet and column of each param are remembered in it once
+    they're found, since they don't change after that.
     """
     data_values = {}
     for param in params:
-        param, sheet = parse_sheet_from_field(param)
+        if resolved is not None and param in resolved:
+            param, sheet = resolved[param]
+        else:
+            found = parse_sheet_from_field(param)
+            if resolved is not None and found[0] is not None:
+                resolved[param] = found
+            param, sheet = found
         if param is None:
             return None
         if sheet is None:
             verbose_print(f"  WARNING: parameter {param} is not present in the input data")
         else:
             # there should only be one sheet
-            verbose_print(f"  populating data for {param} in {sheet}")
+            if mappings.VERBOSE:
+                verbose_print(f"  populating data for {param} in {sheet}")
             if param not in data_values:
                 data_values[param] = {}
             # add this identifier's contents as a key and array:
             if mappings.IDENTIFIER in mappings.INDEXED_DATA["data"][sheet]:
                 data_values[param][sheet] = deepcopy(mappings.INDEXED_DATA["data"][sheet][mappings.IDENTIFIER][param])
-                top_frame = mappings._peek_at_top_of_stack()
+                top_frame = mappings.INDEX_STACK.top
 
                 # if rownum is None, we are calculating an index. We expect to return a bunch of relevant values.
                 # if rownum is not None, we are working with a particular indexed value: we should filter to just that value.
                 if rownum is not None:
-                    row = get_row_for_stack_top(top_frame["sheet"], rownum)
-                    if top_frame["sheet"] == sheet:
+                    row = get_row_for_stack_top(top_frame.sheet, rownum)
+                    if top_frame.sheet == sheet:
                         for i in range(0, len(data_values[param][sheet])):
                             if row[param] is None or row[param] != data_values[param][sheet][i]:
                                 data_values[param][sheet][i] = None
                         data_values[param][sheet] = data_values[param][sheet][rownum]
-                        verbose_print(f"  populated single value {data_values[param][sheet]}")
-                    else:
+                        if mappings.VERBOSE:
+                            verbose_print(f"  populated single value {data_values[param][sheet]}")
+                    elif mappings.VERBOSE:
                         verbose_print(f"  populated non-indexed value {data_values[param][sheet]}")
-                else:
+                elif mappings.VERBOSE:
                     verbose_print(f"  populated index value {data_values[param][sheet]}")
             else:
                 verbose_print(f"  WARNING: {mappings.IDENTIFIER} not on sheet {sheet}")
@@ -297,89 +358,141 @@ def eval_mapping(node_name, rownum):
                 return eval(f'module.{method}({data_values})')
         except mappings.MappingError as e:
             print(f"Error evaluating {method}")
+            if e.method is None:
+                e.method = f"{modulename}.{method}"
+                e.inputs = data_values
             raise e
     return None
 
 
-def ingest_raw_data(input_path):
-    """Ingest the csvs or xlsx and create dataframes for processing."""
+def call_mapping(function, method, params, rownum, resolved):
+    """
+    Evaluate a mapping as eval_mapping does, for the code that codegen generates: function is called directly with
+    the values of params, and method is the name of the function in the template, e.g. "mappings.single_val".
+    """
+    data_values = populate_data_for_params(params, rownum, resolved)
+    if data_values is None or len(data_values.keys()) == 0:
+        return None
+    try:
+        return function(data_values)
+    except mappings.MappingError as e:
+        print(f"Error evaluating {method.rsplit('.', 1)[-1]}")
+        if e.method is None:
+            e.method = method
+            e.inputs = data_values
+        raise e
+
+
+def output_file_for(input_path):
+    """The path, without a suffix, that the outputs for an xlsx file or a directory of csvs are written to."""
+    if os.path.isfile(input_path):
+        file_match = re.match(r"(.+)\.xlsx$", input_path)
+        if file_match is not None:
+            return file_match.group(1)
+    elif os.path.isdir(input_path):
+        return os.path.normpath(input_path)
+    return "mCodePacket"
+
+
+def ingest_raw_data(input_path, columns=None):
+    """Ingest the sheets of a directory, as readers reads them, or of an xlsx and create dataframes for processing.
+    If columns is given, as used_columns returns them, only those columns of each sheet are kept, as used_rows keeps
+    them."""
     raw_csv_dfs = {}
-    output_file = "mCodePacket"
+    output_file = output_file_for(input_path)
     # input can either be an excel file or a directory of csvs
     if os.path.isfile(input_path):
         file_match = re.match(r"(.+)\.xlsx$", input_path)
         if file_match is not None:
-            output_file = file_match.group(1)
             df = pandas.read_excel(input_path, sheet_name=None, dtype=str)
             for page in df:
                 raw_csv_dfs[page] = df[page]  # append all processed mcode dataframes to a list
     elif os.path.isdir(input_path):
-        output_file = os.path.normpath(input_path)
-        files = os.listdir(input_path)
-        for file in files:
-            file_match = re.match(r"(.+)\.csv$", file)
-            if file_match is not None:
-                df = pandas.read_csv(os.path.join(input_path, file), dtype=str)
-                raw_csv_dfs[file_match.group(1)] = df
+        for sheet, path in readers.list_sheets(input_path):
+            raw_csv_dfs[sheet] = readers.read_sheet(path)
+    if columns is not None:
+        for sheet in raw_csv_dfs:
+            raw_csv_dfs[sheet] = used_rows(raw_csv_dfs[sheet], sheet, columns, set())
     return raw_csv_dfs, output_file
 
 
-def process_data(raw_csv_dfs, verbose):
-    """Takes a set of raw dataframes with a common identifier and merges into a JSON data structure."""
+def index_sheet(df, page, verbose, columns=None, pool=None, unique_rows=False):
+    """Merge the rows of one sheet's dataframe by identifier. If columns is given, it lists the columns to keep,
+    instead of the ones with any values. If pool is given, a dict of the values seen so far, each value that's equal to
+    one in it is replaced by the one in it, so that repeated values are only kept in memory once. If unique_rows, the
+    duplicate rows were already left out by used_rows, and rows that are the same aren't dropped. Returns the sheet's
+    columns and {identifier: {column: [values]}}."""
+    df = df.dropna(axis='index', how='all')
+    if columns is None:
+        df = df.dropna(axis='columns', how='all')
+    else:
+        df = df[columns]
+    df = df.map(str).map(lambda x: x.strip())
+    if not unique_rows:
+        df = df.drop_duplicates()  # drop absolutely identical lines
+
+    # Sort by identifier and then tag any dups
+    df.set_index(mappings.IDENTIFIER_FIELD, inplace=True)
+    df.sort_index(inplace=True, kind="stable")  # keep each identifier's rows in the order they were read
+    df.reset_index(inplace=True)
+    dups = df.duplicated(subset=[mappings.IDENTIFIER_FIELD], keep='first')
+
+    # For all rows with the same identifier, merge all of the occurrences into an array
+    rows_to_merge = {}  # this is going to hold all of the rows that will need to be merged...
+    df_dict = df.to_dict(orient="index")
+    for index in range(0, len(dups)):
+        if not dups[index]:  # this is the first occurrence
+            rows_to_merge[df_dict[index][mappings.IDENTIFIER_FIELD]] = [df_dict[index]]
+        else:
+            rows_to_merge[df_dict[index][mappings.IDENTIFIER_FIELD]].append(df_dict[index])
+    merged_dict = {}  # this is going to be the dict with arrays:
+    for i in range(0, len(rows_to_merge)):
+        merged_dict[i] = {}
+        row_to_merge = rows_to_merge[list(rows_to_merge.keys())[i]]
+        while len(row_to_merge) > 0:  # there are still entries to merge
+            row = row_to_merge.pop(0)
+            for k in row.keys():
+                if k.strip() not in merged_dict[i]:
+                    merged_dict[i][k.strip()] = []
+                val = row[k]
+                if val == 'nan':
+                    val = None
+                elif pool is not None:
+                    val = pool.setdefault(val, val)
+                merged_dict[i][k.strip()].append(val)
+            if len(row_to_merge) > 0 and verbose:
+                mappings._info(f"Duplicate row for {merged_dict[i][mappings.IDENTIFIER_FIELD][0]} in {page}")
+
+    # Now we can clean up the dicts: index them by identifier instead of int
+    indexed_merged_dict = {}
+    for i in range(0, len(merged_dict.keys())):
+        indiv = merged_dict[i][mappings.IDENTIFIER_FIELD][0]
+        indexed_merged_dict[indiv] = merged_dict[i]
+    return [col.strip() for col in df.columns], indexed_merged_dict
+
+
+def process_data(raw_csv_dfs, verbose, sheet_columns=None, intern=True, unique_rows=False):
+    """Takes a set of raw dataframes with a common identifier and merges into a JSON data structure.
+    If sheet_columns is given, it lists the columns to keep for each sheet, instead of the ones with any values.
+    Identifiers, codes and dates are repeated across many rows, so unless intern is False, equal values share one
+    string across all of the sheets. If unique_rows, the dataframes were read with used_columns, as index_sheet
+    takes it."""
     final_merged = {}
     cols_index = {}
     individuals = []
+    pool = {} if intern else None
     print(f"\n{Bcolors.OKBLUE}Processing sheets: {Bcolors.ENDC}")
     for page in raw_csv_dfs.keys():
         print(f"{Bcolors.OKBLUE}{page}  {Bcolors.ENDC}", end="")
-        df = raw_csv_dfs[page].dropna(axis='index', how='all') \
-            .dropna(axis='columns', how='all') \
-            .map(str) \
-            .map(lambda x: x.strip()) \
-            .drop_duplicates()  # drop absolutely identical lines
-
-        # Sort by identifier and then tag any dups
-        df.set_index(mappings.IDENTIFIER_FIELD, inplace=True)
-        df.sort_index(inplace=True)
-        df.reset_index(inplace=True)
-        dups = df.duplicated(subset=[mappings.IDENTIFIER_FIELD], keep='first')
-
-        for col in list(df.columns):
-            col = col.strip()
+        columns, indexed_merged_dict = index_sheet(raw_csv_dfs[page], page, verbose,
+                                                   None if sheet_columns is None else sheet_columns[page], pool,
+                                                   unique_rows)
+        for col in columns:
             if col not in cols_index:
                 cols_index[col] = [page]
             else:
                 cols_index[col].append(page)
-
-        # For all rows with the same identifier, merge all of the occurrences into an array
-        rows_to_merge = {}  # this is going to hold all of the rows that will need to be merged...
-        df_dict = df.to_dict(orient="index")
-        for index in range(0, len(dups)):
-            if not dups[index]:  # this is the first occurrence
-                rows_to_merge[df_dict[index][mappings.IDENTIFIER_FIELD]] = [df_dict[index]]
-            else:
-                rows_to_merge[df_dict[index][mappings.IDENTIFIER_FIELD]].append(df_dict[index])
-        merged_dict = {}  # this is going to be the dict with arrays:
-        for i in range(0, len(rows_to_merge)):
-            merged_dict[i] = {}
-            row_to_merge = rows_to_merge[list(rows_to_merge.keys())[i]]
-            while len(row_to_merge) > 0:  # there are still entries to merge
-                row = row_to_merge.pop(0)
-                for k in row.keys():
-                    if k.strip() not in merged_dict[i]:
-                        merged_dict[i][k.strip()] = []
-                    val = row[k]
-                    if val == 'nan':
-                        val = None
-                    merged_dict[i][k.strip()].append(val)
-                if len(row_to_merge) > 0 and verbose:
-                    mappings._info(f"Duplicate row for {merged_dict[i][mappings.IDENTIFIER_FIELD][0]} in {page}")
-
-        # Now we can clean up the dicts: index them by identifier instead of int
-        indexed_merged_dict = {}
-        for i in range(0, len(merged_dict.keys())):
-            indiv = merged_dict[i][mappings.IDENTIFIER_FIELD][0]
-            indexed_merged_dict[indiv] = merged_dict[i]
+        for indiv in indexed_merged_dict:
             if indiv not in individuals:
                 individuals.append(indiv)
         final_merged[page] = indexed_merged_dict
@@ -392,6 +505,277 @@ def process_data(raw_csv_dfs, verbose):
     }
 
 
+def read_raw_sheets(input_path, chunk_size, columns=None, identifiers_only=False):
+    """Yield (sheet name, chunks of the sheet's dataframe) for each sheet at input_path, in the same order as
+    ingest_raw_data. The sheets of a directory are read about chunk_size rows at a time; xlsx sheets are read one whole
+    sheet at a time. If columns is given, as used_columns returns them, only those columns of each sheet are kept, as
+    used_rows keeps them. If identifiers_only, only the identifier column of each sheet is read, with all of its
+    rows."""
+    usecols = (lambda col: col.strip() == mappings.IDENTIFIER_FIELD) if identifiers_only else None
+    if os.path.isfile(input_path):
+        if re.match(r"(.+)\.xlsx$", input_path) is not None:
+            sheets = [(sheet, iter([pandas.read_excel(input_path, sheet_name=sheet, dtype=str, usecols=usecols)]))
+                      for sheet in pandas.ExcelFile(input_path).sheet_names]
+        else:
+            sheets = []
+    elif os.path.isdir(input_path):
+        sheets = ((sheet, readers.read_sheet_chunks(path, chunk_size, usecols))
+                  for sheet, path in readers.list_sheets(input_path))
+    else:
+        sheets = []
+    for sheet, chunks in sheets:
+        if columns is None:
+            yield sheet, chunks
+        else:
+            seen = set()
+            yield sheet, (used_rows(chunk, sheet, columns, seen) for chunk in chunks)
+
+
+def index_raw_sheets(input_path, verbose, chunk_size=100000, columns=None):
+    """Yield (sheet name, columns, indexed rows) for each sheet at input_path, reading and indexing one sheet at a
+    time, so that only one sheet is ever in memory."""
+    print(f"\n{Bcolors.OKBLUE}Processing sheets: {Bcolors.ENDC}")
+    for sheet, chunks in read_raw_sheets(input_path, chunk_size, columns):
+        print(f"{Bcolors.OKBLUE}{sheet}  {Bcolors.ENDC}", end="")
+        sheet_columns, rows = index_sheet(pandas.concat(chunks, ignore_index=True), sheet, verbose,
+                                          unique_rows=columns is not None)
+        yield sheet, sheet_columns, rows
+
+
+def open_indexed_store(input_path, verbose, columns=None):
+    """Open the SQLite database of the indexed data of input_path, indexing the inputs (only the given columns, if
+    columns isn't None) into it unless it already holds the same inputs."""
+    store = IndexedStore(f"{output_file_for(input_path)}_indexed.db")
+    extra = [mappings.IDENTIFIER_FIELD]
+    if columns is not None:
+        extra.append(json.dumps({str(sheet): sorted(cols) for sheet, cols in columns.items()}, sort_keys=True))
+    input_fingerprint = fingerprint(input_path, [], extra)
+    if store.fingerprint() == input_fingerprint:
+        print(f"{Bcolors.OKGREEN}reusing indexed data in {store.path}{Bcolors.ENDC}")
+    else:
+        print(f"{Bcolors.OKGREEN}indexing data into {store.path}{Bcolors.ENDC}", end="")
+        store.load(index_raw_sheets(input_path, verbose, columns=columns), mappings.IDENTIFIER_FIELD,
+                   input_fingerprint)
+    return store
+
+
+def indexed_on_columns(node):
+    """Return the columns that the arrays in a mapping scaffold are indexed_on, as {sheet: set of columns}."""
+    result = {}
+    if isinstance(node, dict):
+        if "INDEX" in node:
+            method, parameters = parse_mapping_function(node["INDEX"])
+            for param in parameters or []:
+                if param in mappings.INDEXED_DATA["columns"]:
+                    sheets = mappings.INDEXED_DATA["columns"][param]
+                else:
+                    param, sheet = parse_sheet_from_field(param)
+                    sheets = [] if sheet is None else [sheet]
+                for sheet in sheets:
+                    if sheet != "CALCULATED":
+                        result.setdefault(sheet, set()).add(param)
+        for value in node.values():
+            for sheet, columns in indexed_on_columns(value).items():
+                result.setdefault(sheet, set()).update(columns)
+    return result
+
+
+def used_columns(mapping_scaffold, manifest):
+    """
+    Return the columns that the mappings in a scaffold, and the manifest's reference_date, use as parameters, as
+    {sheet: set of columns}. Columns that are used without a sheet are under None, since they could be in any sheet.
+    The mappings.IMPLICIT_COLUMNS that mapping functions read directly are always included.
+    """
+    result = {sheet: set(columns) for sheet, columns in mappings.IMPLICIT_COLUMNS.items()}
+
+    def add_mapping(mapping):
+        method, parameters = parse_mapping_function(mapping)
+        for param in parameters or []:
+            sheet, column = split_sheet_from_field(param)
+            if sheet != "CALCULATED":
+                result.setdefault(sheet, set()).add(column)
+
+    def add_node(node):
+        if isinstance(node, dict):
+            if "INDEX" in node:
+                add_mapping(node["INDEX"])
+            for value in node.values():
+                add_node(value)
+        elif isinstance(node, str):
+            add_mapping(node)
+
+    add_node(mapping_scaffold)
+    if "reference_date" in manifest:
+        add_node(create_scaffold_from_template([f"REFERENCE_DATE, {{{manifest['reference_date']}}}"]))
+    return result
+
+
+def usecols_for(sheet, columns):
+    """The usecols for reading a sheet with only the columns given by used_columns, and its identifier, or None
+    to read all of its columns."""
+    if columns is None:
+        return None
+    used = columns.get(sheet, set()) | columns.get(None, set()) | {mappings.IDENTIFIER_FIELD}
+    return lambda col: col.strip() in used
+
+
+def used_rows(df, sheet, columns, seen):
+    """
+    Return the rows of df, all of the columns of a chunk of sheet, with only the columns given by used_columns and the
+    identifier. Rows that are the same in every column as a row read before them, once their values are stripped, are
+    left out, as index_sheet leaves them out of the whole sheet, so that rows that only differ in columns that aren't
+    used aren't merged. seen holds the hashes of the sheet's rows read before df, and the rows of df are added to it.
+    """
+    df = df.dropna(axis='index', how='all')
+    hashes = pandas.util.hash_pandas_object(df.map(str).map(lambda x: x.strip()), index=False)
+    unique = ~(hashes.duplicated() | hashes.isin(seen))
+    seen.update(hashes[unique])
+    usecols = usecols_for(sheet, columns)
+    return df.loc[unique, [col for col in df.columns if usecols(col)]]
+
+
+def shard_of(identifier, shards):
+    """The shard that a donor's rows are partitioned into, from a hash of its identifier."""
+    return zlib.crc32(str(identifier).strip().encode()) % shards
+
+
+def partition_raw_data(input_path, shard_dir, shards, chunk_size=100000, columns=None):
+    """
+    Read the sheets at input_path a chunk at a time and write their rows to shards of csvs in shard_dir, partitioned
+    by a hash of the identifier, so that all of a donor's rows are in the same shard. Every shard has a csv for every
+    sheet, even if it has no rows. Returns the sheet names, in order, and the columns of each sheet that have values
+    anywhere in it, which are the columns that process_data would keep for the whole sheet.
+    """
+    shutil.rmtree(shard_dir, ignore_errors=True)
+    for shard in range(shards):
+        os.makedirs(os.path.join(shard_dir, str(shard)))
+    sheets = []
+    sheet_columns = {}
+    for sheet, chunks in read_raw_sheets(input_path, chunk_size, columns):
+        paths = [os.path.join(shard_dir, str(shard), f"{len(sheets)}.csv") for shard in range(shards)]
+        sheets.append(sheet)
+        has_values = set()
+        columns = None
+        for chunk in chunks:
+            if columns is None:
+                columns = list(chunk.columns)
+                for path in paths:
+                    chunk.iloc[:0].to_csv(path, index=False)
+            if len(chunk) == 0:
+                continue
+            has_values.update(chunk.columns[chunk.notna().any()])
+            for shard, rows in chunk.groupby(chunk[mappings.IDENTIFIER_FIELD].map(lambda x: shard_of(x, shards))):
+                rows.to_csv(paths[shard], mode="a", header=False, index=False)
+        sheet_columns[sheet] = [col for col in columns if col in has_values]
+    return sheets, sheet_columns
+
+
+def read_raw_subset(input_path, select, chunk_size=100000, columns=None):
+    """
+    Read the rows of the donors selected by select, a function of an identifier that's True for the donors to keep,
+    from the sheets at input_path, a chunk at a time, so that only their rows are kept in memory. Returns their
+    dataframes, in the same order as ingest_raw_data, the columns of each sheet that have values anywhere in it, so
+    that they're indexed with the same columns as the whole sheet, and the number of rows of all of the sheets.
+    """
+    raw_csv_dfs = {}
+    sheet_columns = {}
+    total_rows = 0
+    for sheet, chunks in read_raw_sheets(input_path, chunk_size, columns):
+        has_values = set()
+        rows = []
+        for chunk in chunks:
+            if len(chunk) > 0:
+                has_values.update(chunk.columns[chunk.notna().any()])
+                total_rows += len(chunk)
+            rows.append(chunk[chunk[mappings.IDENTIFIER_FIELD].map(select).astype(bool)])
+        raw_csv_dfs[sheet] = pandas.concat(rows, ignore_index=True)
+        sheet_columns[sheet] = [col for col in raw_csv_dfs[sheet].columns if col in has_values]
+    return raw_csv_dfs, sheet_columns, total_rows
+
+
+def read_raw_shard(input_path, shard, shards, chunk_size=100000, columns=None):
+    """Read the rows of one shard of the sheets at input_path, partitioned as partition_raw_data partitions them, as
+    read_raw_subset does."""
+    raw_csv_dfs, sheet_columns, _ = read_raw_subset(input_path, lambda x: shard_of(x, shards) == shard, chunk_size,
+                                                    columns)
+    return raw_csv_dfs, sheet_columns
+
+
+def raw_identifiers(input_path, chunk_size=100000):
+    """The identifiers of the donors in the sheets at input_path, in the order they're first read, reading only the
+    identifier column of each sheet."""
+    identifiers = {}
+    for sheet, chunks in read_raw_sheets(input_path, chunk_size, identifiers_only=True):
+        for chunk in chunks:
+            for identifier in chunk[mappings.IDENTIFIER_FIELD].dropna():
+                identifiers.setdefault(str(identifier).strip(), None)
+    return list(identifiers)
+
+
+def select_donors(input_path, donors=None, sample=None, seed=None):
+    """The identifiers of the donors to convert: donors, a list of identifiers, or a random sample of sample donors,
+    chosen with seed."""
+    if donors is not None:
+        return set(donor.strip() for donor in donors)
+    identifiers = sorted(raw_identifiers(input_path))
+    if seed is None:
+        seed = random.randrange(2**32)
+    print(f"{Bcolors.OKGREEN}sampling {min(sample, len(identifiers))} of {len(identifiers)} donors with --seed "
+          f"{seed}...{Bcolors.ENDC}", end="")
+    return set(random.Random(seed).sample(identifiers, min(sample, len(identifiers))))
+
+
+def deep_size(obj):
+    """The bytes taken by obj and everything in it, counting objects that are shared only once."""
+    seen = set()
+    size = 0
+    to_visit = [obj]
+    while len(to_visit) > 0:
+        obj = to_visit.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            to_visit.extend(obj.keys())
+            to_visit.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set)):
+            to_visit.extend(obj)
+    return size
+
+
+class SampleEstimate:
+    """
+    An estimate of the time and memory that converting all of a cohort takes, extrapolated from converting some of its
+    donors. Reading takes about as long either way, since every row is read to find the donors' rows; indexing,
+    mapping and validating are taken to grow with the number of rows, as donor_costs assumes, and so is the memory
+    that the raw data, the indexed data and the packets take.
+    """
+    def __init__(self, raw_csv_dfs, total_rows, read_seconds):
+        self.rows = sum(len(df) for df in raw_csv_dfs.values())
+        self.total_rows = total_rows
+        self.read_seconds = read_seconds
+        self.raw_memory = sum(df.memory_usage(deep=True).sum() for df in raw_csv_dfs.values())
+        self.start = time.perf_counter()
+
+    def report(self, donors, packets):
+        elapsed = time.perf_counter() - self.start
+        # measured once the donors are converted, so that it doesn't slow down the conversion it's extrapolating
+        memory = self.raw_memory + deep_size(mappings.INDEXED_DATA) + deep_size(packets)
+        scale = self.total_rows / max(self.rows, 1)
+        print(f"\n{Bcolors.OKGREEN}Converted {donors} donors, with {self.rows} of {self.total_rows} rows, in "
+              f"{self.read_seconds + elapsed:.1f}s. Converting all of them would take about "
+              f"{self.read_seconds + elapsed * scale:.0f}s and {memory * scale / 2**20:.0f} MB of memory.{Bcolors.ENDC}")
+
+
+def read_shard(shard_dir, shard, sheets):
+    """Read the dataframes of one shard, in the same order as the sheets they were partitioned from."""
+    raw_csv_dfs = {}
+    for i, sheet in enumerate(sheets):
+        raw_csv_dfs[sheet] = pandas.read_csv(os.path.join(shard_dir, str(shard), f"{i}.csv"), dtype=str)
+    return raw_csv_dfs
+
+
 def process_mapping(line, test=False):
     """Given a csv mapping line, process into its component pieces.
     Turns treatment_type, {list_val(Treatment.submitter_treatment_id)} into
@@ -570,6 +954,14 @@ def check_for_sheet_inconsistencies(template_sheets, csv_sheets):
                  nl.join(csv_template_diff) + nl + "Please correct the sheets above and try again.")
 
 
+def check_sheets(input_path, template_lines, sheets):
+    """Exit if no sheets were read from input_path, or if the sheets aren't all in the mapping template."""
+    if not sheets:
+        sys.exit(f"No ingestable files (csv, parquet, arrow or xlsx) were found at {input_path}. Check path and try again.")
+    check_for_sheet_inconsistencies(set([re.findall(r"\(([\w\" ]+)", x)[0].replace('"',"") for x in template_lines]),
+                                    set(sheets))
+
+
 def load_manifest(manifest_file):
     """Given a manifest file's path, return the data inside it."""
     identifier = None
@@ -637,8 +1029,1006 @@ def load_manifest(manifest_file):
     return result
 
 
-def csv_convert(input_path, manifest_file, minify=False, index_output=False, verbose=False):
+def restore_calculated(indiv, calculated):
+    """Add the values CALCULATED while mapping indiv somewhere else to INDEXED_DATA."""
+    if "CALCULATED" not in mappings.INDEXED_DATA["data"]:
+        mappings.INDEXED_DATA["data"]["CALCULATED"] = {}
+    mappings.INDEXED_DATA["data"]["CALCULATED"][indiv] = calculated
+    for key in calculated:
+        if key not in mappings.INDEXED_DATA["columns"]:
+            mappings.INDEXED_DATA["columns"][key] = []
+        if "CALCULATED" not in mappings.INDEXED_DATA["columns"][key]:
+            mappings.INDEXED_DATA["columns"][key].append("CALCULATED")
+
+
+def restore_donor_record(record, packets, error_report):
+    """Add a donor that was saved in a checkpoint: its packets, the values CALCULATED while mapping it, and its
+    error, if it couldn't be mapped."""
+    if "error" in record:
+        error_report.errors.append(record["error"])
+        return
+    if record["packets"] is not None:
+        packets.extend(record["packets"])
+    if record["calculated"] is not None:
+        restore_calculated(record["identifier"], record["calculated"])
+
+
+def map_reference_date(manifest):
+    """If there is a reference_date in the manifest, we need to calculate that for the current IDENTIFIER and add
+    CALCULATED.REFERENCE_DATE to the INDEXED_DATA."""
+    if "reference_date" in manifest:
+        ref_temp = f"REFERENCE_DATE, {{{manifest['reference_date']}}}"
+        reference_date_scaffold = create_scaffold_from_template([ref_temp])
+        func, params = parse_mapping_function(reference_date_scaffold['REFERENCE_DATE'])
+        sheet = params[0].split('.')[0]
+        with mappings.INDEX_STACK.frame(sheet, mappings.IDENTIFIER_FIELD, 0):
+            map_data_to_scaffold(reference_date_scaffold, None, 0)
+
+
+def map_donor(indiv, manifest, mapping_scaffold, generated=None):
+    """Map the donor indiv in INDEXED_DATA to a list of packets, or None if nothing was mapped. If generated is
+    the module that codegen generated from mapping_scaffold, the donor is mapped with it."""
+    mappings.IDENTIFIER = indiv
+    map_reference_date(manifest)
+    with mappings.INDEX_STACK.frame(None, None, 0):
+        if generated is None:
+            packet = map_data_to_scaffold(deepcopy(mapping_scaffold), None, 0)
+        else:
+            packet = generated.map_scaffold()
+    if packet is None:
+        return None
+    main_key = list(packet.keys())[0]
+    return packet[main_key]
+
+
+class TemplateNotSupported(Exception):
+    """The template uses something that LevelMapper can't map the same way as map_donor."""
+
+
+class FieldNode:
+    """A field of the template: its mapping function, and the (column, sheet) of each of its parameters, or None if a
+    parameter isn't in the input data, in which case the field never has a value."""
+    def __init__(self, method, params):
+        self.method = method
+        self.params = params
+        self.values = None
+
+
+class DictNode:
+    """An object of the template, with the node of each of its keys."""
+    def __init__(self, items):
+        self.items = items
+
+
+class IndexNode:
+    """
+    An array of the template. If it's indexed_on a column, the rows of every instance of the array are found for all
+    donors at once with a join; otherwise its INDEX function is called for each instance of the enclosing array, as
+    map_indexed_scaffold does. The instances are kept as the (donor, sheet, index field, row) that their fields are
+    mapped from, and children lists the instances in each instance of the enclosing array.
+    """
+    def __init__(self, method, params, nodes):
+        self.method = method
+        self.params = params
+        self.nodes = nodes
+        self.static = params is not None and method is mappings.indexed_on
+        self.contexts = []
+        self.children = {}
+
+
+def scaffold_keys(node):
+    """Return the keys of all of the objects in a mapping scaffold."""
+    keys = set()
+    if isinstance(node, dict):
+        for key, value in node.items():
+            keys.add(key)
+            keys |= scaffold_keys(value)
+    return keys
+
+
+def resolve_mapping_function(mapping):
+    """Return the function that a mapping calls, or None if it can't be found: calling it then fails, and the donor
+    is mapped with map_donor, which reports the error as usual."""
+    method, parameters = parse_mapping_function(mapping)
+    modulename = "mappings"
+    subfunc_match = re.match(r"(.+)\.(.+)", method)
+    if subfunc_match is not None:
+        modulename = subfunc_match.group(1)
+        method = subfunc_match.group(2)
+    if modulename not in mappings.MODULES:
+        return None
+    return getattr(mappings.MODULES[modulename], method, None)
+
+
+class LevelMapper:
+    """
+    Maps all of the donors a level of the template at a time, instead of one donor at a time. The rows of each array
+    that's indexed_on a column are found for all donors with one join, and each field is mapped for every instance of
+    its array before the arrays inside it are, without the stack, the parsing of the template and the copies of the
+    donor's data that map_donor makes for every field. The packets are then assembled a donor at a time, in the same
+    order as map_donor would map them, so the packets and INDEXED_DATA are the same as with map_donor.
+
+    A donor is mapped with map_donor instead if mapping it fails, so that the failure is reported as usual, or if an
+    INDEX function other than indexed_on changes a column that another part of the template reads, since what's read
+    would then depend on the order that the template is mapped in. Mapping functions only see the top of the
+    INDEX_STACK, and REFERENCE_DATE in the CALCULATED values.
+    """
+    def __init__(self, manifest, mapping_scaffold):
+        self.manifest = manifest
+        self.mapping_scaffold = mapping_scaffold
+        self.keys = scaffold_keys(mapping_scaffold)
+        # the nodes that read each (column, sheet)
+        self.reads = {}
+        self.root = self.compile(mapping_scaffold)
+        self.check_root(self.root)
+        self.individuals = []
+        self.positions = {}
+        self.fallback = set()
+        self.calculated = {}
+
+    def compile(self, node):
+        """Compile a node of the mapping scaffold, resolving the sheet of every parameter."""
+        if isinstance(node, dict) and "INDEX" in node:
+            method, parameters = parse_mapping_function(node["INDEX"])
+            if parameters is None:
+                return None
+            index_node = IndexNode(resolve_mapping_function(node["INDEX"]), self.resolve(parameters),
+                                   self.compile(node["NODES"]))
+            for param in index_node.params or []:
+                self.reads.setdefault(param, set()).add(index_node)
+            return index_node
+        if isinstance(node, str) and node != "":
+            method, parameters = parse_mapping_function(node)
+            if parameters is None:
+                raise TemplateNotSupported(f"{node} doesn't call a mapping function")
+            field_node = FieldNode(resolve_mapping_function(node), self.resolve(parameters))
+            for param in field_node.params or []:
+                self.reads.setdefault(param, set()).add(field_node)
+            return field_node
+        if isinstance(node, dict):
+            return DictNode([(key, self.compile(value)) for key, value in node.items()])
+        return None
+
+    def resolve(self, parameters):
+        """Return the (column, sheet) of each of parameters, or None if one of them isn't in the input data."""
+        params = []
+        for param in parameters:
+            # CALCULATED values are only added as each donor is mapped, so a parameter that's one of them, or that
+            # isn't in the input data but has the name of one of them, can't be resolved before mapping
+            if "CALCULATED" in param:
+                raise TemplateNotSupported(f"{param} is a CALCULATED value")
+            column, sheet = parse_sheet_from_field(param)
+            if column is None:
+                if param.strip() in self.keys:
+                    raise TemplateNotSupported(f"{param} could be a CALCULATED value")
+                return None
+            params.append((column, sheet))
+        return params
+
+    def check_root(self, node):
+        if isinstance(node, FieldNode):
+            raise TemplateNotSupported("the template has fields that aren't in an INDEX")
+        if isinstance(node, DictNode):
+            for key, value in node.items:
+                self.check_root(value)
+
+    def prepare(self, individuals):
+        """Map the fields of all of the individuals, so that their packets can be assembled by map_donor."""
+        data = mappings.INDEXED_DATA["data"]
+        columns = {col: list(sheets) for col, sheets in mappings.INDEXED_DATA["columns"].items()}
+        had_calculated = "CALCULATED" in data
+        self.individuals = list(individuals)
+        self.positions = {indiv: d for d, indiv in enumerate(self.individuals)}
+        self.fallback = set()
+        self.original_columns = {}
+        self.rewritten = {}
+        self.parent_reads = {}
+        self.root_sheets = [None] * len(self.individuals)
+        for d, indiv in enumerate(self.individuals):
+            mappings.IDENTIFIER = indiv
+            try:
+                map_reference_date(self.manifest)
+            except Exception:
+                self.fallback.add(d)
+        self.map_level(self.root, [(d, None, None, 0) for d in range(len(self.individuals))])
+        for d, rewrites in self.rewritten.items():
+            for column, index_node in rewrites:
+                readers = self.reads.get(column, set()) | self.parent_reads.get(d, {}).get(column, set())
+                if len(readers - {index_node}) > 0:
+                    self.fallback.add(d)
+        for d in self.fallback:
+            # the donor is mapped again from the start by map_donor
+            for (sheet, field), values in self.original_columns.get(d, {}).items():
+                data[sheet][self.individuals[d]][field] = values
+        # the REFERENCE_DATEs are added again as each donor is assembled, so that the CALCULATED values are in the
+        # same order as map_donor adds them
+        self.calculated = {}
+        for d, indiv in enumerate(self.individuals):
+            if "CALCULATED" in data and indiv in data["CALCULATED"]:
+                self.calculated[d] = data["CALCULATED"].pop(indiv)
+        if not had_calculated and "CALCULATED" in data and len(data["CALCULATED"]) == 0:
+            del data["CALCULATED"]
+        mappings.INDEXED_DATA["columns"] = columns
+
+    def map_level(self, node, contexts):
+        """Map the fields in node, and then the arrays in it, for each of the contexts of the enclosing array."""
+        if isinstance(node, DictNode):
+            for key, value in node.items:
+                self.map_level(value, contexts)
+        elif isinstance(node, FieldNode):
+            self.map_fields(node, contexts)
+        elif isinstance(node, IndexNode):
+            if node.static:
+                self.join_index(node, contexts)
+            else:
+                self.call_index(node, contexts)
+            self.map_level(node.nodes, node.contexts)
+
+    def data_values(self, params, d, sheet=None, row=None):
+        """The values of params for a donor, as populate_data_for_params gives them to a mapping function: the value
+        in row if the parameter is in the sheet of the array being mapped, otherwise the donor's whole column."""
+        data = mappings.INDEXED_DATA["data"]
+        indiv = self.individuals[d]
+        data_values = {}
+        for column, param_sheet in params:
+            if column not in data_values:
+                data_values[column] = {}
+            if indiv not in data[param_sheet]:
+                data_values[column][param_sheet] = []
+            elif param_sheet == sheet:
+                data_values[column][param_sheet] = data[param_sheet][indiv][column][row]
+            else:
+                data_values[column][param_sheet] = list(data[param_sheet][indiv][column])
+        return data_values
+
+    def map_fields(self, node, contexts):
+        node.values = [None] * len(contexts)
+        if node.params is None:
+            return
+        mappings.INDEX_STACK.clear()
+        frame = mappings.INDEX_STACK.push(None, None, 0)
+        for i, (d, sheet, field, row) in enumerate(contexts):
+            if d in self.fallback:
+                continue
+            try:
+                data_values = self.data_values(node.params, d, sheet, row)
+                mappings.IDENTIFIER = self.individuals[d]
+                frame.sheet, frame.id, frame.rownum = sheet, field, row
+                node.values[i] = node.method(data_values)
+            except Exception:
+                self.fallback.add(d)
+        mappings.INDEX_STACK.clear()
+
+    def parent_key(self, node, d, sheet, row, index_sheet, index_field):
+        """The value of index_field in the row that an instance of the enclosing array is mapped from, as
+        map_indexed_scaffold compares it. At the root, that's the first row of the index_sheet of the donor's first
+        array."""
+        if sheet is None:
+            if self.root_sheets[d] is None:
+                self.root_sheets[d] = index_sheet
+            sheet, row = self.root_sheets[d], 0
+        self.parent_reads.setdefault(d, {}).setdefault((index_field, sheet), set()).add(node)
+        return mappings.INDEXED_DATA["data"][sheet][self.individuals[d]][index_field][row]
+
+    def join_index(self, node, contexts):
+        """Find the rows of an array that's indexed_on a column for all of the contexts at once, with a join."""
+        data = mappings.INDEXED_DATA["data"]
+        index_field, index_sheet = node.params[0]
+        parents = []
+        for i, (d, sheet, field, row) in enumerate(contexts):
+            if d in self.fallback or self.individuals[d] not in data[index_sheet]:
+                continue
+            try:
+                parents.append((i, d, self.parent_key(node, d, sheet, row, index_sheet, index_field)))
+            except Exception:
+                self.fallback.add(d)
+        rows = []
+        for d in sorted(set(d for i, d, key in parents)):
+            for j, key in enumerate(data[index_sheet][self.individuals[d]][index_field]):
+                if key is not None:
+                    rows.append((d, j, key))
+        parents = pandas.DataFrame(parents, columns=["parent", "donor", "key"], dtype=object)
+        rows = pandas.DataFrame(rows, columns=["donor", "row", "key"], dtype=object)
+        joined = parents.merge(rows, on=["donor", "key"]).sort_values(["parent", "row"], kind="stable")
+        node.contexts = [(d, index_sheet, index_field, j)
+                         for d, j in zip(joined["donor"].tolist(), joined["row"].tolist())]
+        node.children = {}
+        for i, parent in enumerate(joined["parent"].tolist()):
+            node.children.setdefault(parent, []).append(i)
+
+    def call_index(self, node, contexts):
+        """Find the rows of an array with its INDEX function, for each of the contexts in turn, as
+        map_indexed_scaffold does: its values replace the values of the column that it indexes."""
+        data = mappings.INDEXED_DATA["data"]
+        node.contexts = []
+        node.children = {}
+        if node.params is None:
+            return
+        for i, (d, sheet, field, row) in enumerate(contexts):
+            if d in self.fallback:
+                continue
+            indiv = self.individuals[d]
+            try:
+                mappings.IDENTIFIER = indiv
+                index_values = node.method(self.data_values(node.params, d))
+                if index_values is None or indiv not in data[index_values["sheet"]]:
+                    continue
+                index_field = index_values["field"]
+                index_sheet = index_values["sheet"]
+                index_values = index_values["values"]
+                donor_columns = data[index_sheet][indiv]
+                original = self.original_columns.setdefault(d, {})
+                if (index_sheet, index_field) not in original:
+                    original[(index_sheet, index_field)] = donor_columns[index_field]
+                if index_values != donor_columns[index_field]:
+                    self.rewritten.setdefault(d, set()).add(((index_field, index_sheet), node))
+                donor_columns[index_field] = index_values
+                key = self.parent_key(node, d, sheet, row, index_sheet, index_field)
+                for j, value in enumerate(index_values):
+                    if value is not None and value == key:
+                        node.children.setdefault(i, []).append(len(node.contexts))
+                        node.contexts.append((d, index_sheet, index_field, j))
+            except Exception:
+                self.fallback.add(d)
+
+    def assemble(self, node, i):
+        """Assemble the mapped values of node for its ith context, as map_data_to_scaffold maps them."""
+        if isinstance(node, FieldNode):
+            return node.values[i]
+        if isinstance(node, IndexNode):
+            result = []
+            for child in node.children.get(i, []):
+                sub_result = self.assemble(node.nodes, child)
+                if sub_result is not None:
+                    result.append(sub_result)
+            if len(result) == 0:
+                return None
+            return result
+        if isinstance(node, DictNode):
+            result = {}
+            for key, value in node.items:
+                sub_result = self.assemble(value, i)
+                if sub_result is not None:
+                    add_calculated(key, sub_result)
+                    result[key] = sub_result
+            if len(result) == 0:
+                return None
+            return result
+        return None
+
+    def map_donor(self, indiv):
+        """Return the packets of one of the individuals that were prepared, as map_donor would."""
+        d = self.positions.get(indiv)
+        if d is None or d in self.fallback:
+            return map_donor(indiv, self.manifest, self.mapping_scaffold)
+        mappings.IDENTIFIER = indiv
+        for key, values in self.calculated.pop(d, {}).items():
+            for value in values:
+                add_calculated(key, value)
+        packet = self.assemble(self.root, d)
+        if packet is None:
+            return None
+        main_key = list(packet.keys())[0]
+        return packet[main_key]
+
+
+def donor_costs(individuals):
+    """An estimate of the work of mapping each of the individuals: the number of rows it has across all sheets."""
+    costs = dict.fromkeys(individuals, 0)
+    for rows in mappings.INDEXED_DATA["data"].values():
+        for indiv in individuals:
+            if indiv in rows:
+                costs[indiv] += len(rows[indiv][mappings.IDENTIFIER_FIELD])
+    return costs
+
+
+def schedule_donors(costs, workers):
+    """
+    Split the donors into chunks to dispatch to workers, largest first. Each chunk has about a twentieth of a
+    worker's share of the total cost, so the largest donors are dispatched on their own, before any small ones, and
+    the chunks at the end are small enough that no worker is left mapping a long tail on its own.
+    """
+    # sorting is stable, so donors of the same size are dispatched in order
+    order = sorted(costs, key=lambda indiv: costs[indiv], reverse=True)
+    target = sum(costs.values()) / (workers * 20)
+    chunks = []
+    chunk = []
+    chunk_cost = 0
+    for indiv in order:
+        chunk.append(indiv)
+        chunk_cost += costs[indiv]
+        if chunk_cost >= target:
+            chunks.append(chunk)
+            chunk = []
+            chunk_cost = 0
+    if len(chunk) > 0:
+        chunks.append(chunk)
+    return chunks
+
+
+# the function that maps a donor in a worker of a ParallelMapper, inherited when the worker is forked
+_worker_mapper = None
+
+
+def _map_donors(donors, return_rows):
+    """Map a chunk of donors in a worker. Returns the worker's pid, the time it took, and for each donor its
+    packets, CALCULATED values, rows (if return_rows, since mapping adds index values to them) and MappingError."""
+    start = time.perf_counter()
+    data = mappings.INDEXED_DATA["data"]
+    results = []
+    for indiv in donors:
+        try:
+            packet = _worker_mapper(indiv)
+        except mappings.MappingError as e:
+            # the snapshot has to be written here, where the donor's data is as the mapping left it
+            e.write_snapshot()
+            results.append((indiv, None, None, None, e))
+            continue
+        calculated = data.get("CALCULATED", {}).get(indiv)
+        rows = None
+        if return_rows:
+            rows = {sheet: data[sheet][indiv] for sheet in data if sheet != "CALCULATED" and indiv in data[sheet]}
+        results.append((indiv, packet, calculated, rows, None))
+    return os.getpid(), time.perf_counter() - start, results
+
+
+def _mapping_worker(connection, return_rows):
+    """Map each chunk of donors that's received on connection, sending back what _map_donors returns for it, until
+    None is received."""
+    while True:
+        donors = connection.recv()
+        if donors is None:
+            return
+        try:
+            result = _map_donors(donors, return_rows)
+        except BaseException as e:
+            connection.send(e)
+            return
+        connection.send(result)
+
+
+class ParallelMapper:
+    """
+    Maps the individuals in forked worker processes, which inherit INDEXED_DATA and mapper. Donors are dispatched
+    largest first, by schedule_donors, each chunk to the next worker that's free, and map_donor returns each donor's
+    packets in turn, as mapper would, waiting for its chunk if it hasn't been mapped yet, and adds its CALCULATED
+    values (and rows, if return_rows) to INDEXED_DATA. If stop_on_error, the workers are stopped once a donor's
+    MappingError is raised. The utilization of each worker is reported once all of the donors have been returned.
+
+    The workers are sent their chunks over pipes, rather than by a pool that runs threads to do it, so that other
+    processes, like a PacketWriter's validator or the next shard's indexer, can be forked safely while they work.
+    """
+    def __init__(self, mapper, individuals, workers, return_rows=False, stop_on_error=True):
+        global _worker_mapper
+        self.workers = workers
+        self.stop_on_error = stop_on_error
+        self.remaining = len(individuals)
+        self.results = {}
+        self.busy = {}
+        self.start = time.perf_counter()
+        costs = donor_costs(individuals)
+        self.largest = max(costs.values(), default=0)
+        self.total = sum(costs.values())
+        self.chunks = deque(schedule_donors(costs, workers))
+        self.processes = []
+        # the connections to the workers that are mapping a chunk
+        self.pending = set()
+        _worker_mapper = mapper
+        # the workers have to be forked, so that they have the indexed data without reading it again
+        context = multiprocessing.get_context("fork")
+        for _ in range(min(workers, len(self.chunks))):
+            connection, worker_connection = context.Pipe()
+            process = context.Process(target=_mapping_worker, args=(worker_connection, return_rows), daemon=True)
+            process.start()
+            worker_connection.close()
+            self.processes.append((process, connection))
+            self.dispatch(connection)
+        _worker_mapper = None
+
+    def dispatch(self, connection):
+        """Send the next chunk to the worker on connection, if there are any left."""
+        if len(self.chunks) > 0:
+            connection.send(self.chunks.popleft())
+            self.pending.add(connection)
+
+    def collect(self):
+        for connection in multiprocessing.connection.wait(list(self.pending)):
+            self.pending.remove(connection)
+            result = connection.recv()
+            if isinstance(result, BaseException):
+                self.stop()
+                raise result
+            pid, elapsed, results = result
+            self.busy[pid] = self.busy.get(pid, 0) + elapsed
+            for result in results:
+                self.results[result[0]] = result
+            self.dispatch(connection)
+
+    def map_donor(self, indiv):
+        while indiv not in self.results:
+            if len(self.pending) == 0:
+                raise KeyError(f"{indiv} wasn't one of the individuals to map")
+            self.collect()
+        _, packet, calculated, rows, error = self.results.pop(indiv)
+        self.remaining -= 1
+        if self.remaining == 0:
+            self.finish()
+        if error is not None:
+            if self.stop_on_error:
+                self.stop()
+            raise error
+        if rows is not None:
+            for sheet, donor_rows in rows.items():
+                mappings.INDEXED_DATA["data"][sheet][indiv] = donor_rows
+        if calculated is not None:
+            restore_calculated(indiv, calculated)
+        return packet
+
+    def stop(self):
+        """Stop the workers, without waiting for the chunks they're mapping."""
+        for process, connection in self.processes:
+            process.terminate()
+            process.join()
+            connection.close()
+        self.processes = []
+        self.pending = set()
+
+    def finish(self):
+        for process, connection in self.processes:
+            connection.send(None)
+            process.join()
+            connection.close()
+        self.processes = []
+        elapsed = time.perf_counter() - self.start
+        utilization = ", ".join(f"{busy / elapsed:.0%}" for busy in sorted(self.busy.values(), reverse=True))
+        print(f"\n{Bcolors.OKGREEN}Mapped with {self.workers} workers in {elapsed:.1f}s; the largest donor has "
+              f"{self.largest} of {self.total} rows. Utilization of each worker: {utilization}{Bcolors.ENDC}")
+
+
+def donor_mapper(engine, manifest, mapping_scaffold, individuals, workers=1, return_rows=False, stop_on_error=True):
+    """Return a function that maps one of the individuals to its packets. The "donor" engine maps each donor
+    when it's reached; the "level" engine maps all of them with a LevelMapper first; the "compiled" engine maps each
+    donor with a module generated from the scaffold by codegen. With more than one worker, the donors are mapped
+    by a ParallelMapper, with return_rows and stop_on_error."""
+    if workers > 1 and len(individuals) > 1:
+        mapper = donor_mapper(engine, manifest, mapping_scaffold, individuals)
+        return ParallelMapper(mapper, individuals, workers, return_rows, stop_on_error).map_donor
+    if engine == "compiled":
+        generated, path = codegen.load(mapping_scaffold, manifest["mapping"])
+        generated.bind(call_mapping, index_rows, add_calculated, codegen.mapping_function)
+        verbose_print(f"Mapping with {path}")
+        return lambda indiv: map_donor(indiv, manifest, mapping_scaffold, generated)
+    if engine == "level":
+        try:
+            mapper = LevelMapper(manifest, mapping_scaffold)
+        except TemplateNotSupported as e:
+            print(f"\n{Bcolors.WARNING}WARNING: mapping one donor at a time, because {e}.{Bcolors.ENDC}")
+        else:
+            mapper.prepare(individuals)
+            return mapper.map_donor
+    return lambda indiv: map_donor(indiv, manifest, mapping_scaffold)
+
+
+def report_mapping_errors(error_report, failed=None):
+    """Write the error report. If failed is a donor, its mapping error stops the conversion; otherwise the donors
+    with errors were left out."""
+    report_path = serializer.dump(error_report.to_json(), f"{mappings.OUTPUT_FILE}_errors.json")
+    if failed is not None:
+        print(f"\n{Bcolors.FAIL}Mapping failed for {failed}: see {report_path} and the data for {failed} in "
+              f"{error_report.errors[-1]['snapshot']}{Bcolors.ENDC}")
+    else:
+        print(f"\n{Bcolors.WARNING}WARNING: {len(error_report)} donors could not be mapped and were left out of the "
+              f"map file: see {report_path}{Bcolors.ENDC}")
+
+
+def map_header(schema):
+    """The members of a map file other than its packets and its statistics."""
+    header = {"openapi_url": schema.openapi_url, "schema_class": type(schema).__name__}
+    if schema.katsu_sha is not None:
+        header["katsu_sha"] = schema.katsu_sha
+    return header
+
+
+def map_json(schema, packets):
+    """The map file of packets, whose statistics are taken from schema when they're written, once the packets have all
+    been validated."""
+    result = map_header(schema)
+    result[list(schema.validation_schema.keys())[0]] = packets
+    result["statistics"] = lambda: schema.statistics
+    return result
+
+
+class PacketWriter:
+    """
+    Validates and writes the packets of donors to the map file while the donors after them are still being mapped.
+    Every chunk_size packets are validated in another process, as validate_coverage validates them, and then queued,
+    as validation left them, for a thread that writes them to the map file. Adding packets only waits once validating
+    or writing is behind. The map file replaces <OUTPUT_FILE>_map.json once it's finished. If keep, the validated
+    packets are also kept in packets.
+    """
+    def __init__(self, schema, minify=False, compress=None, chunk_size=100, depth=4, keep=False):
+        self.schema = schema
+        self.minify = minify
+        self.compress = compress
+        self.chunk_size = chunk_size
+        self.chunk = []
+        self.packets = [] if keep else None
+        # the validator's process is forked here, so a PacketWriter has to be made before any threads are started
+        self.validator = validate_coverage.ChunkValidator(schema, map_header(schema), workers=1,
+                                                          on_validated=self.validated)
+        self.queue = queue.Queue(maxsize=depth)
+        # started when the first chunk has been validated
+        self.thread = None
+        self.error = None
+        self.path = serializer.output_path(f"{mappings.OUTPUT_FILE}_map.json", compress)
+        self.partial_path = None
+
+    def queued_packets(self):
+        while True:
+            chunk = self.queue.get()
+            if chunk is None:
+                return
+            yield from chunk
+
+    def write(self):
+        # the chunks have all been validated by the time the queue ends
+        result = map_json(self.schema, self.queued_packets())
+        try:
+            self.partial_path = serializer.dump(result, f"{mappings.OUTPUT_FILE}_map.partial.json",
+                                                pretty=not self.minify, compress=self.compress)
+        except BaseException as e:
+            self.error = e
+            # keep taking chunks, so that adding packets doesn't wait for a writer that has stopped
+            while self.queue.get() is not None:
+                pass
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.write, daemon=True)
+            self.thread.start()
+
+    def validated(self, packets):
+        if self.packets is not None:
+            self.packets.extend(packets)
+        self.start()
+        self.queue.put(packets)
+
+    def add(self, packets):
+        """Add the packets of the next donor."""
+        self.chunk.extend(packets)
+        if len(self.chunk) >= self.chunk_size:
+            self.validator.submit(self.chunk)
+            self.chunk = []
+
+    def finish(self):
+        """Validate and write the packets that are left, then the statistics. Returns the path of the map file."""
+        if len(self.chunk) > 0:
+            self.validator.submit(self.chunk)
+            self.chunk = []
+        self.validator.finish()
+        self.start()
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        os.replace(self.partial_path, self.path)
+        return self.path
+
+    def abort(self):
+        """Stop validating and writing, and remove the unfinished map file."""
+        self.validator.close()
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+        if self.partial_path is not None and os.path.exists(self.partial_path):
+            os.remove(self.partial_path)
+
+
+def index_shard(shard_dir, shard, sheets, verbose, sheet_columns, unique_rows=False):
+    """Read and index the dataframes of one shard."""
+    return process_data(read_shard(shard_dir, shard, sheets), verbose, sheet_columns, unique_rows=unique_rows)
+
+
+def _indexing_worker(connection, identifier_field, shard_dir, shard, sheets, verbose, sheet_columns, unique_rows):
+    """Index one shard in another process, sending its indexed data, or the exception that indexing it raised."""
+    mappings.IDENTIFIER_FIELD = identifier_field
+    try:
+        result = index_shard(shard_dir, shard, sheets, verbose, sheet_columns, unique_rows)
+    except BaseException as e:
+        result = e
+    connection.send(result)
+    connection.close()
+
+
+def indexed_shards(shard_dir, shards, sheets, verbose, sheet_columns, prefetch=False, unique_rows=False):
+    """Yield the indexed data of each shard in turn. If prefetch, each shard is read and indexed in another process
+    while the one before it is mapped. That process sends the shard back over a pipe, rather than through a pool that
+    runs threads to receive it, so that the workers of a ParallelMapper can be forked safely while it runs."""
+    if not prefetch:
+        for shard in range(shards):
+            yield index_shard(shard_dir, shard, sheets, verbose, sheet_columns, unique_rows)
+        return
+
+    def start(shard):
+        connection, worker_connection = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(target=_indexing_worker, daemon=True, args=(
+            worker_connection, mappings.IDENTIFIER_FIELD, shard_dir, shard, sheets, verbose, sheet_columns,
+            unique_rows))
+        process.start()
+        worker_connection.close()
+        return process, connection
+
+    next_shard = start(0)
+    try:
+        for shard in range(shards):
+            process, connection = next_shard
+            indexed_data = connection.recv()
+            connection.close()
+            process.join()
+            next_shard = None
+            if isinstance(indexed_data, BaseException):
+                raise indexed_data
+            if shard + 1 < shards:
+                next_shard = start(shard + 1)
+            yield indexed_data
+    finally:
+        if next_shard is not None:
+            next_shard[0].terminate()
+            next_shard[0].join()
+
+
+def first_sheets(sheets):
+    """The position of the first of sheets that each donor in INDEXED_DATA is in. An in-memory conversion orders
+    donors by the first sheet they're in, then by identifier, so donors mapped separately can be merged in its order."""
+    first_sheet = {}
+    for i, sheet in enumerate(sheets):
+        for indiv in mappings.INDEXED_DATA["data"][sheet]:
+            first_sheet.setdefault(indiv, i)
+    return first_sheet
+
+
+def convert_in_shards(input_path, manifest, schema, template_lines, shards, verbose=False, minify=False,
+                      compress=None, continue_on_error=False, engine="donor", columns=None, pipeline=False,
+                      workers=1):
+    """
+    Convert a cohort that doesn't fit in memory. The inputs are partitioned by donor into shards on disk, and one
+    shard at a time is indexed and mapped, writing its packets back to the shard. The shards are then merged in the
+    same order as an in-memory conversion, and the packets are validated and written to the map file as they're
+    merged. If pipeline, each shard is indexed while the one before it is mapped, and the merged packets are validated
+    and written by a PacketWriter. The donors of each shard are mapped by workers processes. Returns the validation
+    results.
+    """
+    mappings.OUTPUT_FILE = output_file_for(input_path)
+    shard_dir = f"{mappings.OUTPUT_FILE}_shards"
+    print(f"{Bcolors.OKGREEN}partitioning raw data into {shards} shards...{Bcolors.ENDC}", end="")
+    sheets, sheet_columns = partition_raw_data(input_path, shard_dir, shards, columns=columns)
+    check_sheets(input_path, template_lines, sheets)
+
+    # warn if any template lines map the same column to multiple lines:
+    scan_template_for_duplicate_mappings(template_lines)
+
+    mapping_scaffold = create_scaffold_from_template(template_lines)
+
+    if mapping_scaffold is None:
+        sys.exit("Could not create mapping scaffold. Make sure that the manifest specifies a valid csv template.")
+
+    print(f"\n{Bcolors.OKGREEN}Creating packets: {Bcolors.ENDC}")
+    error_report = mappings.ErrorReport()
+    shard_data = indexed_shards(shard_dir, shards, sheets, verbose, sheet_columns, pipeline, columns is not None)
+    for shard, indexed_data in enumerate(shard_data):
+        mappings.INDEXED_DATA = indexed_data
+        first_sheet = first_sheets(sheets)
+        mapper = donor_mapper(engine, manifest, mapping_scaffold, mappings.INDEXED_DATA["individuals"],
+                              workers=workers, stop_on_error=not continue_on_error)
+        with open(os.path.join(shard_dir, str(shard), "donors.ndjson"), "wb") as f:
+            progress = tqdm(mappings.INDEXED_DATA["individuals"], desc=f"Shard {shard + 1}/{shards}")
+            for indiv in progress:
+                progress.set_postfix_str(indiv)
+                try:
+                    packet = mapper(indiv)
+                except mappings.MappingError as e:
+                    error_report.add(e)
+                    if continue_on_error:
+                        continue
+                    report_mapping_errors(error_report, indiv)
+                    raise
+                if packet is not None:
+                    f.write(serializer.encode({"order": [first_sheet[indiv], indiv], "packets": packet}) + b"\n")
+    mappings.INDEXED_DATA = None
+    if len(error_report) > 0:
+        report_mapping_errors(error_report)
+
+    def merged_records():
+        files = [open(os.path.join(shard_dir, str(shard), "donors.ndjson"), "rb") for shard in range(shards)]
+        try:
+            yield from heapq.merge(*[map(serializer.decode, f) for f in files], key=lambda r: tuple(r["order"]))
+        finally:
+            for f in files:
+                f.close()
+
+    if pipeline:
+        print(f"\n{Bcolors.OKGREEN}Validating and saving packets to file.{Bcolors.ENDC}")
+        writer = PacketWriter(schema, minify, compress)
+        try:
+            for record in merged_records():
+                writer.add(record["packets"])
+            writer.finish()
+        except BaseException:
+            writer.abort()
+            raise
+        shutil.rmtree(shard_dir)
+        return {"validation_errors": schema.validation_errors, "validation_warnings": schema.validation_warnings}
+
+    def merged_packets(chunk_size=100):
+        # validate the packets a chunk at a time before they're written, as validate_ingest_map would
+        records = merged_records()
+        try:
+            start = 0
+            chunk = []
+            for record in records:
+                chunk.extend(record["packets"])
+                if len(chunk) >= chunk_size:
+                    schema.validate_cases(chunk, start)
+                    yield from chunk
+                    start += len(chunk)
+                    chunk = []
+            schema.validate_cases(chunk, start)
+            yield from chunk
+        finally:
+            records.close()
+
+    result = map_json(schema, merged_packets())
+
+    print(f"\n{Bcolors.OKGREEN}Validating and saving packets to file.{Bcolors.ENDC}")
+    schema.validation_stats = ValidationStats(schema.validation_schema.keys())
+    serializer.dump(result, f"{mappings.OUTPUT_FILE}_map.json", pretty=not minify, compress=compress)
+    schema.check_duplicate_ids()
+    shutil.rmtree(shard_dir)
+    return {"validation_errors": schema.validation_errors, "validation_warnings": schema.validation_warnings}
+
+
+def convert_shard(parts, input_path, manifest, schema, template_lines, mapping_scaffold, shard, verbose=False,
+                  continue_on_error=False, engine="donor", columns=None, workers=1, chunk_size=100):
+    """Map and validate the donors of one shard of the inputs into parts, a chunk_size donors at a time."""
+    print(f"{Bcolors.OKGREEN}reading shard {shard} of {parts.shards}...{Bcolors.ENDC}", end="")
+    raw_csv_dfs, sheet_columns = read_raw_shard(input_path, shard, parts.shards, columns=columns)
+    check_sheets(input_path, template_lines, raw_csv_dfs.keys())
+    print(f"{Bcolors.OKGREEN}indexing data{Bcolors.ENDC}")
+    mappings.INDEXED_DATA = process_data(raw_csv_dfs, verbose, sheet_columns, unique_rows=columns is not None)
+    del raw_csv_dfs
+    first_sheet = first_sheets(list(sheet_columns))
+    schema.identifier_registry = IdentifierRegistry()
+    error_report = mappings.ErrorReport()
+    donors = []
+
+    def add_donors():
+        validation = schema.validate_each_case([packet for _, packets in donors for packet in packets])
+        for order, packets in donors:
+            parts.add(order, packets, validation[:len(packets)])
+            validation = validation[len(packets):]
+        donors.clear()
+
+    print(f"\n{Bcolors.OKGREEN}Creating packets: {Bcolors.ENDC}")
+    parts.start(shard)
+    mapper = donor_mapper(engine, manifest, mapping_scaffold, mappings.INDEXED_DATA["individuals"],
+                          workers=workers, stop_on_error=not continue_on_error)
+    progress = tqdm(mappings.INDEXED_DATA["individuals"], desc=f"Shard {shard}/{parts.shards}")
+    for indiv in progress:
+        progress.set_postfix_str(indiv)
+        try:
+            packet = mapper(indiv)
+        except mappings.MappingError as e:
+            error_report.add(e)
+            if continue_on_error:
+                # keep the donors in order
+                add_donors()
+                parts.add_error([first_sheet[indiv], indiv], error_report.errors[-1])
+                continue
+            parts.abort()
+            report_mapping_errors(error_report, indiv)
+            raise
+        if packet is not None:
+            donors.append(([first_sheet[indiv], indiv], packet))
+            if len(donors) >= chunk_size:
+                add_donors()
+    add_donors()
+    parts.finish(schema.identifier_registry)
+    mappings.INDEXED_DATA = None
+    if len(error_report) > 0:
+        print(f"\n{Bcolors.WARNING}WARNING: {len(error_report)} donors of shard {shard} could not be mapped: they're "
+              f"reported when the shards are merged.{Bcolors.ENDC}")
+
+
+def convert_shards(input_path, manifest, schema, template_lines, shard, shards, fingerprint, verbose=False,
+                   continue_on_error=False, engine="donor", columns=None, workers=1):
+    """
+    Convert one shard of a cohort, or if shard is None, each shard that no other job has claimed until there are
+    none left, into ShardParts that merge_shards combines once every shard is converted. Returns the shards that
+    were converted.
+    """
+    mappings.OUTPUT_FILE = output_file_for(input_path)
+    parts = ShardParts(mappings.OUTPUT_FILE, shards, fingerprint)
+
+    # warn if any template lines map the same column to multiple lines:
+    scan_template_for_duplicate_mappings(template_lines)
+
+    mapping_scaffold = create_scaffold_from_template(template_lines)
+
+    if mapping_scaffold is None:
+        sys.exit("Could not create mapping scaffold. Make sure that the manifest specifies a valid csv template.")
+
+    converted = []
+    while shard is None or len(converted) == 0:
+        current = shard
+        if shard is None:
+            current = parts.claim_next()
+            if current is None:
+                break
+        else:
+            parts.claim(shard)
+        convert_shard(parts, input_path, manifest, schema, template_lines, mapping_scaffold, current, verbose=verbose,
+                      continue_on_error=continue_on_error, engine=engine, columns=columns, workers=workers)
+        converted.append(current)
+    return converted
+
+
+def merge_shards(input_path, manifest_file, minify=False, compress=None):
+    """
+    Combine the shards of input_path, converted with --shard, into the outputs of converting the whole cohort at
+    once: the map file, with its statistics, the errors of donors that couldn't be mapped, and the validation
+    results, with the ids that are duplicated across shards. Returns True if there are validation errors.
+    """
+    print(f"{Bcolors.OKGREEN}Starting merge...{Bcolors.ENDC}", end="")
+    manifest = load_manifest(manifest_file)
+    schema = manifest["schema"]
+    mappings.OUTPUT_FILE = output_file_for(input_path)
+    parts = ShardParts(mappings.OUTPUT_FILE)
+    parts.check()
+    schema.validation_errors = []
+    schema.validation_warnings = []
+    schema.validation_stats = ValidationStats(schema.validation_schema.keys())
+    error_report = mappings.ErrorReport()
+    cases = []
+
+    def merged_packets():
+        for map_record, statistics_record in parts.records():
+            if "error" in statistics_record:
+                error_report.errors.append(statistics_record["error"])
+                continue
+            schema.validation_errors.extend(statistics_record["validation_errors"])
+            schema.validation_warnings.extend(statistics_record["validation_warnings"])
+            if statistics_record["statistics"] is not None:
+                schema.validation_stats.merge(ValidationStats.from_state(statistics_record["statistics"]))
+            cases.extend(statistics_record["cases"])
+            yield from map_record["packets"]
+
+    result = map_json(schema, merged_packets())
+
+    print(f"\n{Bcolors.OKGREEN}Merging {parts.shards} shards to file.{Bcolors.ENDC}")
+    serializer.dump(result, f"{mappings.OUTPUT_FILE}_map.json", pretty=not minify, compress=compress)
+    if len(error_report) > 0:
+        report_mapping_errors(error_report)
+    # the ids are checked in the order they'd have been validated in, so that duplicates are reported in that order
+    schema.identifier_registry = parts.identifier_registry().reorder(cases)
+    schema.check_duplicate_ids()
+    parts.remove()
+    return report_validation({"validation_errors": schema.validation_errors,
+                              "validation_warnings": schema.validation_warnings}, input_path)
+
+
+def conversion_fingerprint(input_path, manifest_file, manifest, schema, extra=()):
+    """The fingerprint of converting input_path with a manifest, its template and mapping functions, and schema."""
+    module_files = [m.__file__ for m in mappings.MODULES.values() if getattr(m, "__file__", None) is not None]
+    return fingerprint(input_path, [manifest_file, manifest["mapping"]] + module_files,
+                       [json.dumps(schema.json_schema, sort_keys=True)] + list(extra))
+
+
+def csv_convert(input_path, manifest_file, minify=False, index_output=False, verbose=False, compress=None,
+                continue_on_error=False, checkpoint_every=None, resume=False, shards=None, sqlite=False,
+                engine="donor", used_columns_only=False, pipeline=False, workers=1, shard=None, donors=None,
+                sample=None, seed=None):
     mappings.VERBOSE = verbose
+    mappings.INDEX_STACK = mappings.IndexStack()
     # read manifest data
     print(f"{Bcolors.OKGREEN}Starting conversion...{Bcolors.ENDC}", end="")
     manifest = load_manifest(manifest_file)
@@ -674,23 +2064,96 @@ def csv_convert(input_path, manifest_file, minify=False, index_output=False, ver
     # read the mapping template (contains the mapping function for each
     # field)
     template_lines = read_mapping_template(manifest["mapping"])
-
-    # read the raw data
-    print(f"{Bcolors.OKGREEN}reading raw data...{Bcolors.ENDC}", end="")
-    raw_csv_dfs, mappings.OUTPUT_FILE = ingest_raw_data(input_path)
-    if not raw_csv_dfs:
-        sys.exit(f"No ingestable files (csv or xlsx) were found at {input_path}. Check path and try again.")
-    check_for_sheet_inconsistencies(set([re.findall(r"\(([\w\" ]+)", x)[0].replace('"',"") for x in template_lines]),
-                                    set(raw_csv_dfs.keys()))
-
-    print(f"{Bcolors.OKGREEN}indexing data{Bcolors.ENDC}")
-    mappings.INDEXED_DATA = process_data(raw_csv_dfs, verbose)
-    if index_output:
-        with open(f"{mappings.OUTPUT_FILE}_indexed.json", 'w') as f:
-            if minify:
-                json.dump(mappings.INDEXED_DATA, f)
-            else:
-                json.dump(mappings.INDEXED_DATA, f, indent=4)
+    columns = None
+    if used_columns_only:
+        columns = used_columns(create_scaffold_from_template(template_lines), manifest)
+
+    if engine == "level" and sqlite:
+        sys.exit("--engine level can't be used with --sqlite, since it maps all of the donors in memory at once.")
+    if workers > 1:
+        if engine == "level" or sqlite:
+            sys.exit("--workers can't be used with --engine level or --sqlite.")
+        if "fork" not in multiprocessing.get_all_start_methods():
+            sys.exit("--workers needs processes to be started by forking, which isn't available on this platform.")
+    if donors is not None or sample is not None:
+        if shards or shard is not None or checkpoint_every or resume or sqlite:
+            sys.exit("--donors and --sample can't be used with --shards, --shard, --checkpoint, --resume or --sqlite.")
+    if shard is not None:
+        if shards or index_output or checkpoint_every or resume or sqlite or pipeline:
+            sys.exit("--shard can't be used with --shards, --index, --checkpoint, --resume, --sqlite or --pipeline.")
+        shard_number, shard_count = shard
+        converted = convert_shards(input_path, manifest, schema, template_lines, shard_number, shard_count,
+                                   conversion_fingerprint(input_path, manifest_file, manifest, schema,
+                                                          [f"used_columns_only={used_columns_only}"]),
+                                   verbose=verbose, continue_on_error=continue_on_error, engine=engine,
+                                   columns=columns, workers=workers)
+        if len(converted) == 0:
+            print(f"\n{Bcolors.OKGREEN}Every shard of {shard_count} has already been started.{Bcolors.ENDC}")
+        else:
+            print(f"\n{Bcolors.OKGREEN}Converted shards {', '.join(str(s) for s in converted)} of {shard_count} "
+                  f"into {mappings.OUTPUT_FILE}_parts: merge them once every shard is converted.{Bcolors.ENDC}")
+        return None, None
+    if shards:
+        if index_output or checkpoint_every or resume or sqlite:
+            sys.exit("--shards can't be used with --index, --checkpoint, --resume or --sqlite.")
+        validation_results = convert_in_shards(input_path, manifest, schema, template_lines, shards,
+                                               verbose=verbose, minify=minify, compress=compress,
+                                               continue_on_error=continue_on_error, engine=engine,
+                                               columns=columns, pipeline=pipeline, workers=workers)
+        return None, report_validation(validation_results, input_path)
+
+    checkpoint = None
+    store = None
+    estimate = None
+    # where the validation results are written
+    results_path = input_path
+    records = []
+    if checkpoint_every or resume:
+        checkpoint = Checkpoint(output_file_for(input_path),
+                                conversion_fingerprint(input_path, manifest_file, manifest, schema,
+                                                       [f"sqlite={sqlite}", f"used_columns_only={used_columns_only}"]),
+                                checkpoint_every)
+    if resume:
+        print(f"{Bcolors.OKGREEN}resuming from {checkpoint.path}{Bcolors.ENDC}")
+        mappings.OUTPUT_FILE = output_file_for(input_path)
+        mappings.INDEXED_DATA, records = checkpoint.resume()
+        if sqlite:
+            store = open_indexed_store(input_path, verbose, columns)
+            mappings.INDEXED_DATA = store.indexed_data()
+    elif sqlite:
+        mappings.OUTPUT_FILE = output_file_for(input_path)
+        store = open_indexed_store(input_path, verbose, columns)
+        mappings.INDEXED_DATA = store.indexed_data()
+        check_sheets(input_path, template_lines, mappings.INDEXED_DATA["data"].keys())
+        if checkpoint is not None:
+            # the indexed data is already saved in the database
+            checkpoint.start(None)
+    else:
+        # read the raw data
+        print(f"{Bcolors.OKGREEN}reading raw data...{Bcolors.ENDC}", end="")
+        sheet_columns = None
+        if donors is not None or sample is not None:
+            # only the rows of the selected donors are kept as the inputs are read
+            selected = select_donors(input_path, donors, sample, seed)
+            start = time.perf_counter()
+            raw_csv_dfs, sheet_columns, total_rows = read_raw_subset(input_path, lambda x: str(x).strip() in selected,
+                                                                     columns=columns)
+            # the outputs of some of the donors don't replace the outputs of all of them
+            mappings.OUTPUT_FILE = f"{output_file_for(input_path)}_sample"
+            results_path = mappings.OUTPUT_FILE
+            estimate = SampleEstimate(raw_csv_dfs, total_rows, time.perf_counter() - start)
+        else:
+            raw_csv_dfs, mappings.OUTPUT_FILE = ingest_raw_data(input_path, columns)
+        check_sheets(input_path, template_lines, raw_csv_dfs.keys())
+
+        print(f"{Bcolors.OKGREEN}indexing data{Bcolors.ENDC}")
+        mappings.INDEXED_DATA = process_data(raw_csv_dfs, verbose, sheet_columns, unique_rows=columns is not None)
+        if donors is not None:
+            missing = [donor for donor in donors if donor.strip() not in mappings.INDEXED_DATA["individuals"]]
+            if len(missing) > 0:
+                print(f"{Bcolors.WARNING}WARNING: {', '.join(missing)} aren't in the inputs.{Bcolors.ENDC}")
+        if checkpoint is not None:
+            checkpoint.start(mappings.INDEXED_DATA)
 
     # if verbose flag is set, warn if column name is present in multiple sheets:
     if verbose:
@@ -707,71 +2170,94 @@ def csv_convert(input_path, manifest_file, minify=False, index_output=False, ver
     if mapping_scaffold is None:
         sys.exit("Could not create mapping scaffold. Make sure that the manifest specifies a valid csv template.")
 
+    if store is not None:
+        store.create_indexes(indexed_on_columns(mapping_scaffold))
+
     packets = []
     # for each identifier's row, make a packet
     print(f"\n{Bcolors.OKGREEN}Creating packets: {Bcolors.ENDC}")
-    progress = tqdm(mappings.INDEXED_DATA["individuals"])
+    error_report = mappings.ErrorReport()
+    # donors from the checkpoint are added as they were mapped, without mapping them again
+    for record in records:
+        restore_donor_record(record, packets, error_report)
+    individuals = mappings.INDEXED_DATA["individuals"]
+    mapper = donor_mapper(engine, manifest, mapping_scaffold, individuals[len(records):], workers=workers,
+                          return_rows=index_output, stop_on_error=not continue_on_error)
+    writer = None
+    if pipeline:
+        # made after the mapper, whose workers are forked before the writer starts its validator's threads
+        writer = PacketWriter(schema, minify, compress, keep=True)
+        writer.add(packets)
+    progress = tqdm(individuals[len(records):], initial=len(records), total=len(individuals))
     for indiv in progress:
         progress.set_postfix_str(indiv)
         # print(f"{Bcolors.OKGREEN}{indiv}  {Bcolors.ENDC}", end="\r")
-        mappings.IDENTIFIER = indiv
-
-        # If there is a reference_date in the manifest, we need to calculate that and add CALCULATED.REFERENCE_DATE to the INDEXED_DATA
-        if "reference_date" in manifest:
-            ref_temp = f"REFERENCE_DATE, {{{manifest['reference_date']}}}"
-            reference_date_scaffold = create_scaffold_from_template([ref_temp])
-            func, params = parse_mapping_function(reference_date_scaffold['REFERENCE_DATE'])
-            sheet = params[0].split('.')[0]
-            mappings._push_to_stack(sheet, mappings.IDENTIFIER_FIELD, 0)
-            map_data_to_scaffold(reference_date_scaffold, None, 0)
-            mappings.INDEX_STACK = []
-        mappings._push_to_stack(None, None, 0)
-        packet = map_data_to_scaffold(deepcopy(mapping_scaffold), None, 0)
+        try:
+            packet = mapper(indiv)
+        except mappings.MappingError as e:
+            error_report.add(e)
+            if continue_on_error:
+                # quarantine the donor: none of its mapped values are used
+                mappings.INDEXED_DATA["data"].get("CALCULATED", {}).pop(indiv, None)
+                if checkpoint is not None:
+                    checkpoint.add({"identifier": indiv, "error": error_report.errors[-1]})
+                continue
+            if checkpoint is not None:
+                checkpoint.save()
+            if writer is not None:
+                writer.abort()
+            report_mapping_errors(error_report, indiv)
+            raise
         if packet is not None:
-            main_key = list(packet.keys())[0]
-            packets.extend(packet[main_key])
-        if mappings._pop_from_stack() is None:
-            raise Exception(f"Stack popped too far!\n{mappings.IDENTIFIER_FIELD}: {mappings.IDENTIFIER}")
-        if mappings._pop_from_stack() is not None:
-            raise Exception(
-                f"Stack not empty\n{mappings.IDENTIFIER_FIELD}: {mappings.IDENTIFIER}\n {mappings.INDEX_STACK}")
-    if index_output:
-        with open(f"{mappings.OUTPUT_FILE}_indexed.json", 'w') as f:
-            if minify:
-                json.dump(mappings.INDEXED_DATA, f)
+            if writer is None:
+                packets.extend(packet)
             else:
-                json.dump(mappings.INDEXED_DATA, f, indent=4)
-
-    result_key = list(schema.validation_schema.keys()).pop(0)
-
-    result = {
-        "openapi_url": schema.openapi_url,
-        "schema_class": type(schema).__name__,
-        result_key: packets
-    }
-    if schema.katsu_sha is not None:
-        result["katsu_sha"] = schema.katsu_sha
-    print(f"{Bcolors.OKGREEN}Saving packets to file.{Bcolors.ENDC}")
-    with open(f"{mappings.OUTPUT_FILE}_map.json", 'w') as f:  # write to json file for ingestion
-        if minify:
-            json.dump(result, f)
-        else:
-            json.dump(result, f, indent=4)
+                writer.add(packet)
+        if checkpoint is not None:
+            checkpoint.add({
+                "identifier": indiv,
+                "packets": packet,
+                "calculated": mappings.INDEXED_DATA["data"].get("CALCULATED", {}).get(indiv)
+            })
+    if len(error_report) > 0:
+        report_mapping_errors(error_report)
+    # the indexed data is written after mapping, so that it includes the CALCULATED values
+    if index_output:
+        serializer.dump(mappings.INDEXED_DATA, f"{mappings.OUTPUT_FILE}_indexed.json", pretty=not minify,
+                        compress=compress)
 
-    # add validation data:
-    print(f"\n{Bcolors.OKGREEN}Starting validation...{Bcolors.ENDC}")
-    schema.validate_ingest_map(result)
+    if writer is not None:
+        print(f"\n{Bcolors.OKGREEN}Finishing validation and saving packets to file.{Bcolors.ENDC}")
+        try:
+            writer.finish()
+        except BaseException:
+            writer.abort()
+            raise
+        packets = writer.packets
+    else:
+        result = map_json(schema, packets)
+
+        # add validation data:
+        print(f"\n{Bcolors.OKGREEN}Starting validation...{Bcolors.ENDC}")
+        schema.validate_ingest_map(result)
+        print(f"{Bcolors.OKGREEN}Saving packets to file.{Bcolors.ENDC}")
+        # write to json file for ingestion
+        serializer.dump(result, f"{mappings.OUTPUT_FILE}_map.json", pretty=not minify, compress=compress)
     validation_results = {"validation_errors": schema.validation_errors,
                           "validation_warnings": schema.validation_warnings}
-    result["statistics"] = schema.statistics
-    with open(f"{mappings.OUTPUT_FILE}_map.json", 'w') as f:  # write to json file for ingestion
-        if minify:
-            json.dump(result, f)
-        else:
-            json.dump(result, f, indent=4)
+    if checkpoint is not None:
+        checkpoint.finish()
+    if store is not None:
+        store.close()
+    if estimate is not None:
+        estimate.report(len(individuals), packets)
+    return packets, report_validation(validation_results, results_path)
+
+
+def report_validation(validation_results, input_path):
+    """Write the validation results and print a summary of them. Returns True if there are validation errors."""
     errors_present = False
-    with open(f"{input_path}_validation_results.json", 'w') as f:
-        json.dump(validation_results, f, indent=4)
+    serializer.dump(validation_results, f"{input_path}_validation_results.json")
     print(f"Warnings written to {input_path}_validation_results.json.")
     if len(validation_results["validation_warnings"]) > 0:
         if len(validation_results["validation_warnings"]) > 20:
@@ -794,18 +2280,47 @@ def csv_convert(input_path, manifest_file, minify=False, index_output=False, ver
             print("\n".join(validation_results["validation_errors"]))
 
         errors_present = True
-    return packets, errors_present
+    return errors_present
+
+
+def parse_shard(shard):
+    """Parse the value of --shard, I/N or next/N, into (I, N), with I None for next."""
+    shard_match = re.fullmatch(r"(\d+|next)/(\d+)", shard.strip())
+    if shard_match is None or int(shard_match.group(2)) == 0:
+        sys.exit(f"--shard must be I/N, for shard I (counting from 0) of N shards, or next/N, not {shard}.")
+    shards = int(shard_match.group(2))
+    if shard_match.group(1) == "next":
+        return None, shards
+    if int(shard_match.group(1)) >= shards:
+        sys.exit(f"--shard {shard}: shards are counted from 0 to {shards - 1}.")
+    return int(shard_match.group(1)), shards
 
 
 def main():
     args = parse_args()
     input_path = args.input
     manifest_file = args.manifest
-    packets, errors = csv_convert(input_path, manifest_file, minify=args.minify, index_output=args.index,
-                                  verbose=args.verbose)
-    print(f"{Bcolors.OKGREEN}\nConverted file written to {mappings.OUTPUT_FILE}_map.json{Bcolors.ENDC}")
+    if args.command == "merge":
+        errors = merge_shards(input_path, manifest_file, minify=args.minify, compress=args.compress)
+    else:
+        shard = None if args.shard is None else parse_shard(args.shard)
+        packets, errors = csv_convert(input_path, manifest_file, minify=args.minify, index_output=args.index,
+                                      verbose=args.verbose, compress=args.compress,
+                                      continue_on_error=args.continue_on_error, checkpoint_every=args.checkpoint,
+                                      resume=args.resume, shards=args.shards, sqlite=args.sqlite,
+                                      engine=args.engine, used_columns_only=args.used_columns_only,
+                                      pipeline=args.pipeline, workers=args.workers, shard=shard,
+                                      donors=None if args.donors is None else args.donors.split(","),
+                                      sample=args.sample, seed=args.seed)
+        if shard is not None:
+            sys.exit(0)
+    map_path = serializer.output_path(f"{mappings.OUTPUT_FILE}_map.json", args.compress)
+    print(f"{Bcolors.OKGREEN}\nConverted file written to {map_path}{Bcolors.ENDC}")
     if errors:
         print(f"{Bcolors.WARNING}WARNING: this file cannot be ingested until all errors are fixed.{Bcolors.ENDC}")
+    elif args.command != "merge" and (args.donors is not None or args.sample is not None):
+        print(f"{Bcolors.WARNING}WARNING: this file only has the donors picked by --donors or --sample, so it shouldn't "
+              f"be ingested in place of a conversion of all of the donors.{Bcolors.ENDC}")
     else:
         print(f"{Bcolors.OKGREEN}INFO: this file can be ingested.{Bcolors.ENDC}")
     sys.exit(0)
@@ -0,0 +1,118 @@
+"""
+Saving the progress of a conversion, so that an interrupted conversion can be resumed where it left off.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import sys
+
+from clinical_etl import serializer
+
+
+def fingerprint(input_path, files, extra=()):
+    """
+    Return a fingerprint of everything a conversion depends on: the input files (by name, size and modification
+    time, since they can be very large), the contents of files, like the manifest, template and mapping functions,
+    and any extra strings. A checkpoint can only be resumed if the fingerprint is the same.
+    """
+    digest = hashlib.sha256()
+    input_files = [input_path]
+    if os.path.isdir(input_path):
+        input_files = [os.path.join(input_path, f) for f in sorted(os.listdir(input_path))]
+    for path in input_files:
+        stat = os.stat(path)
+        digest.update(f"{os.path.basename(path)}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+    for path in files:
+        with open(path, "rb") as f:
+            digest.update(hashlib.sha256(f.read()).digest())
+    for value in extra:
+        digest.update(value.encode())
+    return digest.hexdigest()
+
+
+class Checkpoint:
+    """
+    The progress of a conversion, saved in a {output_file}_checkpoint directory:
+    - indexed.json: INDEXED_DATA before any donor was mapped, so that resuming doesn't read and index the inputs again.
+      It isn't saved if the indexed data is kept in a database that's reused on resume.
+    - donors.ndjson: a record for each donor that was mapped, in order, with its packets
+    - state.json: the fingerprint of the conversion, and the number of donors (and bytes of donors.ndjson) that were
+      completely written at the last save. Anything in donors.ndjson after that is discarded on resume.
+    """
+    def __init__(self, output_file, fingerprint, every=100):
+        self.path = f"{output_file}_checkpoint"
+        self.fingerprint = fingerprint
+        self.every = every
+        self.done = 0
+        self.unsaved = 0
+        self.donors_file = None
+
+    def exists(self):
+        return os.path.exists(os.path.join(self.path, "state.json"))
+
+    def start(self, indexed_data):
+        """Start a new checkpoint, replacing any previous one. indexed_data is None if it doesn't need saving."""
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.makedirs(self.path)
+        if indexed_data is not None:
+            serializer.dump(indexed_data, os.path.join(self.path, "indexed.json"), pretty=False)
+        self.donors_file = open(os.path.join(self.path, "donors.ndjson"), "wb")
+        self.done = 0
+        self.save()
+
+    def resume(self):
+        """Return the INDEXED_DATA (if it was saved) and the donor records that were saved, and carry on adding to
+        this checkpoint."""
+        if not self.exists():
+            sys.exit(f"There is no checkpoint to resume at {self.path}.")
+        with open(os.path.join(self.path, "state.json")) as f:
+            state = json.load(f)
+        if state["fingerprint"] != self.fingerprint:
+            sys.exit(f"The inputs, manifest, template or mapping functions have changed since the checkpoint at "
+                     f"{self.path} was saved, so it can't be resumed: run the conversion again without --resume.")
+        if self.every is None:
+            self.every = state["every"]
+        indexed_data = None
+        if os.path.exists(os.path.join(self.path, "indexed.json")):
+            indexed_data = serializer.load(os.path.join(self.path, "indexed.json"))
+        self.donors_file = open(os.path.join(self.path, "donors.ndjson"), "r+b")
+        # drop donors that were written after the last save: they're mapped again
+        self.donors_file.truncate(state["offset"])
+        records = [serializer.decode(line) for line in self.donors_file if line.strip()]
+        self.donors_file.seek(0, os.SEEK_END)
+        if len(records) != state["done"]:
+            sys.exit(f"The checkpoint at {self.path} is incomplete: run the conversion again without --resume.")
+        self.done = state["done"]
+        return indexed_data, records
+
+    def add(self, record):
+        """Add the record of a mapped donor, saving the checkpoint every `every` donors."""
+        self.donors_file.write(serializer.encode(record) + b"\n")
+        self.unsaved += 1
+        if self.unsaved >= self.every:
+            self.save()
+
+    def save(self):
+        self.done += self.unsaved
+        self.unsaved = 0
+        self.donors_file.flush()
+        os.fsync(self.donors_file.fileno())
+        state = {
+            "fingerprint": self.fingerprint,
+            "every": self.every,
+            "done": self.done,
+            "offset": self.donors_file.tell()
+        }
+        # replace the state in one step, so that it's never half-written
+        state_path = os.path.join(self.path, "state.json")
+        with open(f"{state_path}.tmp", "w") as f:
+            json.dump(state, f)
+        os.replace(f"{state_path}.tmp", state_path)
+
+    def finish(self):
+        """Remove the checkpoint, once the conversion is complete."""
+        if self.donors_file is not None:
+            self.donors_file.close()
+        shutil.rmtree(self.path, ignore_errors=True)
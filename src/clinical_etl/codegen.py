@@ -0,0 +1,211 @@
+"""
+Generating a Python module from a mapping scaffold, so that donors can be mapped without walking the scaffold. Each
+array of the template becomes a function that maps its rows, with the mapping of each of its fields written out in
+the order that CSVConvert.map_data_to_scaffold would map them. The module is cached on disk, keyed by the scaffold it
+was generated from, and can be read to see exactly how a template is mapped.
+"""
+
+import hashlib
+import importlib.util
+import json
+import os
+import re
+import tempfile
+
+from clinical_etl import mappings
+
+# change this when the generated code changes, so that modules generated before aren't used
+GENERATOR_VERSION = "1"
+
+HEADER = '''\
+# Generated by clinical_etl.codegen from {template}: do not edit.
+# Mapping a donor calls map_scaffold(), with the donor's IDENTIFIER and a root frame already set up, as
+# CSVConvert.map_donor does before it calls map_data_to_scaffold.
+
+from clinical_etl import mappings
+
+# set by bind() when the module is loaded
+_call = None
+_index_rows = None
+_add_calculated = None
+_mapping_function = None
+_resolved = None
+'''
+
+BIND = '''\
+def bind(call, index_rows, add_calculated, mapping_function):
+    """Bind the functions of CSVConvert that the generated code calls, and the mapping functions."""
+    global _call, _index_rows, _add_calculated, _mapping_function, _resolved
+    _call = call
+    _index_rows = index_rows
+    _add_calculated = add_calculated
+    _mapping_function = mapping_function
+    _resolved = {}
+    for name, (modulename, function) in _FUNCTIONS.items():
+        globals()[name] = mapping_function(modulename, function)'''
+
+
+def parse_mapping(mapping):
+    """Return the name of the function and the parameters of a mapping, as CSVConvert.parse_mapping_function does."""
+    func_match = re.match(r".*\{(.+?)\((.+)\)\}.*", mapping)
+    if func_match is None:
+        return None, None
+    return func_match.group(1), [param.strip() for param in func_match.group(2).split(";")]
+
+
+def split_method(method):
+    """Return the module and function name of a mapping function, as CSVConvert.eval_mapping finds them."""
+    subfunc_match = re.match(r"(.+)\.(.+)", method)
+    if subfunc_match is not None:
+        return subfunc_match.group(1), subfunc_match.group(2)
+    return "mappings", method
+
+
+class Generator:
+    def __init__(self):
+        self.functions = []
+        self.mappings = []
+        self.variables = 0
+
+    def variable(self):
+        self.variables += 1
+        return f"v{self.variables}"
+
+    def mapping(self, mapping):
+        """Add a mapping to the ones that are bound when the module is loaded, and return its number."""
+        self.mappings.append(mapping)
+        return len(self.mappings) - 1
+
+    def call(self, mapping, rownum):
+        """The expression that evaluates a mapping, as CSVConvert.eval_mapping does."""
+        n = self.mapping(mapping)
+        return f"_call(_f{n}, _m{n}, _p{n}, {rownum}, _resolved)"
+
+    def node(self, node, line, rownum, out):
+        """Return the lines that map node into the variable out, as CSVConvert.map_data_to_scaffold does."""
+        if isinstance(node, dict) and "INDEX" in node:
+            return [f"{out} = {self.index(node, line)}()"]
+        if isinstance(node, str) and node != "":
+            return [f"mappings.CURRENT_LINE = {line!r}", f"{out} = {self.call(node, rownum)}"]
+        if isinstance(node, dict):
+            code = [f"{out} = {{}}"]
+            for key, value in node.items():
+                sub_result = self.variable()
+                code += self.node(value, key if line is None else f"{line}.{key}", rownum, sub_result)
+                code += [
+                    f"if {sub_result} is not None:",
+                    f"    _add_calculated({key!r}, {sub_result})",
+                    f"    {out}[{key!r}] = {sub_result}"
+                ]
+            code += [f"if len({out}) == 0:", f"    {out} = None"]
+            return code
+        return [f"{out} = None"]
+
+    def index(self, node, line):
+        """Add the function that maps an array, as CSVConvert.map_indexed_scaffold does, and return its name."""
+        position = len(self.functions)
+        name = f"map_index_{position}"
+        # keep the function's place, so that the functions are in the order of the template
+        self.functions.append(None)
+        code = [f"def {name}():", f"    # {line}: {node['INDEX']}"]
+        method, parameters = parse_mapping(node["INDEX"])
+        if parameters is None:
+            code += ["    return None"]
+        else:
+            index = self.call(node["INDEX"], None)
+            item = self.variable()
+            body = self.node(node["NODES"], f"{line}.INDEX", "i", item)
+            if line is not None:
+                code += [f"    mappings.CURRENT_LINE = {line!r}"]
+            code += [f"    index = _index_rows({index})",
+                     "    if index is None:",
+                     "        return None",
+                     "    index_sheet, index_field, rows = index",
+                     "    result = []",
+                     "    for i in rows:",
+                     "        with mappings.INDEX_STACK.frame(index_sheet, index_field, i):"]
+            code += [f"            {c}" for c in body]
+            code += [f"        if {item} is not None:",
+                     f"            result.append({item})",
+                     "    if len(result) == 0:",
+                     "        return None",
+                     "    return result"]
+        self.functions[position] = "\n".join(code)
+        return name
+
+    def source(self, mapping_scaffold, template):
+        code = ["def map_scaffold():"] + [f"    {c}" for c in self.node(mapping_scaffold, None, 0, "packet")]
+        code += ["    return packet"]
+        functions = {}
+        constants = []
+        for n, mapping in enumerate(self.mappings):
+            method, parameters = parse_mapping(mapping)
+            if method is None:
+                constants += [f"# {mapping}", f"_f{n} = None", f"_m{n} = None", f"_p{n} = None"]
+            else:
+                modulename, function = split_method(method)
+                functions[f"_f{n}"] = (modulename, function)
+                constants += [f"# {mapping}", f"_f{n} = None", f"_m{n} = {f'{modulename}.{function}'!r}",
+                              f"_p{n} = {tuple(parameters)!r}"]
+        constants += ["", "# the mapping function that each _f is bound to", f"_FUNCTIONS = {functions!r}"]
+        return "\n\n\n".join([HEADER.format(template=template) + "\n" + "\n".join(constants), BIND, "\n".join(code)]
+                                + self.functions) + "\n"
+
+
+def generate(mapping_scaffold, template="the template"):
+    """Return the source of a module that maps a donor with mapping_scaffold."""
+    return Generator().source(mapping_scaffold, template)
+
+
+def mapping_function(modulename, method):
+    """
+    Return the mapping function modulename.method. If it isn't loaded, return a function that fails in the same way
+    as CSVConvert.eval_mapping does when it's called.
+    """
+    module = mappings.MODULES.get(modulename)
+    if module is not None and hasattr(module, method):
+        return getattr(module, method)
+
+    def missing(data_values):
+        if module is None:
+            raise KeyError(modulename)
+        raise AttributeError(f"module {modulename!r} has no attribute {method!r}")
+    return missing
+
+
+def cache_path(mapping_scaffold, template_path):
+    """The path of the module generated from a scaffold, next to the template that it was made from."""
+    digest = hashlib.sha256(GENERATOR_VERSION.encode())
+    digest.update(json.dumps(mapping_scaffold).encode())
+    name = os.path.splitext(os.path.basename(template_path))[0]
+    return os.path.join(os.path.dirname(os.path.abspath(template_path)), "__pycache__",
+                        f"{name}_mapping_{digest.hexdigest()[:16]}.py")
+
+
+def load(mapping_scaffold, template_path):
+    """
+    Return the module generated from mapping_scaffold, generating it unless it's already cached, and the path it was
+    loaded from. It has to be bound with bind() before it's used.
+    """
+    path = cache_path(mapping_scaffold, template_path)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # conversions running at the same time, like --shard jobs, each write their own temporary file and replace
+        # the module with it in one step, so that none of them reads half of a module or loses its temporary file
+        fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(generate(mapping_scaffold, os.path.basename(template_path)))
+            os.replace(tmp_path, path)
+        except OSError:
+            # another conversion has written the same module, which is all that's needed
+            if not os.path.exists(path):
+                raise
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    module_name = os.path.splitext(os.path.basename(path))[0]
+    spec = importlib.util.spec_from_file_location(module_name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module, path
@@ -1,5 +1,11 @@
 import argparse
-import json
+import os
+import sys
+# Include clinical_etl parent directory in the module search path.
+current_dir = os.path.dirname(os.path.abspath(__file__))
+parent_dir = os.path.dirname(current_dir)
+sys.path.append(parent_dir)
+from clinical_etl import serializer
 
 
 def parse_args():
@@ -12,19 +18,18 @@ def parse_args():
 
 
 def generate_csv(input_path):
-    output_path = input_path.replace("_map.json", "_completeness.csv")
+    output_path = serializer.strip_compression_suffix(input_path).replace("_map.json", "_completeness.csv")
     print(f"Converting {input_path} to {output_path}")
-    with open(input_path) as f:
-        stats_dict = json.load(f)["statistics"]
-        with open(output_path, "w") as out:
-            out.write("Schema,Field,Total,Missing,Fraction_missing\n")
-            required_but_missing = stats_dict["required_but_missing"]
-            for k, v in required_but_missing.items():
-                for field, stats in v.items():
-                    total = stats["total"]
-                    missing = stats["missing"]
-                    fraction = missing / total
-                    out.write(f"{k},{field},{total},{missing},{round(fraction,2)}\n")
+    stats_dict = serializer.load(input_path)["statistics"]
+    with open(output_path, "w") as out:
+        out.write("Schema,Field,Total,Missing,Fraction_missing\n")
+        required_but_missing = stats_dict["required_but_missing"]
+        for k, v in required_but_missing.items():
+            for field, stats in v.items():
+                total = stats["total"]
+                missing = stats["missing"]
+                fraction = missing / total
+                out.write(f"{k},{field},{total},{missing},{round(fraction,2)}\n")
 
 
 if __name__ == "__main__":
@@ -17,18 +17,18 @@ def parse_args():
 
 def map_to_mcodepacket(placeholder_val, node, schema):
     # walk through the provided node of the mcodepacket and fill in the details
-    if "str" in str(type(node)):
+    if isinstance(node, str):
         return pick_value_for_node(placeholder_val, node, schema)
-    elif "list" in str(type(node)):
+    elif isinstance(node, list):
         new_node = []
         for i in range(0,len(node)):
             m = map_to_mcodepacket(placeholder_val, node[i], schema["items"])
-            if "list" in str(type(m)):
+            if isinstance(m, list):
                 new_node = m
             else:
                 new_node.append(m)
         return new_node
-    elif "dict" in str(type(node)):
+    elif isinstance(node, dict):
         scaffold = {}
         for key in node.keys():
             x = map_to_mcodepacket(placeholder_val, node[key], schema["properties"][key])
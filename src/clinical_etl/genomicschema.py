@@ -1,7 +1,9 @@
 import json
-import dateparser
+from clinical_etl.lazy import lazy_import
 from clinical_etl.schema import BaseSchema, ValidationError
 
+dateparser = lazy_import("dateparser")
+
 
 """
 A class for the representation of a GenomicSample object for candigv2-ingest.
@@ -0,0 +1,261 @@
+"""
+Keeping the indexed data in a SQLite database instead of in memory. IndexedStore.indexed_data() can be used in place
+of the INDEXED_DATA dict made by CSVConvert.process_data: each sheet is a table with a row for every row of the sheet,
+and a donor's rows are read from it when they're needed. The database is reused by later conversions of the same
+inputs, and can be queried directly when debugging a mapping, e.g. `sqlite3 raw_data_indexed.db 'select * from Donor'`.
+"""
+
+import json
+import os
+import sqlite3
+from collections.abc import Mapping, MutableMapping
+
+
+# tables that aren't sheets start with an underscore
+META_TABLE = "_meta"
+INDIVIDUALS_TABLE = "_individuals"
+CALCULATED_TABLE = "_calculated"
+REWRITTEN_TABLE = "_rewritten"
+
+# the identifier of a donor that hasn't been read: None can't be used, since it's the identifier of blank rows
+UNREAD = object()
+
+
+def quote(name):
+    """Quote a sheet or column name as a SQLite identifier."""
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+class DonorRows(dict):
+    """A donor's rows of a sheet, {column: [values]}, which records the columns that are set after they're read."""
+    def __init__(self, rows):
+        super().__init__(rows)
+        self.changed = set()
+
+    def __setitem__(self, column, values):
+        super().__setitem__(column, values)
+        self.changed.add(column)
+
+
+class SheetRows(Mapping):
+    """
+    The rows of one sheet, by identifier, in the same form as a sheet of INDEXED_DATA: {column: [values]}. The rows of
+    the donor that was read last are kept, because the mapping adds index values to them as it goes. The columns that
+    the mapping sets are written to a temporary table once another donor is read, and replace the columns that are
+    read from the sheet's table from then on, as they would in memory.
+    """
+    def __init__(self, connection, table, identifier_field):
+        self.connection = connection
+        self.table = table
+        self.identifier = UNREAD
+        self.rows = None
+        # the identifiers that have columns in REWRITTEN_TABLE, so that it's only read for them
+        self.rewritten = set()
+        # the statements are the same for every donor, so sqlite3 prepares each of them once and caches it. Rows with
+        # a blank identifier are indexed under None, as they are in memory, so identifiers are compared with IS.
+        self.select_rows = f"SELECT * FROM {quote(table)} WHERE {quote(identifier_field)} IS ? ORDER BY rowid"
+        self.select_exists = f"SELECT 1 FROM {quote(table)} WHERE {quote(identifier_field)} IS ? LIMIT 1"
+        self.select_identifiers = f"SELECT {quote(identifier_field)} FROM {quote(table)} GROUP BY 1 ORDER BY min(rowid)"
+        self.count_identifiers = f"SELECT count(*) FROM (SELECT 1 FROM {quote(table)} GROUP BY {quote(identifier_field)})"
+        self.select_rewritten = f"SELECT value FROM {REWRITTEN_TABLE} WHERE sheet = ? AND identifier IS ?"
+
+    def __contains__(self, identifier):
+        if identifier == self.identifier:
+            return True
+        return self.connection.execute(self.select_exists, (identifier,)).fetchone() is not None
+
+    def flush(self):
+        """Write the columns that the mapping set in the rows of the donor that was read last."""
+        if self.rows is not None and len(self.rows.changed) > 0:
+            self.connection.execute(f"INSERT INTO {REWRITTEN_TABLE} (sheet, identifier, value) VALUES (?, ?, ?) "
+                                    f"ON CONFLICT (sheet, identifier) DO UPDATE SET value = excluded.value",
+                                    (self.table, self.identifier,
+                                     json.dumps({column: self.rows[column] for column in self.rows.changed})))
+            self.rewritten.add(self.identifier)
+            self.rows.changed = set()
+
+    def __getitem__(self, identifier):
+        if identifier != self.identifier:
+            cursor = self.connection.execute(self.select_rows, (identifier,))
+            rows = cursor.fetchall()
+            if len(rows) == 0:
+                raise KeyError(identifier)
+            self.flush()
+            columns = [description[0] for description in cursor.description]
+            self.rows = DonorRows({column: [row[i] for row in rows] for i, column in enumerate(columns)})
+            if identifier in self.rewritten:
+                row = self.connection.execute(self.select_rewritten, (self.table, identifier)).fetchone()
+                rewritten = json.loads(row[0])
+                dict.update(self.rows, rewritten)
+                # they're written again with any other columns that are set
+                self.rows.changed = set(rewritten)
+            self.identifier = identifier
+        return self.rows
+
+    def __iter__(self):
+        return (row[0] for row in self.connection.execute(self.select_identifiers))
+
+    def __len__(self):
+        return self.connection.execute(self.count_identifiers).fetchone()[0]
+
+
+class CalculatedRows(MutableMapping):
+    """
+    The values CALCULATED while mapping each donor, by identifier. The mapping adds to the values of the donor that's
+    being mapped, so they're kept in memory and written to the database once another donor is reached.
+    """
+    def __init__(self, connection):
+        self.connection = connection
+        self.identifier = UNREAD
+        self.values = None
+
+    def _read(self, identifier):
+        if identifier != self.identifier:
+            self.flush()
+            row = self.connection.execute(f"SELECT value FROM {CALCULATED_TABLE} WHERE identifier IS ?",
+                                          (identifier,)).fetchone()
+            self.identifier = identifier
+            self.values = None if row is None else json.loads(row[0])
+
+    def flush(self):
+        """Write the values of the donor that was read last."""
+        if self.identifier is not UNREAD and self.values is not None:
+            self.connection.execute(f"INSERT INTO {CALCULATED_TABLE} (identifier, value) VALUES (?, ?) "
+                                    f"ON CONFLICT (identifier) DO UPDATE SET value = excluded.value",
+                                    (self.identifier, json.dumps(self.values)))
+
+    def __getitem__(self, identifier):
+        self._read(identifier)
+        if self.values is None:
+            raise KeyError(identifier)
+        return self.values
+
+    def __setitem__(self, identifier, values):
+        self._read(identifier)
+        self.values = values
+
+    def __delitem__(self, identifier):
+        self._read(identifier)
+        if self.values is None:
+            raise KeyError(identifier)
+        self.values = None
+        self.connection.execute(f"DELETE FROM {CALCULATED_TABLE} WHERE identifier IS ?", (identifier,))
+
+    def __iter__(self):
+        self.flush()
+        return (row[0] for row in self.connection.execute(f"SELECT identifier FROM {CALCULATED_TABLE} ORDER BY rowid"))
+
+    def __len__(self):
+        self.flush()
+        return self.connection.execute(f"SELECT count(*) FROM {CALCULATED_TABLE}").fetchone()[0]
+
+
+class SheetData(Mapping):
+    """The "data" of INDEXED_DATA: the rows of each sheet, then the CALCULATED values once there are any."""
+    def __init__(self, sheets, calculated):
+        self.sheets = sheets
+        self.calculated = calculated
+
+    def __getitem__(self, sheet):
+        if sheet == "CALCULATED":
+            return self.calculated
+        return self.sheets[sheet]
+
+    def __iter__(self):
+        yield from self.sheets
+        if len(self.calculated) > 0:
+            yield "CALCULATED"
+
+    def __len__(self):
+        return len(self.sheets) + (len(self.calculated) > 0)
+
+
+class IndexedStore:
+    """A SQLite database at path holding the indexed data of one input."""
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path, cached_statements=256)
+        self.connection.execute(f"CREATE TABLE IF NOT EXISTS {META_TABLE} (key PRIMARY KEY, value)")
+        self.data = None
+
+    def fingerprint(self):
+        row = self.connection.execute(f"SELECT value FROM {META_TABLE} WHERE key = 'fingerprint'").fetchone()
+        return None if row is None else row[0]
+
+    def _meta(self, key):
+        return json.loads(self.connection.execute(f"SELECT value FROM {META_TABLE} WHERE key = ?",
+                                                  (key,)).fetchone()[0])
+
+    def load(self, sheets, identifier_field, fingerprint):
+        """
+        Replace the contents of the database with sheets, an iterable of (sheet name, columns, {identifier:
+        {column: [values]}}) in the form that CSVConvert.index_sheet indexes them. fingerprint identifies the inputs,
+        so that the database is only reused for the same inputs.
+        """
+        self.connection.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.connection = sqlite3.connect(self.path, cached_statements=256)
+        with self.connection:
+            self.connection.execute(f"CREATE TABLE {META_TABLE} (key PRIMARY KEY, value)")
+            self.connection.execute(f"CREATE TABLE {INDIVIDUALS_TABLE} (identifier PRIMARY KEY)")
+            names = []
+            cols_index = {}
+            for sheet, columns, rows in sheets:
+                names.append(sheet)
+                for col in columns:
+                    cols_index.setdefault(col, []).append(sheet)
+                # columns aren't typed, so that the values are kept as the strings they were read as
+                self.connection.execute(f"CREATE TABLE {quote(sheet)} ({', '.join(quote(c) for c in columns)})")
+                self.connection.execute(f"CREATE INDEX {quote(f'{sheet}_{identifier_field}')} "
+                                        f"ON {quote(sheet)} ({quote(identifier_field)})")
+                self.connection.executemany(
+                    f"INSERT INTO {quote(sheet)} VALUES ({', '.join('?' * len(columns))})",
+                    (row for values in rows.values() for row in zip(*[values[col] for col in columns])))
+                self.connection.executemany(f"INSERT OR IGNORE INTO {INDIVIDUALS_TABLE} VALUES (?)",
+                                            ((indiv,) for indiv in rows))
+            self.connection.executemany(f"INSERT INTO {META_TABLE} VALUES (?, ?)", [
+                ("identifier_field", json.dumps(identifier_field)),
+                ("sheets", json.dumps(names)),
+                ("columns", json.dumps(cols_index)),
+                # written last, so that a database that wasn't completely loaded isn't reused
+                ("fingerprint", fingerprint)
+            ])
+
+    def create_indexes(self, columns):
+        """Index the columns that arrays are indexed_on, given as {sheet: [columns]}, for each donor's rows."""
+        identifier_field = self._meta("identifier_field")
+        with self.connection:
+            for sheet, sheet_columns in columns.items():
+                for col in sheet_columns:
+                    if col != identifier_field:
+                        self.connection.execute(
+                            f"CREATE INDEX IF NOT EXISTS {quote(f'{sheet}_{identifier_field}_{col}')} "
+                            f"ON {quote(sheet)} ({quote(identifier_field)}, {quote(col)})")
+
+    def indexed_data(self):
+        """
+        Return the indexed data in the form of INDEXED_DATA. The CALCULATED values, and the columns that INDEX
+        functions set, are kept in temporary tables, so that the database itself isn't written to while donors are
+        mapped, and they start empty for every conversion.
+        """
+        identifier_field = self._meta("identifier_field")
+        with self.connection:
+            self.connection.execute(f"CREATE TEMP TABLE IF NOT EXISTS {CALCULATED_TABLE} (identifier PRIMARY KEY, value)")
+            self.connection.execute(f"DELETE FROM {CALCULATED_TABLE}")
+            self.connection.execute(f"CREATE TEMP TABLE IF NOT EXISTS {REWRITTEN_TABLE} "
+                                    f"(sheet, identifier, value, PRIMARY KEY (sheet, identifier))")
+            self.connection.execute(f"DELETE FROM {REWRITTEN_TABLE}")
+        self.data = SheetData({sheet: SheetRows(self.connection, sheet, identifier_field)
+                               for sheet in self._meta("sheets")},
+                              CalculatedRows(self.connection))
+        return {
+            "identifier_field": identifier_field,
+            "columns": self._meta("columns"),
+            "individuals": [row[0] for row in
+                            self.connection.execute(f"SELECT identifier FROM {INDIVIDUALS_TABLE} ORDER BY rowid")],
+            "data": self.data
+        }
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,26 @@
+"""
+Importing modules when they're first used instead of when the modules that use them are imported. pandas, numpy,
+dateparser, requests and the jsonschema and openapi validators take most of a second to import between them, which
+is most of the time it takes to start CSVConvert, and all of the time it takes to ask it for --help.
+"""
+
+import importlib.util
+import sys
+
+
+def lazy_import(name):
+    """
+    Return the module called name, without running it: it's imported the first time one of its attributes is used.
+    A module that's already imported is returned as it is. Like an import, this fails if the module isn't installed.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f"No module named {name!r}", name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
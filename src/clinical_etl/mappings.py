@@ -1,20 +1,117 @@
 import ast
-import dateparser
 import json
 import datetime
 import math
+import re
+from collections import Counter
+from contextlib import contextmanager
 from dateutil import relativedelta
+from clinical_etl.lazy import lazy_import
+
+dateparser = lazy_import("dateparser")
+
+
+class StackFrame:
+    """A frame on the INDEX_STACK: the sheet, index field and row number currently being mapped."""
+    __slots__ = ("sheet", "id", "rownum")
+
+    def __init__(self, sheet, id, rownum):
+        self.sheet = sheet
+        self.id = id
+        self.rownum = rownum
+
+    def __getitem__(self, key):
+        # frames used to be dicts: keep frame["sheet"] working for custom mapping functions
+        return getattr(self, key)
+
+    def __repr__(self):
+        return f"{{'sheet': {self.sheet!r}, 'id': {self.id!r}, 'rownum': {self.rownum!r}}}"
+
+
+class IndexStack:
+    """The stack of indexed rows being mapped, from the root (donor) row down to the current row.
+
+    Frames should be added with the `frame` context manager, which pops the frame again when the block exits,
+    so pushes and pops are always balanced, even when a mapping raises an error.
+    """
+    __slots__ = ("_frames",)
+
+    def __init__(self):
+        self._frames = []
+
+    def __len__(self):
+        return len(self._frames)
+
+    def __iter__(self):
+        return iter(self._frames)
+
+    def __repr__(self):
+        return repr(self._frames)
+
+    @property
+    def top(self):
+        """The frame at the top of the stack (not a copy: changes to it change the stack)."""
+        return self._frames[-1]
+
+    def push(self, sheet, id, rownum):
+        frame = StackFrame(sheet, id, rownum)
+        self._frames.append(frame)
+        if VERBOSE:
+            print(f"Pushed to stack: {self}")
+        return frame
+
+    def pop(self):
+        if VERBOSE:
+            print("Popped from stack")
+        if len(self._frames) > 0:
+            return self._frames.pop()
+        return None
+
+    @contextmanager
+    def frame(self, sheet, id, rownum):
+        """Push a frame for the duration of a with block."""
+        frame = self.push(sheet, id, rownum)
+        try:
+            yield frame
+        finally:
+            self.pop()
+
+    def clear(self):
+        self._frames.clear()
+
 
 VERBOSE = False
 MODULES = {}
 IDENTIFIER_FIELD = None
 IDENTIFIER = None
-INDEX_STACK = []
+INDEX_STACK = IndexStack()
 INDEXED_DATA = None
 CURRENT_LINE = ""
 OUTPUT_FILE = ""
 DATE_FORMAT = None
-DEFAULT_DATE_PARSER = dateparser.DateDataParser(settings={'PREFER_DAY_OF_MONTH': 'first'})
+# the parser that dates are parsed with, made by default_date_parser() when it's first needed
+_default_date_parser = None
+# debug snapshots that have been written, by (OUTPUT_FILE, IDENTIFIER)
+DEBUG_SNAPSHOTS = {}
+# columns that mapping functions read from INDEXED_DATA themselves rather than from their parameters, as
+# {sheet: [columns]}, so that --used-columns-only still reads them
+IMPLICIT_COLUMNS = {"Donor": ["date_resolution"]}  # int_to_date_interval_json
+
+
+def default_date_parser():
+    """Return the DateDataParser that dates are parsed with. It's made the first time it's needed, since importing
+    dateparser takes a while."""
+    global _default_date_parser
+    if _default_date_parser is None:
+        _default_date_parser = dateparser.DateDataParser(settings={'PREFER_DAY_OF_MONTH': 'first'})
+    return _default_date_parser
+
+
+def __getattr__(name):
+    # mapping functions can still use mappings.DEFAULT_DATE_PARSER, which is made when it's first used
+    if name == "DEFAULT_DATE_PARSER":
+        return default_date_parser()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 class MappingError(Exception):
@@ -27,16 +124,84 @@ class MappingError(Exception):
     def __init__(self, value, field_level=3):
         self.value = value
         self.level = field_level
+        # where the error happened: by the time it's reported, the mapping may have moved on
+        self.identifier = IDENTIFIER
+        self.identifier_field = IDENTIFIER_FIELD
+        self.line = CURRENT_LINE
+        self.stack = [{"sheet": frame["sheet"], "id": frame["id"], "rownum": frame["rownum"]} for frame in INDEX_STACK]
+        self.method = None
+        self.inputs = None
+        self.snapshot_path = None
 
     def __str__(self):
-        with open(f"{OUTPUT_FILE}_indexed.json", "w") as f:
-            json.dump(INDEXED_DATA, f, indent=4)
         if self.level == 1:
             return repr(f"{self.value}")
         elif self.level == 2:
-            return repr(f"Check the values for {IDENTIFIER}: {self.value}")
+            return repr(f"Check the values for {self.identifier}: {self.value}")
         elif self.level == 3:
-            return repr(f"Check the values for {IDENTIFIER} in {IDENTIFIER_FIELD}: {self.value}")
+            return repr(f"Check the values for {self.identifier} in {self.identifier_field}: {self.value}")
+
+    def write_snapshot(self):
+        """Write the indexed data of the donor that failed, and only that donor, to
+        {OUTPUT_FILE}_{identifier}_debug.json. Each donor's snapshot is only written once. Returns its path."""
+        if self.snapshot_path is not None:
+            return self.snapshot_path
+        key = (OUTPUT_FILE, self.identifier)
+        if key not in DEBUG_SNAPSHOTS:
+            safe_identifier = re.sub(r"[^\w.-]", "_", str(self.identifier))
+            path = f"{OUTPUT_FILE}_{safe_identifier}_debug.json"
+            data = {}
+            if INDEXED_DATA is not None:
+                for sheet, rows in INDEXED_DATA["data"].items():
+                    if self.identifier in rows:
+                        data[sheet] = rows[self.identifier]
+            with open(path, "w") as f:
+                json.dump({"identifier": self.identifier, "data": data}, f, indent=4)
+            DEBUG_SNAPSHOTS[key] = path
+        self.snapshot_path = DEBUG_SNAPSHOTS[key]
+        return self.snapshot_path
+
+    def to_json(self):
+        return {
+            "identifier": self.identifier,
+            "field": self.line,
+            "method": self.method,
+            "inputs": self.inputs,
+            "message": str(self.value),
+            "stack": self.stack,
+            "snapshot": self.snapshot_path
+        }
+
+
+class ErrorReport:
+    """MappingErrors collected across donors, summarized by the field and mapping method that failed."""
+    def __init__(self):
+        self.errors = []
+
+    def __len__(self):
+        return len(self.errors)
+
+    def add(self, error):
+        """Add a MappingError to the report, writing a debug snapshot of its donor."""
+        error.write_snapshot()
+        self.errors.append(error.to_json())
+
+    def to_json(self):
+        counts = Counter()
+        donors = {}
+        for error in self.errors:
+            key = (error["field"], error["method"])
+            counts[key] += 1
+            donors.setdefault(key, {})[error["identifier"]] = None
+        return {
+            "total_errors": len(self.errors),
+            "total_donors": len(set(error["identifier"] for error in self.errors)),
+            "summary": [
+                {"field": field, "method": method, "count": count, "donors": list(donors[(field, method)])}
+                for (field, method), count in counts.most_common()
+            ],
+            "errors": self.errors
+        }
 
 
 def date(data_values):
@@ -71,14 +236,14 @@ def earliest_date(data_values):
     fields = list(data_values.keys())
     date_resolution = list(data_values[fields[0]].values())[0]
     dates = list(data_values[fields[1]].values())[0]
-    earliest = DEFAULT_DATE_PARSER.get_date_data(str(datetime.date.today()))
+    earliest = default_date_parser().get_date_data(str(datetime.date.today()))
     # Ensure dates is a list, not a string, to allow non-indexed, single value entries.
     if type(dates) is not list:
         dates_list = [dates]
     else:
         dates_list = dates
     for date in dates_list:
-        d = DEFAULT_DATE_PARSER.get_date_data(date)
+        d = default_date_parser().get_date_data(date)
         if d['date_obj'] < earliest['date_obj']:
             earliest = d
     return {
@@ -267,7 +432,7 @@ def list_val(data_values):
     if has_value(data_values):
         col = list(data_values.keys())[0]
         for sheet in data_values[col].keys():
-            if "list" in str(type(data_values[col][sheet])):
+            if isinstance(data_values[col][sheet], list):
                 all_items.extend(data_values[col][sheet])
             else:
                 all_items.append(data_values[col][sheet])
@@ -300,7 +465,7 @@ def index_val(data_values):
     if has_value(data_values):
         col = list(data_values.keys())[0]
         for sheet in data_values[col].keys():
-            if "list" in str(type(data_values[col][sheet])):
+            if isinstance(data_values[col][sheet], list):
                 all_items.extend(data_values[col][sheet])
             else:
                 all_items.append(data_values[col][sheet])
@@ -323,7 +488,7 @@ def flat_list_val(data_values):
         if item is not None:
             try:
                 result = ast.literal_eval(item)
-                if "list" in str(type(result)):
+                if isinstance(result, list):
                     all_items.extend(result)
             except Exception:
                 all_items.extend(map(lambda x: x.strip(), item.split(",")))
@@ -422,7 +587,7 @@ def ontology_placeholder(data_values):
         a dict of the format:
         {"id": "placeholder","label": data_values}
     """
-    if "str" in str(type(data_values)):
+    if isinstance(data_values, str):
         return {
             "id": "placeholder",
             "label": data_values
@@ -514,35 +679,15 @@ def _info(message, input_values=None):
 
 
 def _push_to_stack(sheet, id, rownum):
-    INDEX_STACK.append(
-        {
-            "sheet": sheet,
-            "id": id,
-            "rownum": rownum
-        }
-    )
-    if VERBOSE:
-        print(f"Pushed to stack: {INDEX_STACK}")
+    INDEX_STACK.push(sheet, id, rownum)
 
 
 def _pop_from_stack():
-    if VERBOSE:
-        print("Popped from stack")
-    if len(INDEX_STACK) > 0:
-        return INDEX_STACK.pop()
-    else:
-        return None
+    return INDEX_STACK.pop()
 
 
 def _peek_at_top_of_stack():
-    val = INDEX_STACK[-1]
-    if VERBOSE:
-        print(json.dumps(val, indent=2))
-    return {
-        "sheet": val["sheet"],
-        "id": val["id"],
-        "rownum": val["rownum"]
-    }
+    return INDEX_STACK.top
 
 
 def _is_null(cell):
@@ -573,7 +718,7 @@ def _parse_date(date_string):
     """
     if any(char in '0123456789' for char in date_string):
         try:
-            d = DEFAULT_DATE_PARSER.get_date_data(date_string)
+            d = default_date_parser().get_date_data(date_string)
             return d['date_obj'].strftime("%Y-%m")
         except Exception as e:
             raise MappingError(f"error in date({date_string}): {type(e)} {e}", field_level=2)
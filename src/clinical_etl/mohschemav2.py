@@ -1,7 +1,24 @@
 import json
-import dateparser
+from clinical_etl.lazy import lazy_import
 from clinical_etl.schema import BaseSchema, ValidationError
 
+dateparser = lazy_import("dateparser")
+
+
+PROGRESSION_STATES = [
+    "Distant progression",
+    "Loco-regional progression",
+    "Progression not otherwise specified",
+    "Relapse or recurrence"
+]
+
+SMOKING_STATES = [
+    "Current reformed smoker for <= 15 years",
+    "Current reformed smoker for > 15 years",
+    "Current reformed smoker, duration not specified",
+    "Current smoker"
+]
+
 
 """
 A class for the representation of a DonorWithClinicalData (MoHCCN data model v2) object in Katsu.
@@ -185,45 +202,255 @@ class MoHSchemaV2(BaseSchema):
         }
     }
 
+    ## Conditional checks between fields in the MoH data model: see BaseSchema.validation_rules.
+    validation_rules = {
+        "donors": [
+            {
+                "rule": "required_if",
+                "fields": ["cause_of_death", "date_of_death"],
+                "if": "is_deceased",
+                "truthy": True,
+                "presence": "key",
+                "level": "warn",
+                "message": "{field} required if is_deceased = Yes"
+            },
+            {
+                "rule": "forbidden_if",
+                "fields": ["lost_to_followup_after_clinical_event_identifier"],
+                "if": "is_deceased",
+                "truthy": True,
+                "level": "fail",
+                "message": "{field} cannot be present if is_deceased = Yes"
+            },
+            {
+                "rule": "required_if",
+                "fields": ["lost_to_followup_after_clinical_event_identifier"],
+                "if": "lost_to_followup_reason",
+                "presence": "key",
+                "level": "fail",
+                "message": "{if} should only be submitted if {field} is submitted"
+            },
+            {
+                "rule": "required_if",
+                "fields": ["lost_to_followup_after_clinical_event_identifier"],
+                "if": "date_alive_after_lost_to_followup",
+                "presence": "key",
+                "level": "warn",
+                "message": "{field} is required if {if} is submitted"
+            },
+            {
+                "rule": "forbidden_if",
+                "fields": ["cause_of_death"],
+                "if": "is_deceased",
+                "truthy": False,
+                "level": "fail",
+                "message": "{field} should only be submitted if is_deceased = Yes"
+            },
+            {
+                "rule": "forbidden_if",
+                "fields": ["date_of_death"],
+                "if": "is_deceased",
+                "truthy": False,
+                "level": "fail",
+                "message": "{field} should only be submitted if is_deceased = Yes"
+            }
+        ],
+        "primary_diagnoses": [
+            {
+                "rule": "required_if",
+                "fields": ["lymph_nodes_examined_method", "number_lymph_nodes_positive"],
+                "if": "lymph_nodes_examined_status",
+                "truthy": True,
+                "level": "warn",
+                "message": "{field} required if {if} = Yes"
+            }
+        ],
+        "treatments": [
+            {
+                "rule": "required_if",
+                "fields": ["chemotherapies"],
+                "if": "treatment_type",
+                "in": ["Chemotherapy"],
+                "presence": "nonempty",
+                "level": "warn",
+                "message": "treatment type Chemotherapy should have one or more chemotherapies submitted"
+            },
+            {
+                "rule": "required_if",
+                "fields": ["hormone_therapies"],
+                "if": "treatment_type",
+                "in": ["Hormonal therapy"],
+                "presence": "nonempty",
+                "level": "warn",
+                "message": "treatment type Hormonal therapy should have one or more hormone_therapies submitted"
+            },
+            {
+                "rule": "required_if",
+                "fields": ["immunotherapies"],
+                "if": "treatment_type",
+                "in": ["Immunotherapy"],
+                "presence": "nonempty",
+                "level": "warn",
+                "message": "treatment type Immunotherapy should have one or more immunotherapies submitted"
+            },
+            {
+                "rule": "required_if",
+                "fields": ["radiations"],
+                "if": "treatment_type",
+                "in": ["Radiation therapy"],
+                "presence": "nonempty",
+                "level": "warn",
+                "message": "treatment type Radiation therapy should have one or more radiation submitted"
+            },
+            {
+                "rule": "required_if",
+                "fields": ["surgeries"],
+                "if": "treatment_type",
+                "in": ["Surgery"],
+                "presence": "nonempty",
+                "level": "warn",
+                "message": "treatment type Surgery should have one or more surgery submitted"
+            },
+            {
+                "rule": "date_order",
+                "fields": ["treatment_start_date", "treatment_end_date"],
+                "level": "fail",
+                "message": "Treatment start cannot be after treatment end."
+            }
+        ],
+        "chemotherapies": [
+            {
+                "rule": "required_if",
+                "fields": ["chemotherapy_drug_dose_units"],
+                "if": "prescribed_cumulative_drug_dose",
+                "level": "warn",
+                "message": "{field} required if {if} is submitted"
+            },
+            {
+                "rule": "required_if",
+                "fields": ["chemotherapy_drug_dose_units"],
+                "if": "actual_cumulative_drug_dose",
+                "level": "warn",
+                "message": "{field} required if {if} is submitted"
+            }
+        ],
+        "hormone_therapies": [
+            {
+                "rule": "required_if",
+                "fields": ["hormone_drug_dose_units"],
+                "if": "prescribed_cumulative_drug_dose",
+                "level": "warn",
+                "message": "{field} required if {if} is submitted"
+            },
+            {
+                "rule": "required_if",
+                "fields": ["hormone_drug_dose_units"],
+                "if": "actual_cumulative_drug_dose",
+                "level": "warn",
+                "message": "{field} required if {if} is submitted"
+            }
+        ],
+        "immunotherapies": [
+            {
+                "rule": "required_if",
+                "fields": ["immunotherapy_drug_dose_units"],
+                "if": "prescribed_cumulative_drug_dose",
+                "level": "warn",
+                "message": "{field} required if {if} is submitted"
+            },
+            {
+                "rule": "required_if",
+                "fields": ["immunotherapy_drug_dose_units"],
+                "if": "actual_cumulative_drug_dose",
+                "level": "warn",
+                "message": "{field} required if {if} is submitted"
+            }
+        ],
+        "radiations": [
+            {
+                "rule": "required_if",
+                "fields": ["reference_radiation_treatment_id"],
+                "if": "radiation_boost",
+                "truthy": True,
+                "level": "warn",
+                "message": "{field} required if {if} = Yes"
+            }
+        ],
+        "followups": [
+            {
+                "rule": "required_if",
+                "fields": ["relapse_type", "date_of_relapse", "method_of_progression_status"],
+                "if": "disease_status_at_followup",
+                "in": PROGRESSION_STATES,
+                "presence": "key",
+                "level": "warn",
+                "message": "{field} is required if {if} is {value}"
+            }
+        ],
+        "biomarkers": [
+            {
+                "rule": "required_if",
+                "fields": ["hpv_strain"],
+                "if": "hpv_pcr_status",
+                "in": ["Positive"],
+                "presence": "key",
+                "level": "warn",
+                "message": "If hpv_pcr_status is positive, hpv_strain is required"
+            }
+        ],
+        "comorbidities": [
+            {
+                "rule": "forbidden_if",
+                "fields": ["laterality_of_prior_malignancy"],
+                "if": "prior_malignancy",
+                "not_in": ["Yes"],
+                "presence": "key",
+                "level": "fail",
+                "message": "{field} should not be submitted unless {if} = Yes"
+            }
+        ],
+        "exposures": [
+            {
+                "rule": "one_of_required",
+                "fields": ["tobacco_smoking_status"],
+                "level": "warn",
+                "message": "tobacco_smoking_status required for exposure"
+            },
+            {
+                "rule": "forbidden_if",
+                "fields": ["tobacco_type"],
+                "if": "tobacco_smoking_status",
+                "not_in": SMOKING_STATES + [None],
+                "presence": "key",
+                "level": "fail",
+                "message": "{field} cannot be submitted for {if} = {value}"
+            },
+            {
+                "rule": "forbidden_if",
+                "fields": ["pack_years_smoked"],
+                "if": "tobacco_smoking_status",
+                "not_in": SMOKING_STATES + [None],
+                "presence": "key",
+                "level": "fail",
+                "message": "{field} cannot be submitted for {if} = {value}"
+            }
+        ]
+    }
+
     def validate_donors(self, map_json):
         for prop in map_json:
             match prop:
-                case "is_deceased":
-                    if map_json["is_deceased"]:
-                        if "cause_of_death" not in map_json:
-                            self.warn("cause_of_death required if is_deceased = Yes")
-                        if "date_of_death" not in map_json:
-                            self.warn("date_of_death required if is_deceased = Yes")
-                case "lost_to_followup_after_clinical_event_identifier":
-                    if map_json["lost_to_followup_after_clinical_event_identifier"] is not None:
-                        if map_json["is_deceased"]:
-                            self.fail(
-                                "lost_to_followup_after_clinical_event_identifier cannot be present if is_deceased = Yes")
-                case "lost_to_followup_reason":
-                    if map_json["lost_to_followup_reason"] is not None:
-                        if "lost_to_followup_after_clinical_event_identifier" not in map_json:
-                            self.fail(
-                                "lost_to_followup_reason should only be submitted if lost_to_followup_after_clinical_event_identifier is submitted")
-                case "date_alive_after_lost_to_followup":
-                    if map_json["date_alive_after_lost_to_followup"] is not None:
-                        if "lost_to_followup_after_clinical_event_identifier" not in map_json:
-                            self.warn(
-                                "lost_to_followup_after_clinical_event_identifier is required if date_alive_after_lost_to_followup is submitted")
-                case "cause_of_death":
-                    if map_json["cause_of_death"] is not None:
-                        if not map_json["is_deceased"]:
-                            self.fail("cause_of_death should only be submitted if is_deceased = Yes")
                 case "primary_diagnoses":
                     birth = None
                     death = None
                     if len(map_json["primary_diagnoses"]) > 0:
                         if "date_of_birth" in map_json and map_json["date_of_birth"] not in [None, '']:
-                            if "dict" in str(type(map_json["date_of_birth"])):
+                            if isinstance(map_json["date_of_birth"], dict):
                                 birth = map_json["date_of_birth"]["month_interval"]
                             else:
                                 birth = dateparser.parse(map_json["date_of_birth"]).date()
                         if "date_of_death" in map_json and map_json["date_of_death"] not in [None, '']:
-                            if "dict" in str(type(map_json["date_of_death"])):
+                            if isinstance(map_json["date_of_death"], dict):
                                 death = map_json["date_of_death"]["month_interval"]
                             else:
                                 death = dateparser.parse(map_json["date_of_death"]).date()
@@ -231,7 +458,7 @@ class MoHSchemaV2(BaseSchema):
                         for diagnosis in map_json["primary_diagnoses"]:
                             diagnosis_date = None
                             if "date_of_diagnosis" in diagnosis and diagnosis["date_of_diagnosis"] not in [None, '']:
-                                if "dict" in str(type(diagnosis["date_of_diagnosis"])):
+                                if isinstance(diagnosis["date_of_diagnosis"], dict):
                                     diagnosis_date = diagnosis["date_of_diagnosis"]["month_interval"]
                                 else:
                                     diagnosis_date = dateparser.parse(diagnosis["date_of_diagnosis"]).date()
@@ -245,13 +472,13 @@ class MoHSchemaV2(BaseSchema):
                                     treatment_start = None
                                     treatment_end = None
                                     if "treatment_start_date" in treatment and treatment["treatment_start_date"] not in [None, '']:
-                                        if "dict" in str(type(treatment["treatment_start_date"])):
+                                        if isinstance(treatment["treatment_start_date"], dict):
                                             treatment_start = treatment["treatment_start_date"]['month_interval']
 
                                         else:
                                             treatment_start = dateparser.parse(treatment["treatment_start_date"]).date()
                                     if "treatment_end_date" in treatment and treatment["treatment_end_date"] not in [None, '']:
-                                        if "dict" in str(type(treatment["treatment_end_date"])):
+                                        if isinstance(treatment["treatment_end_date"], dict):
                                             treatment_end = treatment["treatment_end_date"]['month_interval']
                                         else:
                                             treatment_end = dateparser.parse(treatment["treatment_end_date"]).date()
@@ -272,16 +499,13 @@ class MoHSchemaV2(BaseSchema):
                                         if 'diagnosis_date' in locals() and diagnosis_date not in [None, ''] and treatment_start < diagnosis_date:
                                             self.warn(f"{diagnosis['submitter_primary_diagnosis_id']} > {treatment['submitter_treatment_id']}: treatment_start_date should not be before date_of_diagnosis")
                         diagnosis_values_list = list(diagnoses_dates.values())
-                        if (len(diagnosis_values_list) > 0 and "int" in str(type(diagnosis_values_list[0])) and
+                        if (len(diagnosis_values_list) > 0 and isinstance(diagnosis_values_list[0], int) and
                                 0 not in diagnosis_values_list):
                             self.warn(f"Earliest primary_diagnosis.date_of_diagnosis.month_interval should be 0, current "
                                       f"month_intervals: {diagnoses_dates}")
                 case "date_of_death":
-                    if map_json["date_of_death"] is not None:
-                        if not map_json["is_deceased"]:
-                            self.fail("date_of_death should only be submitted if is_deceased = Yes")
                     if map_json["date_of_birth"] is not None and map_json["date_of_death"] is not None:
-                        if "dict" in str(type(map_json["date_of_birth"])):
+                        if isinstance(map_json["date_of_birth"], dict):
                             death = map_json["date_of_death"]["month_interval"]
                             birth = map_json["date_of_birth"]["month_interval"]
                             if ("date_alive_after_lost_to_followup" in map_json and
@@ -324,12 +548,6 @@ class MoHSchemaV2(BaseSchema):
 
         for prop in map_json:
             match prop:
-                case "lymph_nodes_examined_status":
-                    if map_json["lymph_nodes_examined_status"]:
-                        if "lymph_nodes_examined_method" not in map_json or map_json["lymph_nodes_examined_method"] is None:
-                            self.warn("lymph_nodes_examined_method required if lymph_nodes_examined_status = Yes")
-                        if "number_lymph_nodes_positive" not in map_json or map_json["number_lymph_nodes_positive"] is None:
-                            self.warn("number_lymph_nodes_positive required if lymph_nodes_examined_status = Yes")
                 case "clinical_tumour_staging_system":
                     self.validate_staging_system(map_json, "clinical")
 
@@ -362,91 +580,35 @@ class MoHSchemaV2(BaseSchema):
 
 
     def validate_biomarkers(self, map_json):
-        for prop in map_json:
-            match prop:
-                case "hpv_pcr_status":
-                    if map_json["hpv_pcr_status"] == "Positive" and "hpv_strain" not in map_json:
-                        self.warn("If hpv_pcr_status is positive, hpv_strain is required")
+        # hpv_strain is checked by validation_rules
+        return
 
 
     def validate_followups(self, map_json):
-        for prop in map_json:
-            match prop:
-                case "disease_status_at_followup":
-                    states = [
-                        "Distant progression",
-                        "Loco-regional progression",
-                        "Progression not otherwise specified",
-                        "Relapse or recurrence"
-                    ]
-                    if map_json["disease_status_at_followup"] in states:
-                        required_fields = [
-                            "relapse_type",
-                            "date_of_relapse",
-                            "method_of_progression_status"
-                        ]
-                        for field in required_fields:
-                            if field not in map_json:
-                                self.warn(f"{field} is required if disease_status_at_followup is {map_json['disease_status_at_followup']}")
-                        if "anatomic_site_progression_or_recurrence" not in map_json:
-                            if "relapse_type" in map_json and map_json["relapse_type"] != "Biochemical progression":
-                                self.warn(f"anatomic_site_progression_or_recurrence is required if disease_status_at_followup is {map_json['disease_status_at_followup']}")
+        if map_json.get("disease_status_at_followup") in PROGRESSION_STATES:
+            if "anatomic_site_progression_or_recurrence" not in map_json:
+                if "relapse_type" in map_json and map_json["relapse_type"] != "Biochemical progression":
+                    self.warn(f"anatomic_site_progression_or_recurrence is required if disease_status_at_followup is {map_json['disease_status_at_followup']}")
 
 
     def validate_treatments(self, map_json):
-        for prop in map_json:
-            match prop:
-                case "treatment_type":
-                    if map_json["treatment_type"] is not None:
-                        for t_type in map_json["treatment_type"]:
-                            match t_type:
-                                case "Chemotherapy":
-                                    if "chemotherapies" not in map_json or len(map_json["chemotherapies"]) == 0:
-                                        self.warn("treatment type Chemotherapy should have one or more chemotherapies submitted")
-                                case "Hormonal therapy":
-                                    if "hormone_therapies" not in map_json or len(map_json["hormone_therapies"]) == 0:
-                                        self.warn("treatment type Hormonal therapy should have one or more hormone_therapies submitted")
-                                case "Immunotherapy":
-                                    if "immunotherapies" not in map_json or len(map_json["immunotherapies"]) == 0:
-                                        self.warn("treatment type Immunotherapy should have one or more immunotherapies submitted")
-                                case "Radiation therapy":
-                                    if "radiations" not in map_json or len(map_json["radiations"]) == 0:
-                                        self.warn("treatment type Radiation therapy should have one or more radiation submitted")
-                                case "Surgery":
-                                    if "surgeries" not in map_json or len(map_json["surgeries"]) == 0:
-                                        self.warn("treatment type Surgery should have one or more surgery submitted")
-                case "treatment_start_date":
-                    if map_json["treatment_start_date"] is not None:
-                        if "treatment_end_date" in map_json and map_json["treatment_end_date"] is not None:
-                            if "dict" in str(type(map_json["treatment_start_date"])):
-                                start = map_json["treatment_start_date"]["month_interval"]
-                                end = map_json["treatment_end_date"]["month_interval"]
-                            else:
-                                start = dateparser.parse(map_json["treatment_start_date"]).date()
-                                end = dateparser.parse(map_json["treatment_end_date"]).date()
-                            if start > end:
-                                self.fail("Treatment start cannot be after treatment end.")
+        # treatment types and dates are checked by validation_rules
+        return
 
 
     def validate_chemotherapies(self, map_json):
-        if "chemotherapy_drug_dose_units" not in map_json or map_json["chemotherapy_drug_dose_units"] is None:
-            for x in ["prescribed_cumulative_drug_dose", "actual_cumulative_drug_dose"]:
-                if x in map_json and map_json[x] is not None:
-                    self.warn(f"chemotherapy_drug_dose_units required if {x} is submitted")
+        # chemotherapy_drug_dose_units is checked by validation_rules
+        return
 
 
     def validate_hormone_therapies(self, map_json):
-        if "hormone_drug_dose_units" not in map_json or map_json["hormone_drug_dose_units"] is None:
-            for x in ["prescribed_cumulative_drug_dose", "actual_cumulative_drug_dose"]:
-                if x in map_json and map_json[x] is not None:
-                    self.warn(f"hormone_drug_dose_units required if {x} is submitted")
+        # hormone_drug_dose_units is checked by validation_rules
+        return
 
 
     def validate_immunotherapies(self, map_json):
-        if "immunotherapy_drug_dose_units" not in map_json or map_json["immunotherapy_drug_dose_units"] is None:
-            for x in ["prescribed_cumulative_drug_dose", "actual_cumulative_drug_dose"]:
-                if x in map_json and map_json[x] is not None:
-                    self.warn(f"immunotherapy_drug_dose_units required if {x} is submitted")
+        # immunotherapy_drug_dose_units is checked by validation_rules
+        return
 
 
     def validate_radiations(self, map_json):
@@ -454,12 +616,8 @@ class MoHSchemaV2(BaseSchema):
         # if index > 0:
         #     self.fail("Only one radiation is allowed per treatment")
 
-        for prop in map_json:
-            match prop:
-                case "radiation_boost":
-                    if map_json["radiation_boost"]:
-                        if "reference_radiation_treatment_id" not in map_json or map_json["reference_radiation_treatment_id"] is None:
-                            self.warn("reference_radiation_treatment_id required if radiation_boost = Yes")
+        # reference_radiation_treatment_id is checked by validation_rules
+        return
 
 
     def validate_surgeries(self, map_json):
@@ -479,34 +637,13 @@ class MoHSchemaV2(BaseSchema):
 
 
     def validate_comorbidities(self, map_json):
-        for prop in map_json:
-            match prop:
-                case "laterality_of_prior_malignancy":
-                    if "prior_malignancy" not in map_json or map_json["prior_malignancy"] != "Yes":
-                        self.fail("laterality_of_prior_malignancy should not be submitted unless prior_malignancy = Yes")
+        # laterality_of_prior_malignancy is checked by validation_rules
+        return
 
 
     def validate_exposures(self, map_json):
-        is_smoker = False
-        if "tobacco_smoking_status" not in map_json or map_json["tobacco_smoking_status"] is None:
-            self.warn("tobacco_smoking_status required for exposure")
-        else:
-            if map_json["tobacco_smoking_status"] in [
-                "Current reformed smoker for <= 15 years",
-                "Current reformed smoker for > 15 years",
-                "Current reformed smoker, duration not specified",
-                "Current smoker"
-            ]:
-                is_smoker = True
-
-            for prop in map_json:
-                match prop:
-                    case "tobacco_type":
-                        if not is_smoker:
-                            self.fail(f"tobacco_type cannot be submitted for tobacco_smoking_status = {map_json['tobacco_smoking_status']}")
-                    case "pack_years_smoked":
-                        if not is_smoker:
-                            self.fail(f"pack_years_smoked cannot be submitted for tobacco_smoking_status = {map_json['tobacco_smoking_status']}")
+        # tobacco_smoking_status, tobacco_type and pack_years_smoked are checked by validation_rules
+        return
 
 
     def validate_staging_system(self, map_json, staging_type):
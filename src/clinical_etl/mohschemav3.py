@@ -1,7 +1,30 @@
 import json
-import dateparser
-from clinical_etl.schema import BaseSchema, ValidationError
+from clinical_etl.lazy import lazy_import
+from clinical_etl.schema import BaseSchema, ValidationError, parse_date_value
 
+dateparser = lazy_import("dateparser")
+numpy = lazy_import("numpy")
+pandas = lazy_import("pandas")
+
+
+def _is_later(df, a, b):
+    """Column-wise a > b, for comparable (same kind) non-null dates."""
+    return (df[f"{a}_kind"] == df[f"{b}_kind"]) & (df[a] > df[b])
+
+
+PROGRESSION_STATES = [
+    "Distant progression",
+    "Loco-regional progression",
+    "Progression not otherwise specified",
+    "Relapse or recurrence"
+]
+
+SMOKING_STATES = [
+    "Current reformed smoker for <= 15 years",
+    "Current reformed smoker for > 15 years",
+    "Current reformed smoker, duration not specified",
+    "Current smoker"
+]
 
 """
 A class for the representation of a DonorWithClinicalData (MoHCCN data model v2) object in Katsu.
@@ -163,129 +186,346 @@ class MoHSchemaV3(BaseSchema):
         }
     }
 
+    ## Conditional checks between fields in the MoH data model: see BaseSchema.validation_rules.
+    validation_rules = {
+        "donors": [
+            {
+                "rule": "required_if",
+                "fields": ["cause_of_death", "date_of_death"],
+                "if": "is_deceased",
+                "in": ["Yes"],
+                "presence": "key",
+                "level": "warn",
+                "message": "{field} required if is_deceased = Yes"
+            },
+            {
+                "rule": "forbidden_if",
+                "fields": ["lost_to_followup_after_clinical_event_identifier"],
+                "if": "is_deceased",
+                "in": ["Yes"],
+                "level": "fail",
+                "message": "{field} cannot be present if is_deceased = Yes"
+            },
+            {
+                "rule": "required_if",
+                "fields": ["lost_to_followup_after_clinical_event_identifier"],
+                "if": "lost_to_followup_reason",
+                "presence": "key",
+                "level": "fail",
+                "message": "{if} should only be submitted if {field} is submitted"
+            },
+            {
+                "rule": "required_if",
+                "fields": ["lost_to_followup_after_clinical_event_identifier"],
+                "if": "date_alive_after_lost_to_followup",
+                "presence": "key",
+                "level": "warn",
+                "message": "{field} is required if {if} is submitted"
+            },
+            {
+                "rule": "forbidden_if",
+                "fields": ["cause_of_death"],
+                "if": "is_deceased",
+                "in": ["No", "Not available"],
+                "level": "fail",
+                "message": "{field} should only be submitted if is_deceased = Yes"
+            },
+            {
+                "rule": "forbidden_if",
+                "fields": ["date_of_death"],
+                "if": "is_deceased",
+                "in": ["No", "Not available"],
+                "level": "fail",
+                "message": "{field} should only be submitted if is_deceased = Yes"
+            }
+        ],
+        "primary_diagnoses": [
+            {
+                "rule": "one_of_required",
+                "fields": ["clinical_tumour_staging_system", "pathological_tumour_staging_system"],
+                "presence": "key",
+                "level": "warn",
+                "message": "Either clinical_tumour_staging_system or pathological_staging_system is required"
+            }
+        ],
+        "treatments": [
+            {
+                "rule": "required_if",
+                "fields": ["systemic_therapies"],
+                "if": "treatment_type",
+                "in": ["Systemic therapy"],
+                "presence": "nonempty",
+                "level": "warn",
+                "message": "Treatment type Systemic therapy should have one or more systemic therapies submitted"
+            },
+            {
+                "rule": "required_if",
+                "fields": ["radiations"],
+                "if": "treatment_type",
+                "in": ["Radiation therapy"],
+                "presence": "nonempty",
+                "level": "warn",
+                "message": "Treatment type Radiation therapy should have one or more radiation submitted"
+            },
+            {
+                "rule": "required_if",
+                "fields": ["surgeries"],
+                "if": "treatment_type",
+                "in": ["Surgery"],
+                "presence": "nonempty",
+                "level": "warn",
+                "message": "Treatment type Surgery should have one or more surgery submitted"
+            },
+            {
+                "rule": "date_order",
+                "fields": ["treatment_start_date", "treatment_end_date"],
+                "level": "fail",
+                "message": "Treatment start cannot be after treatment end."
+            }
+        ],
+        "systemic_therapies": [
+            {
+                "rule": "required_if",
+                "fields": ["drug_dose_units"],
+                "if": "prescribed_cumulative_drug_dose",
+                "level": "warn",
+                "message": "{field} required if {if} is submitted"
+            },
+            {
+                "rule": "required_if",
+                "fields": ["drug_dose_units"],
+                "if": "actual_cumulative_drug_dose",
+                "level": "warn",
+                "message": "{field} required if {if} is submitted"
+            },
+            {
+                "rule": "date_order",
+                "fields": ["start_date", "end_date"],
+                "level": "fail",
+                "message": "Systemic therapy start cannot be after systemic therapy end."
+            }
+        ],
+        "radiations": [
+            {
+                "rule": "required_if",
+                "fields": ["reference_radiation_treatment_id"],
+                "if": "radiation_boost",
+                "in": ["Yes"],
+                "level": "warn",
+                "message": "{field} required if {if} = Yes"
+            }
+        ],
+        "followups": [
+            {
+                "rule": "required_if",
+                "fields": ["relapse_type", "date_of_relapse", "method_of_progression_status"],
+                "if": "disease_status_at_followup",
+                "in": PROGRESSION_STATES,
+                "presence": "key",
+                "level": "warn",
+                "message": "{field} is required if {if} is {value}"
+            }
+        ],
+        "biomarkers": [
+            {
+                "rule": "required_if",
+                "fields": ["hpv_strain"],
+                "if": "hpv_pcr_status",
+                "in": ["Positive"],
+                "presence": "key",
+                "level": "warn",
+                "message": "If hpv_pcr_status is positive, hpv_strain is required"
+            }
+        ],
+        "comorbidities": [
+            {
+                "rule": "forbidden_if",
+                "fields": ["laterality_of_prior_malignancy"],
+                "if": "prior_malignancy",
+                "not_in": ["Yes"],
+                "presence": "key",
+                "level": "fail",
+                "message": "{field} should not be submitted unless {if} = Yes"
+            }
+        ],
+        "exposures": [
+            {
+                "rule": "one_of_required",
+                "fields": ["tobacco_smoking_status"],
+                "level": "warn",
+                "message": "tobacco_smoking_status required for exposure"
+            },
+            {
+                "rule": "forbidden_if",
+                "fields": ["tobacco_type"],
+                "if": "tobacco_smoking_status",
+                "not_in": SMOKING_STATES + [None],
+                "presence": "key",
+                "level": "fail",
+                "message": "{field} cannot be submitted for {if} = {value}"
+            },
+            {
+                "rule": "forbidden_if",
+                "fields": ["pack_years_smoked"],
+                "if": "tobacco_smoking_status",
+                "not_in": SMOKING_STATES + [None],
+                "presence": "key",
+                "level": "fail",
+                "message": "{field} cannot be submitted for {if} = {value}"
+            }
+        ]
+    }
+
     def validate_donors(self, map_json):
         for prop in map_json:
             match prop:
-                case "is_deceased":
-                    if map_json["is_deceased"] == "Yes":
-                        if "cause_of_death" not in map_json:
-                            self.warn("cause_of_death required if is_deceased = Yes")
-                        if "date_of_death" not in map_json:
-                            self.warn("date_of_death required if is_deceased = Yes")
-                case "lost_to_followup_after_clinical_event_identifier":
-                    if map_json["lost_to_followup_after_clinical_event_identifier"] is not None:
-                        if map_json["is_deceased"] == "Yes":
-                            self.fail(
-                                "lost_to_followup_after_clinical_event_identifier cannot be present if is_deceased = Yes")
-                case "lost_to_followup_reason":
-                    if map_json["lost_to_followup_reason"] is not None:
-                        if "lost_to_followup_after_clinical_event_identifier" not in map_json:
-                            self.fail(
-                                "lost_to_followup_reason should only be submitted if lost_to_followup_after_clinical_event_identifier is submitted")
-                case "date_alive_after_lost_to_followup":
-                    if map_json["date_alive_after_lost_to_followup"] is not None:
-                        if "lost_to_followup_after_clinical_event_identifier" not in map_json:
-                            self.warn(
-                                "lost_to_followup_after_clinical_event_identifier is required if date_alive_after_lost_to_followup is submitted")
-                case "cause_of_death":
-                    if map_json["cause_of_death"] is not None:
-                        if map_json["is_deceased"] in ["No", "Not available"]:
-                            self.fail("cause_of_death should only be submitted if is_deceased = Yes")
                 case "primary_diagnoses":
-                    birth = None
-                    death = None
                     if len(map_json["primary_diagnoses"]) > 0:
-                        if "date_of_birth" in map_json and map_json["date_of_birth"] not in [None, '']:
-                            if "dict" in str(type(map_json["date_of_birth"])):
-                                birth = map_json["date_of_birth"]["month_interval"]
-                            else:
-                                birth = dateparser.parse(map_json["date_of_birth"]).date()
-                        if "date_of_death" in map_json and map_json["date_of_death"] not in [None, '']:
-                            if "dict" in str(type(map_json["date_of_death"])):
-                                death = map_json["date_of_death"]["month_interval"]
-                            else:
-                                death = dateparser.parse(map_json["date_of_death"]).date()
-                        diagnoses_dates = {}
-                        for diagnosis in map_json["primary_diagnoses"]:
-                            diagnosis_date = None
-                            if "date_of_diagnosis" in diagnosis and diagnosis["date_of_diagnosis"] not in [None, '']:
-                                if "dict" in str(type(diagnosis["date_of_diagnosis"])):
-                                    diagnosis_date = diagnosis["date_of_diagnosis"]["month_interval"]
-                                else:
-                                    diagnosis_date = dateparser.parse(diagnosis["date_of_diagnosis"]).date()
-                                diagnoses_dates[diagnosis['submitter_primary_diagnosis_id']] = diagnosis_date
-                                if 'death' in locals() and death not in [None, ''] and diagnosis_date > death:
-                                    self.fail(f"{diagnosis['submitter_primary_diagnosis_id']}: date_of_death cannot be earlier than date_of_diagnosis")
-                                if 'birth' in locals() and birth not in [None, ''] and diagnosis_date < birth:
-                                    self.fail(f"{diagnosis['submitter_primary_diagnosis_id']}: date_of_birth cannot be later than date_of_diagnosis")
-                            if "treatments" in diagnosis and len(diagnosis["treatments"]) > 0:
-                                for treatment in diagnosis["treatments"]:
-                                    treatment_start = None
-                                    treatment_end = None
-                                    if "treatment_start_date" in treatment and treatment["treatment_start_date"] not in [None, '']:
-                                        if "dict" in str(type(treatment["treatment_start_date"])):
-                                            treatment_start = treatment["treatment_start_date"]['month_interval']
-                                        else:
-                                            treatment_start = dateparser.parse(treatment["treatment_start_date"]).date()
-                                    if "treatment_end_date" in treatment and treatment["treatment_end_date"] not in [None, '']:
-                                        if "dict" in str(type(treatment["treatment_end_date"])):
-                                            treatment_end = treatment["treatment_end_date"]['month_interval']
-                                        else:
-                                            treatment_end = dateparser.parse(treatment["treatment_end_date"]).date()
-                                    if ('death' in locals() and death not in [None, ''] and
-                                            'treatment_end' in locals() and treatment_end not in [None, '']
-                                            and treatment_end > death):
-                                        self.fail(f"{diagnosis['submitter_primary_diagnosis_id']} > {treatment['submitter_treatment_id']}: date_of_death cannot be earlier than treatment_end_date ")
-                                    if ('diagnosis_date' in locals() and diagnosis_date not in [None, ''] and
-                                            treatment_end not in [None, ''] and 'treatment_end' in locals() and
-                                            treatment_end < diagnosis_date):
-                                        self.warn(f"{diagnosis['submitter_primary_diagnosis_id']} > {treatment['submitter_treatment_id']}: date_of_diagnosis should be earlier than treatment_end_date ")
-                                    if 'treatment_start' in locals() and treatment_start not in [None, '']:
-                                        if 'death' in locals() and death not in [None, ''] and treatment_start > death:
-                                            self.fail(
-                                                    f"{diagnosis['submitter_primary_diagnosis_id']} > {treatment['submitter_treatment_id']}: treatment_start_date cannot be after date_of_death ")
-                                        if 'birth' in locals() and birth not in [None, ''] and treatment_start < birth and treatment_start is not None:
-                                            self.fail(f"{diagnosis['submitter_primary_diagnosis_id']} > {treatment['submitter_treatment_id']}: treatment_start_date cannot be before date_of_birth")
-                                        if 'diagnosis_date' in locals() and diagnosis_date not in [None, ''] and treatment_start < diagnosis_date:
-                                            self.warn(f"{diagnosis['submitter_primary_diagnosis_id']} > {treatment['submitter_treatment_id']}: treatment_start_date should not be before date_of_diagnosis")
-                        diagnosis_values_list = list(diagnoses_dates.values())
-                        if (len(diagnosis_values_list) > 0 and "int" in str(type(diagnosis_values_list[0])) and
-                                0 not in diagnosis_values_list):
-                            self.warn(f"Earliest primary_diagnosis.date_of_diagnosis.month_interval should be 0, current "
-                                      f"month_intervals: {diagnoses_dates}")
+                        for level, message in self.donor_date_checks_for(map_json)["primary_diagnoses"]:
+                            getattr(self, level)(message)
                 case "date_of_death":
-                    if map_json["date_of_death"] is not None:
-                        if map_json["is_deceased"] in ["No", "Not available"]:
-                            self.fail("date_of_death should only be submitted if is_deceased = Yes")
-                    if map_json["date_of_birth"] is not None and map_json["date_of_death"] is not None:
-                        if "dict" in str(type(map_json["date_of_birth"])):
-                            death = map_json["date_of_death"]["month_interval"]
-                            birth = map_json["date_of_birth"]["month_interval"]
-                            if ("date_alive_after_lost_to_followup" in map_json and
-                                    map_json["date_alive_after_lost_to_followup"] is not None):
-                                date_alive = map_json["date_alive_after_lost_to_followup"]["month_interval"]
-                        else:
-                            death = dateparser.parse(map_json["date_of_death"]).date()
-                            birth = dateparser.parse(map_json["date_of_birth"]).date()
-                            if ("date_alive_after_lost_to_followup" in map_json and
-                                    map_json["date_alive_after_lost_to_followup"] is not None):
-                                date_alive = dateparser.parse(
-                                    map_json["date_alive_after_lost_to_followup"]).date()
-                        if birth > death:
-                            self.fail("date_of_death cannot be earlier than date_of_birth")
-                        if "date_alive_after_lost_to_followup" in map_json and date_alive > death:
-                            self.fail("date_alive_after_lost_to_followup cannot be after date_of death")
-                        if "date_alive_after_lost_to_followup" in map_json and date_alive < birth:
-                            self.fail("date_alive_after_lost_to_followup cannot be before date_of birth")
+                    for level, message in self.donor_date_checks_for(map_json)["date_of_death"]:
+                        getattr(self, level)(message)
                 case "biomarkers":
                     for x in map_json["biomarkers"]:
                         if "test_date" not in x or x["test_date"] is None:
                             self.warn("test_date is required for biomarkers not associated with nested events")
 
-    def validate_primary_diagnoses(self, map_json):
-        if "clinical_tumour_staging_system" not in map_json and "pathological_tumour_staging_system" not in map_json:
-            self.warn("Either clinical_tumour_staging_system or pathological_staging_system is required")
+    def prepare_validation(self, root_objects, start=0):
+        self.donor_date_checks = self.check_donor_dates(root_objects, start)
+
+    def donor_date_checks_for(self, map_json):
+        """Return the precomputed date checks for the donor being validated, or compute them if there aren't any."""
+        index = self.validation_schema["donors"]["extra_args"]["index"]
+        checks = getattr(self, "donor_date_checks", {}).get(index)
+        if checks is None or checks["id"] != map_json.get("submitter_donor_id"):
+            checks = self.check_donor_dates([map_json], index)[index]
+        return checks
+
+    def check_donor_dates(self, donors, start=0):
+        """Check that birth < diagnosis < treatment start/end < death for a list of donors.
+
+        The dates of all of the donors, diagnoses and treatments are flattened into tables and compared column by
+        column, rather than donor by donor.
+
+        Returns:
+            a dict keyed by the position of each donor in the mapping (start + its index in donors), with the
+            (level, message) pairs that validate_donors should report for "primary_diagnoses" and "date_of_death", in
+            order.
+        """
+        parsed_dates = self.parsed_dates
+        donor_rows = []
+        diagnosis_rows = []
+        treatment_rows = []
+        diagnoses_dates = {}
+        for pos, donor in enumerate(donors):
+            birth = donor.get("date_of_birth")
+            if birth == "Not available":
+                # date_of_birth is a required field, so validate_schema will have set this to None
+                birth = None
+            birth_kind, birth_value, _ = parse_date_value(birth, parsed_dates)
+            death_kind, death_value, _ = parse_date_value(donor.get("date_of_death"), parsed_dates)
+            alive_kind, alive_value, _ = parse_date_value(donor.get("date_alive_after_lost_to_followup"), parsed_dates)
+            donor_rows.append((pos, "date_of_death" in donor, birth_kind, birth_value, death_kind, death_value,
+                               alive_kind, alive_value))
+            diagnoses_dates[pos] = {}
+            for pd_order, diagnosis in enumerate(donor.get("primary_diagnoses") or []):
+                pd_id = diagnosis.get("submitter_primary_diagnosis_id")
+                kind, value, raw = parse_date_value(diagnosis.get("date_of_diagnosis"), parsed_dates)
+                if kind is not None:
+                    diagnoses_dates[pos][pd_id] = raw
+                diagnosis_rows.append((pos, pd_order, pd_id, kind, value))
+                for tr_order, treatment in enumerate(diagnosis.get("treatments") or []):
+                    start_kind, start_value, _ = parse_date_value(treatment.get("treatment_start_date"), parsed_dates)
+                    end_kind, end_value, _ = parse_date_value(treatment.get("treatment_end_date"), parsed_dates)
+                    treatment_rows.append((pos, pd_order, tr_order, pd_id, treatment.get("submitter_treatment_id"),
+                                           start_kind, start_value, end_kind, end_value))
+
+        donor_df = pandas.DataFrame(donor_rows, columns=["pos", "has_death", "birth_kind", "birth", "death_kind",
+                                                         "death", "alive_kind", "alive"])
+        diagnosis_df = pandas.DataFrame(diagnosis_rows, columns=["pos", "pd_order", "pd_id", "diagnosis_kind",
+                                                                 "diagnosis"])
+        treatment_df = pandas.DataFrame(treatment_rows, columns=["pos", "pd_order", "tr_order", "pd_id", "tr_id",
+                                                                 "start_kind", "start", "end_kind", "end"])
+        donor_dates = donor_df[["pos", "birth_kind", "birth", "death_kind", "death"]]
+        diagnosis_df = diagnosis_df.merge(donor_dates, on="pos", how="left")
+        treatment_df = treatment_df.merge(donor_dates, on="pos", how="left").merge(
+            diagnosis_df[["pos", "pd_order", "diagnosis_kind", "diagnosis"]], on=["pos", "pd_order"], how="left")
+
+        # each rule is (table, mask, level, message suffix); rules are reported in this order for each row
+        diagnosis_prefix = diagnosis_df["pd_id"].astype(str)
+        treatment_prefix = treatment_df["pd_id"].astype(str) + " > " + treatment_df["tr_id"].astype(str)
+        rules = [
+            (diagnosis_df, diagnosis_prefix, _is_later(diagnosis_df, "diagnosis", "death"), "fail",
+             ": date_of_death cannot be earlier than date_of_diagnosis"),
+            (diagnosis_df, diagnosis_prefix, _is_later(diagnosis_df, "birth", "diagnosis"), "fail",
+             ": date_of_birth cannot be later than date_of_diagnosis"),
+            (treatment_df, treatment_prefix, _is_later(treatment_df, "end", "death"), "fail",
+             ": date_of_death cannot be earlier than treatment_end_date "),
+            (treatment_df, treatment_prefix, _is_later(treatment_df, "diagnosis", "end"), "warn",
+             ": date_of_diagnosis should be earlier than treatment_end_date "),
+            (treatment_df, treatment_prefix, _is_later(treatment_df, "start", "death"), "fail",
+             ": treatment_start_date cannot be after date_of_death "),
+            (treatment_df, treatment_prefix, _is_later(treatment_df, "birth", "start"), "fail",
+             ": treatment_start_date cannot be before date_of_birth"),
+            (treatment_df, treatment_prefix, _is_later(treatment_df, "diagnosis", "start"), "warn",
+             ": treatment_start_date should not be before date_of_diagnosis"),
+        ]
+        events = []
+        for rule_order, (df, prefix, mask, level, message) in enumerate(rules):
+            events.append(pandas.DataFrame({
+                "pos": df.loc[mask, "pos"],
+                "pd_order": df.loc[mask, "pd_order"],
+                "tr_order": df.loc[mask, "tr_order"] if "tr_order" in df else -1,
+                "rule": rule_order,
+                "check": "primary_diagnoses",
+                "level": level,
+                "message": prefix[mask] + message
+            }))
+
+        # the earliest diagnosis should have a month_interval of 0: only the last date for each diagnosis id counts
+        dated = diagnosis_df[diagnosis_df["diagnosis_kind"].notna()]
+        dated = dated.groupby(["pos", "pd_id"], sort=False, dropna=False).last().reset_index()
+        is_zero = (dated["diagnosis_kind"] == "interval") & (dated["diagnosis"] == 0)
+        no_zero = ~is_zero.groupby(dated["pos"], sort=False).any()
+        first_is_interval = dated.groupby("pos", sort=False)["diagnosis_kind"].first() == "interval"
+        for pos in no_zero.index[no_zero & first_is_interval]:
+            events.append(pandas.DataFrame({
+                "pos": [pos], "pd_order": [numpy.inf], "tr_order": [-1], "rule": [len(rules)],
+                "check": ["primary_diagnoses"], "level": ["warn"],
+                "message": ["Earliest primary_diagnosis.date_of_diagnosis.month_interval should be 0, current "
+                            f"month_intervals: {diagnoses_dates[pos]}"]
+            }))
+
+        # date_of_death checks against date_of_birth and date_alive_after_lost_to_followup
+        has_death = donor_df["has_death"] & donor_df["birth"].notna() & donor_df["death"].notna()
+        donor_rules = [
+            (_is_later(donor_df, "birth", "death"), "date_of_death cannot be earlier than date_of_birth"),
+            (_is_later(donor_df, "alive", "death"), "date_alive_after_lost_to_followup cannot be after date_of death"),
+            (_is_later(donor_df, "birth", "alive"), "date_alive_after_lost_to_followup cannot be before date_of birth"),
+        ]
+        for rule_order, (mask, message) in enumerate(donor_rules):
+            mask = mask & has_death
+            events.append(pandas.DataFrame({
+                "pos": donor_df.loc[mask, "pos"], "pd_order": -1, "tr_order": -1, "rule": rule_order,
+                "check": "date_of_death", "level": "fail", "message": message
+            }))
+
+        results = {}
+        for pos, donor in enumerate(donors):
+            results[start + pos] = {
+                "id": donor.get("submitter_donor_id"),
+                "primary_diagnoses": [],
+                "date_of_death": []
+            }
+        events = [e for e in events if len(e) > 0]
+        if len(events) > 0:
+            all_events = pandas.concat(events).sort_values(["pos", "pd_order", "tr_order", "rule"], kind="stable")
+            for event in all_events.itertuples(index=False):
+                results[start + event.pos][event.check].append((event.level, event.message))
+        return results
 
+    def validate_primary_diagnoses(self, map_json):
         for prop in map_json:
             if prop == "clinical_tumour_staging_system":
                 self.validate_staging_system(map_json, "clinical")
@@ -327,131 +567,58 @@ class MoHSchemaV3(BaseSchema):
         return
 
     def validate_treatments(self, map_json):
-        for prop in map_json:
-            if prop == "treatment_type" and map_json["treatment_type"] is not None:
-                for t_type in map_json["treatment_type"]:
-                    match t_type:
-                        case "Systemic therapy":
-                            if "systemic_therapies" not in map_json or len(map_json["systemic_therapies"]) == 0:
-                                self.warn("Treatment type Systemic therapy should have one or more systemic therapies submitted")
-                        case "Radiation therapy":
-                            if "radiations" not in map_json or len(map_json["radiations"]) == 0:
-                                self.warn("Treatment type Radiation therapy should have one or more radiation submitted")
-                        case "Surgery":
-                            if "surgeries" not in map_json or len(map_json["surgeries"]) == 0:
-                                self.warn("Treatment type Surgery should have one or more surgery submitted")
-            elif prop == "treatment_start_date" and map_json["treatment_start_date"] is not None:
-                if "treatment_end_date" in map_json and map_json["treatment_end_date"] is not None:
-                    if "dict" in str(type(map_json["treatment_start_date"])):
-                        treatment_start = map_json["treatment_start_date"]["month_interval"]
-                        treatment_end = map_json["treatment_end_date"]["month_interval"]
-                    else:
-                        treatment_start = dateparser.parse(map_json["treatment_start_date"]).date()
-                        treatment_end = dateparser.parse(map_json["treatment_end_date"]).date()
-                    if treatment_start > treatment_end:
-                        self.fail("Treatment start cannot be after treatment end.")
-                    
-                    if "systemic_therapies" in map_json and len(map_json["systemic_therapies"]) > 0:
-                        for therapy in map_json["systemic_therapies"]:
-                            if "start_date" in therapy and therapy["start_date"] not in [None, '']:
-                                if "dict" in str(type(therapy["start_date"])):
-                                    therapy_start = therapy["start_date"]['month_interval']
-                                else:
-                                    therapy_start = dateparser.parse(therapy["start_date"]).date()
-                                if therapy_start < treatment_start:
-                                    self.fail(
-                                        "Systemic therapy start date cannot be earlier than its treatment start date.")
-                            if "end_date" in therapy and therapy["end_date"] not in [None, '']:
-                                if "dict" in str(type(therapy["end_date"])):
-                                    therapy_end = therapy["end_date"]["month_interval"]
-                                else:
-                                    therapy_end = dateparser.parse(therapy["treatment_end_date"]).date()
-                                if therapy_end > treatment_end:
-                                    self.fail("Systemic therapy end date cannot be after its treatment end date.")
+        if map_json.get("treatment_start_date") is not None:
+            if "treatment_end_date" in map_json and map_json["treatment_end_date"] is not None:
+                if isinstance(map_json["treatment_start_date"], dict):
+                    treatment_start = map_json["treatment_start_date"]["month_interval"]
+                    treatment_end = map_json["treatment_end_date"]["month_interval"]
+                else:
+                    treatment_start = dateparser.parse(map_json["treatment_start_date"]).date()
+                    treatment_end = dateparser.parse(map_json["treatment_end_date"]).date()
+                if "systemic_therapies" in map_json and len(map_json["systemic_therapies"]) > 0:
+                    for therapy in map_json["systemic_therapies"]:
+                        if "start_date" in therapy and therapy["start_date"] not in [None, '']:
+                            if isinstance(therapy["start_date"], dict):
+                                therapy_start = therapy["start_date"]['month_interval']
+                            else:
+                                therapy_start = dateparser.parse(therapy["start_date"]).date()
+                            if therapy_start < treatment_start:
+                                self.fail(
+                                    "Systemic therapy start date cannot be earlier than its treatment start date.")
+                        if "end_date" in therapy and therapy["end_date"] not in [None, '']:
+                            if isinstance(therapy["end_date"], dict):
+                                therapy_end = therapy["end_date"]["month_interval"]
+                            else:
+                                therapy_end = dateparser.parse(therapy["treatment_end_date"]).date()
+                            if therapy_end > treatment_end:
+                                self.fail("Systemic therapy end date cannot be after its treatment end date.")
 
     def validate_systemic_therapies(self, map_json):
-        if "drug_dose_units" not in map_json or map_json["drug_dose_units"] is None:
-            for x in ["prescribed_cumulative_drug_dose", "actual_cumulative_drug_dose"]:
-                if x in map_json and map_json[x] is not None:
-                    self.warn(f"drug_dose_units required if {x} is submitted")
-        for prop in map_json:
-            if prop == "start_date" and map_json["start_date"] is not None:
-                start = None
-                end = None
-                if "end_date" in map_json and map_json["end_date"] is not None:
-                    if "dict" in str(type(map_json["start_date"])):
-                        if "month_interval" in map_json["start_date"]:
-                            start = map_json["start_date"]["month_interval"]
-                        if "month_interval" in map_json["end_date"]:
-                            end = map_json["end_date"]["month_interval"]
-                    else:
-                        start = dateparser.parse(map_json["start_date"]).date()
-                        end = dateparser.parse(map_json["end_date"]).date()
-                    if start and end and start > end:
-                        self.fail("Systemic therapy start cannot be after systemic therapy end.")
+        # drug_dose_units and the start/end dates are checked by validation_rules
+        return
 
     def validate_radiations(self, map_json):
-        for prop in map_json:
-            if prop == "radiation_boost" and map_json["radiation_boost"] == "Yes":
-                if "reference_radiation_treatment_id" not in map_json or map_json["reference_radiation_treatment_id"] is None:
-                    self.warn("reference_radiation_treatment_id required if radiation_boost = Yes")
+        # reference_radiation_treatment_id is checked by validation_rules
+        return
 
     def validate_surgeries(self, map_json):
         # No validations needed (submitter_specimen_id removed in V3)
         return
 
     def validate_followups(self, map_json):
-        for prop in map_json:
-            if prop == "disease_status_at_followup":
-                states = [
-                    "Distant progression",
-                    "Loco-regional progression",
-                    "Progression not otherwise specified",
-                    "Relapse or recurrence"
-                ]
-                if map_json["disease_status_at_followup"] in states:
-                    required_fields = [
-                        "relapse_type",
-                        "date_of_relapse",
-                        "method_of_progression_status"
-                    ]
-                    for field in required_fields:
-                        if field not in map_json:
-                            self.warn(f"{field} is required if disease_status_at_followup is {map_json['disease_status_at_followup']}")
-                    if "anatomic_site_progression_or_recurrence" not in map_json:
-                        if "relapse_type" in map_json and map_json["relapse_type"] != "Biochemical progression":
-                            self.warn(f"anatomic_site_progression_or_recurrence is required if disease_status_at_followup is {map_json['disease_status_at_followup']}")
+        if map_json.get("disease_status_at_followup") in PROGRESSION_STATES:
+            if "anatomic_site_progression_or_recurrence" not in map_json:
+                if "relapse_type" in map_json and map_json["relapse_type"] != "Biochemical progression":
+                    self.warn(f"anatomic_site_progression_or_recurrence is required if disease_status_at_followup is {map_json['disease_status_at_followup']}")
 
     def validate_biomarkers(self, map_json):
-        for prop in map_json:
-            match prop:
-                case "hpv_pcr_status":
-                    if map_json["hpv_pcr_status"] == "Positive" and "hpv_strain" not in map_json:
-                        self.warn("If hpv_pcr_status is positive, hpv_strain is required")
+        # hpv_strain is checked by validation_rules
+        return
 
     def validate_comorbidities(self, map_json):
-        for prop in map_json:
-            if prop == "laterality_of_prior_malignancy":
-                if "prior_malignancy" not in map_json or map_json["prior_malignancy"] != "Yes":
-                    self.fail("laterality_of_prior_malignancy should not be submitted unless prior_malignancy = Yes")
+        # laterality_of_prior_malignancy is checked by validation_rules
+        return
 
     def validate_exposures(self, map_json):
-        is_smoker = False
-        if "tobacco_smoking_status" not in map_json or map_json["tobacco_smoking_status"] is None:
-            self.warn("tobacco_smoking_status required for exposure")
-        else:
-            if map_json["tobacco_smoking_status"] in [
-                "Current reformed smoker for <= 15 years",
-                "Current reformed smoker for > 15 years",
-                "Current reformed smoker, duration not specified",
-                "Current smoker"
-            ]:
-                is_smoker = True
-
-            for prop in map_json:
-                if prop == "tobacco_type":
-                    if not is_smoker:
-                        self.fail(f"tobacco_type cannot be submitted for tobacco_smoking_status = {map_json['tobacco_smoking_status']}")
-                elif prop == "pack_years_smoked":
-                    if not is_smoker:
-                        self.fail(f"pack_years_smoked cannot be submitted for tobacco_smoking_status = {map_json['tobacco_smoking_status']}")
+        # tobacco_smoking_status, tobacco_type and pack_years_smoked are checked by validation_rules
+        return
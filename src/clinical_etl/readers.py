@@ -0,0 +1,114 @@
+"""
+Reading the sheets of a directory of inputs. Each file is a sheet, named after the file without its suffix: csvs,
+csvs compressed with gzip (.csv.gz) or zstd (.csv.zst, if zstandard is installed), and Parquet (.parquet) or Arrow
+IPC (.arrow, .feather) files if pyarrow is installed. Every sheet is read as strings, with missing values as NaN, the
+way pandas.read_csv(dtype=str) reads a csv, so that they're all indexed in the same way.
+"""
+
+import importlib.util
+import os
+import sys
+
+from clinical_etl import serializer
+from clinical_etl.lazy import lazy_import
+
+pandas = lazy_import("pandas")
+# imported by _require_pyarrow, when an arrow or parquet file is first read
+pyarrow = None
+
+
+SHEET_SUFFIXES = (".csv", ".csv.gz", ".csv.zst", ".parquet", ".arrow", ".feather")
+ARROW_SUFFIXES = (".parquet", ".arrow", ".feather")
+
+
+def sheet_name(file):
+    """Return the name of the sheet in file, a file in a directory of inputs, or None if it isn't a sheet."""
+    for suffix in SHEET_SUFFIXES:
+        if file.endswith(suffix) and len(file) > len(suffix):
+            return file[:-len(suffix)]
+    return None
+
+
+def list_sheets(input_dir):
+    """Return (sheet name, path) for each sheet in input_dir. Two files can't be the same sheet."""
+    sheets = {}
+    for file in os.listdir(input_dir):
+        sheet = sheet_name(file)
+        if sheet is not None:
+            if sheet in sheets:
+                sys.exit(f"{os.path.basename(sheets[sheet])} and {file} in {input_dir} are both the sheet {sheet}: "
+                         f"remove one of them.")
+            sheets[sheet] = os.path.join(input_dir, file)
+    return list(sheets.items())
+
+
+def _require_pyarrow(path):
+    global pyarrow
+    if pyarrow is not None:
+        return
+    if importlib.util.find_spec("pyarrow") is None:
+        sys.exit(f"Reading {path} needs the pyarrow package: install it with `pip install pyarrow`.")
+    import pyarrow
+    import pyarrow.compute
+    import pyarrow.ipc
+    import pyarrow.parquet
+
+
+def _to_dataframe(table):
+    """Convert an arrow table to a dataframe of strings, with missing values as NaN."""
+    table = pyarrow.table([pyarrow.compute.cast(column, pyarrow.string()) for column in table.columns],
+                          names=table.column_names)
+    df = table.to_pandas().astype(object)
+    return df.where(df.notna(), float("nan"))
+
+
+def _arrow_columns(names, usecols):
+    if usecols is None:
+        return names
+    return [name for name in names if usecols(name)]
+
+
+def _open_ipc(path):
+    # the file is memory-mapped, so its batches are read from the page cache without being copied
+    return pyarrow.ipc.open_file(pyarrow.memory_map(path, "r"))
+
+
+def read_sheet(path, usecols=None):
+    """Read the whole sheet at path into a dataframe. usecols is a function of a column name, as pandas.read_csv
+    takes it, that's True for the columns to read, or None to read all of them."""
+    if path.endswith(ARROW_SUFFIXES):
+        _require_pyarrow(path)
+        if path.endswith(".parquet"):
+            names = pyarrow.parquet.ParquetFile(path).schema_arrow.names
+            table = pyarrow.parquet.read_table(path, columns=_arrow_columns(names, usecols), memory_map=True)
+        else:
+            reader = _open_ipc(path)
+            table = reader.read_all().select(_arrow_columns(reader.schema.names, usecols))
+        return _to_dataframe(table)
+    with serializer.open_input(path) as f:
+        return pandas.read_csv(f, dtype=str, usecols=usecols)
+
+
+def read_sheet_chunks(path, chunk_size, usecols=None):
+    """Yield the sheet at path a chunk of about chunk_size rows at a time, decompressing it as it's read. The first
+    chunk has no rows, so that the columns are known even if the sheet is empty."""
+    if path.endswith(ARROW_SUFFIXES):
+        _require_pyarrow(path)
+        if path.endswith(".parquet"):
+            parquet_file = pyarrow.parquet.ParquetFile(path, memory_map=True)
+            columns = _arrow_columns(parquet_file.schema_arrow.names, usecols)
+            yield _to_dataframe(parquet_file.schema_arrow.empty_table().select(columns))
+            for batch in parquet_file.iter_batches(batch_size=chunk_size, columns=columns):
+                yield _to_dataframe(pyarrow.Table.from_batches([batch]))
+        else:
+            reader = _open_ipc(path)
+            columns = _arrow_columns(reader.schema.names, usecols)
+            yield _to_dataframe(reader.schema.empty_table().select(columns))
+            # the batches are the ones the file was written with
+            for i in range(reader.num_record_batches):
+                yield _to_dataframe(pyarrow.Table.from_batches([reader.get_batch(i)]).select(columns))
+        return
+    with serializer.open_input(path) as f:
+        yield pandas.read_csv(f, dtype=str, nrows=0, usecols=usecols)
+    with serializer.open_input(path) as f:
+        yield from pandas.read_csv(f, dtype=str, usecols=usecols, chunksize=chunk_size)
@@ -1,13 +1,21 @@
 # mappings and validation based on the mohccn schema
 
-import requests
-import yaml
 import json
 import re
+import sys
+from array import array
 from copy import deepcopy
-import jsonschema
+from hashlib import blake2b
 from collections import Counter
-import openapi_spec_validator as osv
+from clinical_etl.lazy import lazy_import
+
+# imported when they're first used, since they take a while to import
+dateparser = lazy_import("dateparser")
+jsonschema = lazy_import("jsonschema")
+numpy = lazy_import("numpy")
+osv = lazy_import("openapi_spec_validator")
+requests = lazy_import("requests")
+yaml = lazy_import("yaml")
 
 
 class ValidationError(Exception):
@@ -17,6 +25,254 @@ class ValidationError(Exception):
     def __str__(self):
         return repr(f"Validation error: {self.value}")
 
+
+class ValidationStats:
+    """
+    Counts of the required fields that are missing in each schema, and of the cases (root objects) with missing
+    data. Stats for different sets of cases, e.g. validated in parallel, can be combined with merge().
+    """
+    def __init__(self, schema_names=()):
+        self.schema_names = list(schema_names)
+        self.total_cases = 0
+        self.required_totals = {}       # {schema_name: Counter({field: count})}
+        self.required_missing = {}      # {schema_name: Counter({field: count})}
+        self.schemas_used = {}          # dicts are used as ordered sets
+        self.cases_missing_data = {}
+
+    def add_object(self, schema_name, required_fields, missing_fields, case):
+        """Count an object of schema_name, which is missing missing_fields out of its required_fields."""
+        if schema_name not in self.schemas_used:
+            self.schemas_used[schema_name] = None
+            self.required_totals[schema_name] = Counter()
+            self.required_missing[schema_name] = Counter()
+        self.required_totals[schema_name].update(required_fields)
+        if len(missing_fields) > 0:
+            self.required_missing[schema_name].update(missing_fields)
+            self.cases_missing_data[case] = None
+
+    def merge(self, other):
+        """Add the counts from another ValidationStats to this one."""
+        for schema_name in other.schema_names:
+            if schema_name not in self.schema_names:
+                self.schema_names.append(schema_name)
+        self.total_cases += other.total_cases
+        for schema_name in other.schemas_used:
+            if schema_name not in self.schemas_used:
+                self.schemas_used[schema_name] = None
+                self.required_totals[schema_name] = Counter()
+                self.required_missing[schema_name] = Counter()
+            self.required_totals[schema_name].update(other.required_totals[schema_name])
+            self.required_missing[schema_name].update(other.required_missing[schema_name])
+        self.cases_missing_data.update(other.cases_missing_data)
+        return self
+
+    def to_state(self):
+        """Return the counts as a dict that can be saved as JSON, and read back with from_state()."""
+        return {
+            "total_cases": self.total_cases,
+            "required_totals": {name: dict(counts) for name, counts in self.required_totals.items()},
+            "required_missing": {name: dict(counts) for name, counts in self.required_missing.items()},
+            "schemas_used": list(self.schemas_used),
+            "cases_missing_data": list(self.cases_missing_data)
+        }
+
+    @classmethod
+    def from_state(cls, state, schema_names=()):
+        """Read counts saved by to_state()."""
+        stats = cls(schema_names)
+        stats.total_cases = state["total_cases"]
+        stats.required_totals = {name: Counter(counts) for name, counts in state["required_totals"].items()}
+        stats.required_missing = {name: Counter(counts) for name, counts in state["required_missing"].items()}
+        stats.schemas_used = dict.fromkeys(state["schemas_used"])
+        stats.cases_missing_data = dict.fromkeys(state["cases_missing_data"])
+        return stats
+
+    def to_json(self):
+        """Return the stats in the format of BaseSchema.statistics."""
+        required_but_missing = {}
+        for schema_name, totals in self.required_totals.items():
+            required_but_missing[schema_name] = {}
+            for field, total in totals.items():
+                required_but_missing[schema_name][field] = {
+                    "total": total,
+                    "missing": self.required_missing[schema_name][field]
+                }
+        return {
+            "required_but_missing": required_but_missing,
+            "schemas_used": list(self.schemas_used),
+            "cases_missing_data": list(self.cases_missing_data),
+            "schemas_not_used": [x for x in self.schema_names if x not in self.schemas_used],
+            "summary_cases": {
+                "complete_cases": self.total_cases - len(self.cases_missing_data),
+                "total_cases": self.total_cases
+            }
+        }
+
+
+class IdentifierRegistry:
+    """
+    The ids of the objects in each schema, and the case (root object) that each one is in, for finding duplicated
+    ids. Each id is kept as a 64-bit hash, an index into the list of cases and its bytes in an arena, so a registry of
+    millions of ids is a few flat arrays rather than millions of python objects. Hashes that are equal are checked
+    against the bytes of the ids, so a hash collision is never reported as a duplicate.
+
+    Registries from different workers or runs can be combined with merge(), and saved to and loaded from a file with
+    dump() and load().
+    """
+    def __init__(self):
+        self.cases = []
+        self.schemas = {}               # {schema_name: {"hashes": array, "cases": array, "offsets": array, "arena": bytearray}}
+
+    def _columns(self, schema_name):
+        if schema_name not in self.schemas:
+            self.schemas[schema_name] = {
+                "hashes": array("Q"),
+                "cases": array("Q"),
+                "offsets": array("Q"),
+                "arena": bytearray()
+            }
+        return self.schemas[schema_name]
+
+    def add(self, schema_name, id, case):
+        """Register an id of schema_name in case. Cases are expected to be added one after another."""
+        if len(self.cases) == 0 or self.cases[-1] != case:
+            self.cases.append(case)
+        columns = self._columns(schema_name)
+        id_bytes = str(id).encode()
+        columns["hashes"].append(int.from_bytes(blake2b(id_bytes, digest_size=8).digest(), "little"))
+        columns["cases"].append(len(self.cases) - 1)
+        columns["offsets"].append(len(columns["arena"]))
+        columns["arena"].extend(id_bytes)
+
+    def ids(self, schema_name):
+        """Yield the ids (as strings) registered for schema_name, in the order they were added."""
+        columns = self.schemas[schema_name]
+        offsets = columns["offsets"]
+        for i in range(len(offsets)):
+            end = offsets[i + 1] if i + 1 < len(offsets) else len(columns["arena"])
+            yield columns["arena"][offsets[i]:end].decode()
+
+    def counts(self):
+        """Return {schema_name: Counter({id: count})} for all of the registered ids."""
+        return {schema_name: Counter(self.ids(schema_name)) for schema_name in self.schemas}
+
+    def duplicates(self):
+        """
+        Yield (schema_name, id, count, cases) for each id that was registered more than once in a schema, with the
+        cases it's in. Within a schema, the most common ids come first, then the ids that were registered first.
+        """
+        for schema_name, columns in self.schemas.items():
+            hashes = numpy.frombuffer(columns["hashes"], dtype=numpy.uint64)
+            if len(hashes) == 0:
+                continue
+            order = numpy.argsort(hashes, kind="stable")
+            sorted_hashes = hashes[order]
+            repeated = sorted_hashes[1:] == sorted_hashes[:-1]
+            if not repeated.any():
+                continue
+            offsets = columns["offsets"]
+            arena = columns["arena"]
+            found = []
+            # each run of equal hashes is a candidate group: compare the ids themselves in case of collisions
+            run_starts = numpy.flatnonzero(numpy.diff(numpy.concatenate(([False], repeated, [False])).astype(numpy.int8)))
+            for run_start, run_end in zip(run_starts[::2], run_starts[1::2] + 1):
+                groups = {}
+                for i in order[run_start:run_end]:
+                    end = offsets[i + 1] if i + 1 < len(offsets) else len(arena)
+                    groups.setdefault(bytes(arena[offsets[i]:end]), []).append(int(i))
+                for id_bytes, positions in groups.items():
+                    if len(positions) > 1:
+                        cases = list(dict.fromkeys(self.cases[columns["cases"][i]] for i in positions))
+                        found.append((-len(positions), positions[0], id_bytes.decode(), cases))
+            for count, _, id, cases in sorted(found):
+                yield schema_name, id, -count, cases
+
+    def merge(self, other):
+        """Add the ids from another registry to this one."""
+        case_offset = len(self.cases)
+        self.cases.extend(other.cases)
+        for schema_name, other_columns in other.schemas.items():
+            columns = self._columns(schema_name)
+            arena_offset = len(columns["arena"])
+            columns["hashes"].extend(other_columns["hashes"])
+            columns["cases"].extend(array("Q", (i + case_offset for i in other_columns["cases"])))
+            columns["offsets"].extend(array("Q", (i + arena_offset for i in other_columns["offsets"])))
+            columns["arena"].extend(other_columns["arena"])
+        return self
+
+    def reorder(self, cases):
+        """
+        Return a registry of the same ids as if the cases had been added in the order of cases: the ids of each case
+        keep their order, and cases that aren't in cases come after the rest. Registries of parts of a mapping that
+        were merged in a different order than the mapping's can then report duplicates in the same order it would.
+        """
+        registry = IdentifierRegistry()
+        registry.cases = list(dict.fromkeys(list(cases) + self.cases))
+        rank = {case: i for i, case in enumerate(registry.cases)}
+        for schema_name, columns in self.schemas.items():
+            reordered = registry._columns(schema_name)
+            offsets = columns["offsets"]
+            arena = columns["arena"]
+            case_ranks = [rank[self.cases[i]] for i in columns["cases"]]
+            # sorting is stable, so the ids of each case keep their order
+            for i in sorted(range(len(case_ranks)), key=case_ranks.__getitem__):
+                end = offsets[i + 1] if i + 1 < len(offsets) else len(arena)
+                reordered["hashes"].append(columns["hashes"][i])
+                reordered["cases"].append(case_ranks[i])
+                reordered["offsets"].append(len(reordered["arena"]))
+                reordered["arena"].extend(arena[offsets[i]:end])
+        return registry
+
+    def dump(self, path):
+        """Write the registry to a file: a line of JSON describing it, then the contents of each of its arrays."""
+        header = {
+            "byteorder": sys.byteorder,
+            "cases": self.cases,
+            "schemas": {name: {"ids": len(c["hashes"]), "arena": len(c["arena"])} for name, c in self.schemas.items()}
+        }
+        with open(path, "wb") as f:
+            f.write(json.dumps(header).encode() + b"\n")
+            for columns in self.schemas.values():
+                for key in ["hashes", "cases", "offsets"]:
+                    columns[key].tofile(f)
+                f.write(columns["arena"])
+
+    @classmethod
+    def load(cls, path):
+        """Read a registry written by dump()."""
+        registry = cls()
+        with open(path, "rb") as f:
+            header = json.loads(f.readline())
+            registry.cases = header["cases"]
+            for schema_name, sizes in header["schemas"].items():
+                columns = registry._columns(schema_name)
+                for key in ["hashes", "cases", "offsets"]:
+                    columns[key].fromfile(f, sizes["ids"])
+                    if header["byteorder"] != sys.byteorder:
+                        columns[key].byteswap()
+                columns["arena"] = bytearray(f.read(sizes["arena"]))
+        return registry
+
+
+def parse_date_value(value, parsed_dates):
+    """Return the kind ("interval" or "date"), a comparable number and the raw value of a date field.
+
+    Month intervals are only comparable with other month intervals, and dates with other dates. Missing or
+    unparseable dates have a kind of None. Date strings are parsed once and cached in parsed_dates.
+    """
+    if value is None or value == '':
+        return None, float("nan"), None
+    if isinstance(value, dict):
+        if value.get("month_interval") is None:
+            return None, float("nan"), None
+        return "interval", value["month_interval"], value["month_interval"]
+    if value not in parsed_dates:
+        parsed = dateparser.parse(value)
+        parsed_dates[value] = None if parsed is None else parsed.date()
+    if parsed_dates[value] is None:
+        return None, float("nan"), None
+    return "date", parsed_dates[value].toordinal(), parsed_dates[value]
+
 """
 Convenience methods for validating openapi as jsonschema
 """
@@ -70,12 +326,51 @@ class BaseSchema:
         }
     }
 
+    # conditional checks between fields, compiled into checkers when the schema is created. Each rule is only checked
+    # for objects that contain its trigger field: the "if" field for required_if, the first of the "fields" for
+    # forbidden_if and date_order, and every object for one_of_required.
+    validation_rules = {
+        "examples": [
+            {
+                "rule": "required_if",          # each of "fields" is required if the "if" field is present and...
+                "fields": ["attribute_2"],
+                "if": "attribute_1",
+                "in": ["Yes"],                  # ...its value is in "in", not in "not_in", has the truthiness
+                                                # of "truthy", or otherwise is not None
+                "level": "warn",                # "warn" or "fail"
+                "message": "{field} required if {if} = {value}"
+            },
+            {
+                "rule": "forbidden_if",         # each of "fields" that is present fails the same kind of condition
+                "fields": ["attribute_3"],
+                "if": "attribute_1",
+                "not_in": ["Yes"],
+                "presence": "key",              # a field counts as present if its key is there, even if it's None;
+                "level": "fail",                # by default it has to be there and not None, and "nonempty"
+                                                # also excludes empty lists
+                "message": "{field} should only be submitted if {if} = Yes"
+            },
+            {
+                "rule": "one_of_required",      # at least one of "fields" is present
+                "fields": ["attribute_2", "attribute_3"],
+                "level": "warn",
+                "message": "Either attribute_2 or attribute_3 is required"
+            },
+            {
+                "rule": "date_order",           # the first of "fields" can't be after the second
+                "fields": ["start_date", "end_date"],
+                "level": "fail",
+                "message": "Start cannot be after end."
+            }
+        ]
+    }
+
 
     def __init__(self, url, simple=False):
         self.validation_warnings = []
         self.validation_errors = []
-        self.statistics = {}
-        self.identifiers = {}
+        self.validation_stats = ValidationStats(self.validation_schema.keys())
+        self.identifier_registry = IdentifierRegistry()
         self.stack_location = []
         self.schema = {}
         self.openapi_url = url
@@ -83,6 +378,10 @@ class BaseSchema:
         self.template = None
         self.katsu_sha = None
         self.scaffold = None
+        self.parsed_dates = {}
+        self.validators = {}
+        self.rule_checkers = self.compile_validation_rules()
+        self.prune_plan = None
 
         """Retrieve the schema from the supplied URL, return as dictionary."""
         try:
@@ -114,6 +413,8 @@ class BaseSchema:
         # add default mapping functions:
         self.template = self.add_default_mappings(raw_template)
 
+        self.prune_plan = self.compile_prune_plan()
+
 
     def warn(self, message):
         prefix = " > ".join(self.stack_location)
@@ -135,6 +436,119 @@ class BaseSchema:
         self.validation_errors.append(f"{message}")
 
 
+    def compile_validation_rules(self):
+        """Compile validation_rules into {schema_name: {trigger_field: [checker, ...]}}, where each checker takes the
+        object being validated. Rules without a trigger field are listed under None."""
+        rule_checkers = {}
+        for schema_name, rules in self.validation_rules.items():
+            rule_checkers[schema_name] = {}
+            for rule in rules:
+                match rule["rule"]:
+                    case "required_if":
+                        trigger = rule["if"]
+                        checker = self.required_if_checker(rule)
+                    case "forbidden_if":
+                        trigger = rule["fields"][0]
+                        checker = self.forbidden_if_checker(rule)
+                    case "one_of_required":
+                        trigger = None
+                        checker = self.one_of_required_checker(rule)
+                    case "date_order":
+                        trigger = rule["fields"][0]
+                        checker = self.date_order_checker(rule)
+                    case _:
+                        raise ValidationError(f"Unknown validation rule {rule['rule']} for {schema_name}")
+                if trigger not in rule_checkers[schema_name]:
+                    rule_checkers[schema_name][trigger] = []
+                rule_checkers[schema_name][trigger].append(checker)
+        return rule_checkers
+
+
+    @staticmethod
+    def rule_condition(rule):
+        """Return a function that tests whether the value of a rule's "if" field meets its condition. If the value is
+        a list, the condition is tested against each of its items."""
+        if "in" in rule:
+            values = rule["in"]
+            def matches(value):
+                if isinstance(value, list):
+                    return any(v in values for v in value)
+                return value in values
+        elif "truthy" in rule:
+            truthy = rule["truthy"]
+            def matches(value):
+                return bool(value) == truthy
+        elif "not_in" in rule:
+            values = rule["not_in"]
+            def matches(value):
+                if isinstance(value, list):
+                    return not any(v in values for v in value)
+                return value not in values
+        else:
+            def matches(value):
+                return value is not None
+        return matches
+
+
+    @staticmethod
+    def rule_presence(rule):
+        """Return a function that tests whether a field is present in an object, according to the rule's presence."""
+        match rule.get("presence"):
+            case "key":
+                return lambda map_json, field: field in map_json
+            case "nonempty":
+                return lambda map_json, field: field in map_json and map_json[field] is not None and len(map_json[field]) > 0
+        return lambda map_json, field: field in map_json and map_json[field] is not None
+
+
+    def required_if_checker(self, rule):
+        matches = self.rule_condition(rule)
+        is_present = self.rule_presence(rule)
+        report = getattr(self, rule["level"])
+        def check(map_json):
+            value = map_json.get(rule["if"])
+            if matches(value):
+                for field in rule["fields"]:
+                    if not is_present(map_json, field):
+                        report(rule["message"].format_map({"field": field, "if": rule["if"], "value": value}))
+        return check
+
+
+    def forbidden_if_checker(self, rule):
+        matches = self.rule_condition(rule)
+        is_present = self.rule_presence(rule)
+        report = getattr(self, rule["level"])
+        def check(map_json):
+            value = map_json.get(rule["if"])
+            if matches(value):
+                for field in rule["fields"]:
+                    if is_present(map_json, field):
+                        report(rule["message"].format_map({"field": field, "if": rule["if"], "value": value}))
+        return check
+
+
+    def one_of_required_checker(self, rule):
+        is_present = self.rule_presence(rule)
+        report = getattr(self, rule["level"])
+        def check(map_json):
+            for field in rule["fields"]:
+                if is_present(map_json, field):
+                    return
+            report(rule["message"].format_map({"fields": ", ".join(rule["fields"])}))
+        return check
+
+
+    def date_order_checker(self, rule):
+        first, second = rule["fields"]
+        report = getattr(self, rule["level"])
+        def check(map_json):
+            first_kind, first_date, _ = parse_date_value(map_json.get(first), self.parsed_dates)
+            second_kind, second_date, _ = parse_date_value(map_json.get(second), self.parsed_dates)
+            if first_kind is not None and first_kind == second_kind and first_date > second_date:
+                report(rule["message"].format_map({"field": first, "fields": ", ".join(rule["fields"])}))
+        return check
+
+
     def expand_ref(self, ref, validation_schema_node):
         if "$ref" in ref:
             refName = ref["$ref"].replace("#/components/schemas/", "")
@@ -177,30 +591,38 @@ class BaseSchema:
         """Create a template for the schema, for use with the --template flag."""
         if node_names is None:
             node_names = []
-        if "str" in str(type(node)):
-            node_names.append(f"{node_name},")
-            return "string", node_names
-        elif "list" in str(type(node)):
-            new_node_name = ".".join((node_name, "INDEX"))
-            sc, nn = self.generate_mapping_template(node[0], new_node_name, node_names)
-            return [sc], nn
-        elif "number" in str(type(node)) or "integer" in str(type(node)):
-            return 0, node_names
-        elif "boolean" in str(type(node)):
-            return True, node_names
-        elif "dict" in str(type(node)):
-            scaffold = {}
-            node_names.append(f"{node_name},")
-            for prop in node.keys():
-                if node_name == "":
-                    new_node_name = prop
-                else:
-                    new_node_name = ".".join((node_name, prop))
-                scaffold[prop], node_names = self.generate_mapping_template(node[prop], new_node_name, node_names)
-            return scaffold, node_names
-        else:
-            return str(type(node)), node_names
-        return None, node_names
+        root = [None]
+        # walk the scaffold depth-first: each entry is a node, its name, and the container/key its result goes into
+        to_visit = [(node, node_name, root, 0)]
+        while len(to_visit) > 0:
+            curr_node, curr_name, container, key = to_visit.pop()
+            if isinstance(curr_node, str):
+                node_names.append(f"{curr_name},")
+                container[key] = "string"
+            elif isinstance(curr_node, list):
+                container[key] = [None]
+                to_visit.append((curr_node[0], ".".join((curr_name, "INDEX")), container[key], 0))
+            elif isinstance(curr_node, bool):
+                container[key] = True
+            elif isinstance(curr_node, (int, float)):
+                container[key] = 0
+            elif isinstance(curr_node, dict):
+                scaffold = {}
+                container[key] = scaffold
+                node_names.append(f"{curr_name},")
+                children = []
+                for prop in curr_node.keys():
+                    if curr_name == "":
+                        new_node_name = prop
+                    else:
+                        new_node_name = ".".join((curr_name, prop))
+                    scaffold[prop] = None
+                    children.append((curr_node[prop], new_node_name, scaffold, prop))
+                # push in reverse so that the props are visited in order
+                to_visit.extend(reversed(children))
+            else:
+                container[key] = str(type(curr_node))
+        return root[0], node_names
 
 
     def add_default_mappings(self, template):
@@ -320,30 +742,132 @@ class BaseSchema:
                 result.append(x)
         return result
 
+
+    def compile_prune_plan(self):
+        """Compile json_schema into the plan that prune follows. Each object schema becomes a (keep, nested) pair:
+        keep is the set of fields that are required, by the json_schema or the validation_schema, and nested maps the
+        fields that are objects, or arrays of objects, to (plan, is_array)."""
+        defs = self.json_schema.get("$defs", {})
+        plans = {}
+
+        def resolve(schema_obj):
+            # the value of a field is described by the first schema of an allOf, oneOf or anyOf, as in the scaffold
+            while True:
+                if "$ref" in schema_obj:
+                    schema_obj = defs[schema_obj["$ref"].replace("#/$defs/", "")]
+                elif "allOf" in schema_obj:
+                    schema_obj = schema_obj["allOf"][0]
+                elif "oneOf" in schema_obj:
+                    schema_obj = schema_obj["oneOf"][0]
+                elif "anyOf" in schema_obj:
+                    schema_obj = schema_obj["anyOf"][0]
+                else:
+                    return schema_obj
+
+        def compile_object(schema_obj, validation_schema_node):
+            key = (id(schema_obj), validation_schema_node)
+            if key not in plans:
+                keep = set(schema_obj.get("required", []))
+                if validation_schema_node in self.validation_schema:
+                    keep.update(self.validation_schema[validation_schema_node]["required_fields"])
+                nested = {}
+                plans[key] = (keep, nested)
+                for prop, prop_obj in schema_obj.get("properties", {}).items():
+                    prop_obj = resolve(prop_obj)
+                    is_array = prop_obj.get("type") == "array"
+                    if is_array:
+                        prop_obj = resolve(prop_obj.get("items", {}))
+                    if prop_obj.get("type") == "object":
+                        nested[prop] = (compile_object(prop_obj, prop), is_array)
+            return plans[key]
+
+        return compile_object(resolve(self.json_schema), list(self.validation_schema.keys())[0])
+
+
+    def prune(self, map_json):
+        """Remove the fields that are None, or empty arrays of objects, from map_json and the objects nested in it,
+        unless they're required. map_json is pruned in place and returned."""
+        if self.prune_plan is None:
+            return map_json
+        to_visit = [(map_json, self.prune_plan)]
+        while len(to_visit) > 0:
+            obj, (keep, nested) = to_visit.pop()
+            empty = []
+            for field, value in obj.items():
+                if value is None or (value == [] and field in nested):
+                    if field not in keep:
+                        empty.append(field)
+                elif field in nested:
+                    plan, is_array = nested[field]
+                    if not is_array:
+                        value = [value]
+                    for item in value:
+                        if isinstance(item, dict):
+                            to_visit.append((item, plan))
+            for field in empty:
+                obj.pop(field)
+        return map_json
+
+
     def validate_ingest_map(self, map_json):
-        self.statistics["required_but_missing"] = {}
-        self.statistics["schemas_used"] = []
-        self.statistics["cases_missing_data"] = []
+        self.validation_stats = ValidationStats(self.validation_schema.keys())
+        root_schema = list(self.validation_schema.keys())[0]
+        self.validate_cases(map_json[root_schema])
+        self.check_duplicate_ids()
+
 
+    def validate_cases(self, cases, start=0):
+        """Validate a list of root objects, where the first one is at position start in the whole mapping. The
+        errors, warnings, statistics and identifier_registry are added to the ones already collected."""
         for key in self.validation_schema.keys():
             self.validation_schema[key]["extra_args"] = {
                 "index": 0
             }
         root_schema = list(self.validation_schema.keys())[0]
-        for x in range(0, len(map_json[root_schema])):
-            self.validate_jsonschema(map_json[root_schema][x], x)
-            self.validate_schema(root_schema, map_json[root_schema][x])
-        for schema in self.identifiers:
-            most_common = self.identifiers[schema].most_common()
-            if most_common[0][1] > 1:
-                for x in most_common:
-                    if x[1] > 1:
-                        self.fail(f"Duplicated IDs: in schema {schema}, {x[0]} occurs {x[1]} times")
-        self.statistics["schemas_not_used"] = list(set(self.validation_schema.keys()) - set(self.statistics["schemas_used"]))
-        self.statistics["summary_cases"] = {
-            "complete_cases": len(map_json[root_schema]) - len(self.statistics["cases_missing_data"]),
-            "total_cases": len(map_json[root_schema])
-        }
+        self.prepare_validation(cases, start)
+        for x in range(0, len(cases)):
+            self.validate_jsonschema(cases[x], start + x)
+            self.validate_schema(root_schema, cases[x], start + x)
+        self.validation_stats.total_cases += len(cases)
+
+
+    def validate_each_case(self, cases, start=0):
+        """Validate a list of root objects as validate_cases does, but instead of adding each one's errors, warnings
+        and statistics to the ones already collected, return them for each root object in turn, with the cases that
+        its ids were added to identifier_registry under."""
+        collected = (self.validation_errors, self.validation_warnings, self.validation_stats)
+        for key in self.validation_schema.keys():
+            self.validation_schema[key]["extra_args"] = {
+                "index": 0
+            }
+        root_schema = list(self.validation_schema.keys())[0]
+        self.prepare_validation(cases, start)
+        results = []
+        try:
+            for x in range(0, len(cases)):
+                self.validation_errors = []
+                self.validation_warnings = []
+                self.validation_stats = ValidationStats()
+                registered = len(self.identifier_registry.cases)
+                self.validate_jsonschema(cases[x], start + x)
+                self.validate_schema(root_schema, cases[x], start + x)
+                self.validation_stats.total_cases = 1
+                results.append((self.validation_errors, self.validation_warnings, self.validation_stats,
+                                self.identifier_registry.cases[registered:]))
+        finally:
+            self.validation_errors, self.validation_warnings, self.validation_stats = collected
+        return results
+
+
+    def check_duplicate_ids(self):
+        for schema, id, count, cases in self.identifier_registry.duplicates():
+            self.fail(f"Duplicated IDs: in schema {schema}, {id} occurs {count} times, in {', '.join(cases)}")
+
+
+    def prepare_validation(self, root_objects, start=0):
+        """Called with the root objects passed to validate_cases before any of them are validated, so that subclasses
+        can precompute checks that are cheaper to do across all objects at once."""
+        return
 
 
     def validate_jsonschema(self, map_json, index):
@@ -361,10 +885,10 @@ class BaseSchema:
                     curr_map = map_json
                     while len(error.path) > 1:
                         node = error.path.popleft()
-                        if "str" in str(type(node)):
+                        if isinstance(node, str):
                             curr_map = curr_map[node]
                             idx = error.path.popleft()
-                            if "str" in str(type(idx)):
+                            if isinstance(idx, str):
                                 error.path.appendleft(idx)
                                 continue
                             # is there an id for this?
@@ -384,50 +908,77 @@ class BaseSchema:
                 self.fail(message)
 
 
-    def validate_schema(self, schema_name, map_json):
+    def validate_schema(self, schema_name, map_json, index=None):
+        # walk the nested schemas depth-first: each entry is a (schema_name, object, index) to validate,
+        # or None to mark that we're done with an object's nested schemas and can leave it.
+        to_visit = [(schema_name, map_json, index)]
+        while len(to_visit) > 0:
+            entry = to_visit.pop()
+            if entry is None:
+                self.stack_location.pop()
+                continue
+            schema_name, map_json, index = entry
+            if index is not None:
+                self.validation_schema[schema_name]["extra_args"]["index"] = index
+            self.validate_schema_object(schema_name, map_json)
+
+            to_visit.append(None)
+            nested = []
+            for ns in self.validation_schema[schema_name]["nested_schemas"]:
+                if ns in map_json:
+                    if isinstance(map_json[ns], list):
+                        for x in range(0, len(map_json[ns])):
+                            nested.append((ns, map_json[ns][x], x))
+                    else:
+                        nested.append((ns, map_json[ns], 0))
+            # push in reverse so that nested objects are validated in order
+            to_visit.extend(reversed(nested))
+
+
+    @property
+    def identifiers(self):
+        """The number of times each id occurs in each schema, as {schema_name: Counter({id: count})}."""
+        return self.identifier_registry.counts()
+
+
+    @property
+    def statistics(self):
+        """The validation_stats of the last validate_ingest_map, as a dict."""
+        return self.validation_stats.to_json()
+
+
+    def get_validator(self, schema_name):
+        """Return the validate_{schema_name} method, which is only looked up the first time it's needed."""
+        if schema_name not in self.validators:
+            self.validators[schema_name] = getattr(self, f"validate_{schema_name}")
+        return self.validators[schema_name]
+
+
+    def validate_schema_object(self, schema_name, map_json):
+        """Validate a single object against its schema, leaving its id on top of the stack_location."""
         id = f"{self.validation_schema[schema_name]['name']} {self.validation_schema[schema_name]['extra_args']['index']}"
-        if self.validation_schema[schema_name]["id"] is not None and self.validation_schema[schema_name]["id"] in map_json:
+        has_id = self.validation_schema[schema_name]["id"] is not None and self.validation_schema[schema_name]["id"] in map_json
+        if has_id:
             id = map_json[self.validation_schema[schema_name]["id"]]
-            if schema_name not in self.identifiers:
-                self.identifiers[schema_name] = Counter()
-            self.identifiers[schema_name].update([id])
         required_fields = self.validation_schema[schema_name]["required_fields"]
-        nested_schemas = self.validation_schema[schema_name]["nested_schemas"]
         self.stack_location.append(str(id))
         case = self.stack_location[0]
+        if has_id:
+            self.identifier_registry.add(schema_name, id, case)
 
         # print(f"Validating schema {schema_name} for {self.stack_location[-1]}")
-        if schema_name not in self.statistics["required_but_missing"]:
-            self.statistics["required_but_missing"][schema_name] = {}
-        if schema_name not in self.statistics["schemas_used"]:
-            self.statistics["schemas_used"].append(schema_name)
-
         remove_these = []
         for f in required_fields:
-            if f not in self.statistics["required_but_missing"][schema_name]:
-                self.statistics["required_but_missing"][schema_name][f] = {
-                    "total": 0,
-                    "missing": 0
-                }
-            self.statistics["required_but_missing"][schema_name][f]["total"] += 1
             if f not in map_json or map_json[f] == "Not available":
                 # self.warn(f"{f} required for {schema_name}")
-                self.statistics["required_but_missing"][schema_name][f]["missing"] += 1
-                if case not in self.statistics["cases_missing_data"]:
-                    self.statistics["cases_missing_data"].append(case)
                 map_json[f] = None
                 remove_these.append(f)
+        self.validation_stats.add_object(schema_name, required_fields, remove_these, case)
 
-        eval(f"self.validate_{schema_name}({map_json})")
+        for trigger, checkers in self.rule_checkers.get(schema_name, {}).items():
+            if trigger is None or trigger in map_json:
+                for check in checkers:
+                    check(map_json)
+        self.get_validator(schema_name)(map_json)
         for f in remove_these:
             map_json.pop(f)
-
-        for ns in nested_schemas:
-            if ns in map_json:
-                for x in range(0, len(map_json[ns])):
-                    self.validation_schema[ns]["extra_args"]["index"] = x
-                    if "list" in str(type(map_json[ns])):
-                        self.validate_schema(ns, map_json[ns][x])
-                    else:
-                        self.validate_schema(ns, map_json[ns])
-        self.stack_location.pop()
@@ -0,0 +1,236 @@
+"""
+Reading and writing the json files made by the ETL. The fastest json library that's installed is used: orjson, then
+msgspec, then the standard library. They all write the same json: pretty-printed json is indented by 2 spaces, as
+orjson can only indent by 2, strings are written as UTF-8, and NaN and infinite floats are written as null. The only
+difference is in how some floats are spelled, such as 1e-05 by the standard library and 0.00001 by orjson, which are
+the same value. Outputs can be compressed with gzip, or with zstd if zstandard is installed.
+"""
+
+import gc
+import gzip
+import io
+import json
+import math
+import sys
+from collections.abc import Iterator, Mapping
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# number of bytes that are buffered before they're written to the output file
+CHUNK_SIZE = 1 << 20
+
+COMPRESSION_SUFFIXES = {
+    "gzip": ".gz",
+    "zstd": ".zst"
+}
+
+
+def available_backends():
+    """Return the names of the json libraries that can be used, fastest first."""
+    backends = []
+    if orjson is not None:
+        backends.append("orjson")
+    if msgspec is not None:
+        backends.append("msgspec")
+    backends.append("json")
+    return backends
+
+
+# the json library used when none is specified
+BACKEND = available_backends()[0]
+
+
+# number of spaces that pretty-printed json is indented by
+INDENT = 2
+
+
+def _encode_default(obj):
+    # mappings that aren't dicts, like the sheets of an IndexedStore, are encoded as objects
+    if isinstance(obj, Mapping):
+        return {key: _encode_default(value) if isinstance(value, Mapping) and not isinstance(value, dict) else value
+                for key, value in obj.items()}
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def _finite(obj):
+    # NaN and infinite floats become None, as orjson and msgspec encode them, instead of the standard library's NaN
+    if isinstance(obj, float) and not math.isfinite(obj):
+        return None
+    if isinstance(obj, Mapping):
+        return {key: _finite(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_finite(value) for value in obj]
+    return obj
+
+
+def _json_dumps(obj, pretty):
+    kwargs = {"indent": INDENT} if pretty else {"separators": (",", ":")}
+    try:
+        return json.dumps(obj, ensure_ascii=False, allow_nan=False, default=_encode_default, **kwargs)
+    except ValueError as e:
+        if "Out of range float" not in str(e):
+            raise
+        return json.dumps(_finite(obj), ensure_ascii=False, allow_nan=False, default=_encode_default, **kwargs)
+
+
+def encode(obj, pretty=False, backend=None):
+    """Return obj encoded as json bytes."""
+    backend = backend or BACKEND
+    if backend == "orjson":
+        option = orjson.OPT_NON_STR_KEYS
+        if pretty:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=_encode_default, option=option)
+    if backend == "msgspec":
+        encoded = msgspec.json.encode(obj, enc_hook=_encode_default)
+        if pretty:
+            encoded = msgspec.json.format(encoded, indent=INDENT)
+        return encoded
+    return _json_dumps(obj, pretty).encode()
+
+
+def decode(data, backend=None):
+    """Return the object encoded in json bytes or str."""
+    backend = backend or BACKEND
+    if backend == "orjson":
+        return orjson.loads(data)
+    if backend == "msgspec":
+        return msgspec.json.decode(data)
+    return json.loads(data)
+
+
+def iter_encoded(obj, pretty=False, backend=None):
+    """
+    Yield obj encoded as json, in pieces. The members of a top-level object, and the items of the lists in it, are
+    encoded separately, so that a whole map file never has to be encoded in memory at once. A member's value can also
+    be an iterator, which is written as a list as it's consumed, or a function, which is called when the member is
+    reached: a member can depend on the members before it.
+    """
+    if not isinstance(obj, dict) or len(obj) == 0:
+        yield encode(obj, pretty, backend)
+        return
+    pad = b" " * INDENT if pretty else b""
+    newline = b"\n" if pretty else b""
+    colon = b": " if pretty else b":"
+
+    def nested(value, level):
+        encoded = encode(value, pretty, backend)
+        if pretty:
+            # newlines can only be whitespace in json, since they're escaped in strings
+            encoded = encoded.replace(b"\n", b"\n" + pad * level)
+        return encoded
+
+    separator = b""
+    for key, value in obj.items():
+        yield (separator or b"{") + newline + pad + encode(str(key), backend=backend) + colon
+        separator = b","
+        if callable(value):
+            value = value()
+        if isinstance(value, (list, Iterator)):
+            item_separator = b"["
+            for item in value:
+                yield item_separator + newline + pad * 2 + nested(item, 2)
+                item_separator = b","
+            if item_separator == b"[":
+                yield b"[]"
+            else:
+                yield newline + pad + b"]"
+        else:
+            yield nested(value, 1)
+    yield newline + b"}"
+
+
+def compression_of(path):
+    """Return the compression ("gzip", "zstd" or None) of a file, from its suffix."""
+    for compress, suffix in COMPRESSION_SUFFIXES.items():
+        if str(path).endswith(suffix):
+            return compress
+    return None
+
+
+def output_path(path, compress=None):
+    """Return the path that a file is written to, with the suffix for its compression."""
+    if compress is None:
+        return path
+    return f"{path}{COMPRESSION_SUFFIXES[compress]}"
+
+
+def strip_compression_suffix(path):
+    """Return path without the suffix of its compression, if it has one."""
+    compress = compression_of(path)
+    if compress is None:
+        return path
+    return path[:-len(COMPRESSION_SUFFIXES[compress])]
+
+
+def _require_zstandard():
+    if zstandard is None:
+        sys.exit("zstd compression needs the zstandard package: install it with `pip install zstandard`.")
+
+
+def open_output(path, compress=None):
+    """Open path for writing bytes, compressed with compress."""
+    if compress == "gzip":
+        return gzip.open(path, "wb", compresslevel=6)
+    if compress == "zstd":
+        _require_zstandard()
+        return zstandard.open(path, "wb")
+    return open(path, "wb")
+
+
+def open_input(path, text=False):
+    """Open path for reading, decompressing it according to its suffix. Returns a text file if text is True."""
+    compress = compression_of(path)
+    if compress == "gzip":
+        fp = gzip.open(path, "rb")
+    elif compress == "zstd":
+        _require_zstandard()
+        fp = zstandard.open(path, "rb")
+    else:
+        fp = open(path, "rb")
+    if text:
+        return io.TextIOWrapper(fp, encoding="utf-8")
+    return fp
+
+
+def dump(obj, path, pretty=True, compress=None, backend=None):
+    """
+    Write obj to path as json, compressed with compress ("gzip", "zstd" or None); the suffix for the compression is
+    added to path. Returns the path that was written.
+    """
+    path = output_path(path, compress)
+    with open_output(path, compress) as f:
+        buffer = bytearray()
+        for piece in iter_encoded(obj, pretty, backend):
+            buffer += piece
+            if len(buffer) >= CHUNK_SIZE:
+                f.write(buffer)
+                buffer = bytearray()
+        f.write(buffer)
+    return path
+
+
+def load(path, backend=None):
+    """Read the json object in path, decompressing it according to its suffix."""
+    with open_input(path) as f:
+        data = f.read()
+    # decoding a map file creates millions of objects, none of them garbage: don't let the collector scan them
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return decode(data, backend)
+    finally:
+        if gc_enabled:
+            gc.enable()
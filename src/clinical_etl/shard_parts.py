@@ -0,0 +1,152 @@
+"""
+The outputs of converting one shard of a cohort at a time with --shard, so that the shards can be converted by separate
+jobs, on machines that share a filesystem, and merged into the outputs of converting the whole cohort at once. They're
+kept in a {output_file}_parts directory, which is also the queue of shards to convert:
+- {shard}.claim: made by the job that converts the shard, so that jobs that take the next shard leave it alone
+- {shard}_map.ndjson: a record for each mapped donor of the shard, in the order it was mapped, with its validated
+  packets
+- {shard}_statistics.ndjson: a record for each of those donors, in the same order, with its validation errors, warnings
+  and statistics, or with its mapping error
+- {shard}_ids.bin: the IdentifierRegistry of the shard's packets, for finding ids that are duplicated across shards
+- {shard}.json: written once the rest are complete, with the number of shards and the fingerprint of the conversion
+"""
+
+import glob
+import heapq
+import json
+import os
+import re
+import shutil
+import socket
+import sys
+
+from clinical_etl import serializer
+from clinical_etl.schema import IdentifierRegistry
+
+
+class ShardParts:
+    def __init__(self, output_file, shards=None, fingerprint=None):
+        self.path = f"{output_file}_parts"
+        self.shards = shards
+        self.fingerprint = fingerprint
+        self.shard = None
+        self.map_file = None
+        self.statistics_file = None
+
+    def part(self, shard, name):
+        return os.path.join(self.path, f"{shard}{name}")
+
+    def claim(self, shard):
+        """Claim a shard to convert, whether or not another job has claimed it. Its previous parts are discarded."""
+        os.makedirs(self.path, exist_ok=True)
+        if os.path.exists(self.part(shard, ".json")):
+            os.remove(self.part(shard, ".json"))
+        with open(self.part(shard, ".claim"), "w") as f:
+            f.write(f"{socket.gethostname()} {os.getpid()}\n")
+
+    def claim_next(self):
+        """Claim the first shard that no job has claimed yet, and return it, or None if they've all been claimed."""
+        os.makedirs(self.path, exist_ok=True)
+        for shard in range(self.shards):
+            try:
+                # creating the claim fails if it exists, even if another job creates it at the same time
+                fd = os.open(self.part(shard, ".claim"), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                continue
+            with os.fdopen(fd, "w") as f:
+                f.write(f"{socket.gethostname()} {os.getpid()}\n")
+            return shard
+        return None
+
+    def start(self, shard):
+        self.shard = shard
+        self.map_file = open(self.part(shard, "_map.ndjson"), "wb")
+        self.statistics_file = open(self.part(shard, "_statistics.ndjson"), "wb")
+
+    def add(self, order, packets, validation):
+        """Add a mapped donor, with the results of validate_each_case for each of its packets."""
+        statistics = None
+        errors = []
+        warnings = []
+        cases = []
+        for packet_errors, packet_warnings, packet_statistics, packet_cases in validation:
+            errors.extend(packet_errors)
+            warnings.extend(packet_warnings)
+            cases.extend(packet_cases)
+            statistics = packet_statistics if statistics is None else statistics.merge(packet_statistics)
+        self.map_file.write(serializer.encode({"order": order, "packets": packets}) + b"\n")
+        self.statistics_file.write(serializer.encode({
+            "order": order,
+            "validation_errors": errors,
+            "validation_warnings": warnings,
+            "statistics": None if statistics is None else statistics.to_state(),
+            "cases": cases
+        }) + b"\n")
+
+    def add_error(self, order, error):
+        """Add a donor that couldn't be mapped, with its MappingError as ErrorReport records it."""
+        self.map_file.write(serializer.encode({"order": order, "packets": []}) + b"\n")
+        self.statistics_file.write(serializer.encode({"order": order, "error": error}) + b"\n")
+
+    def finish(self, identifier_registry):
+        """Write the rest of the shard's parts, and mark it as complete."""
+        self.map_file.close()
+        self.statistics_file.close()
+        identifier_registry.dump(self.part(self.shard, "_ids.bin"))
+        done_path = self.part(self.shard, ".json")
+        # replace it in one step, so that a merge never sees half of it
+        with open(f"{done_path}.tmp", "w") as f:
+            json.dump({"shard": self.shard, "shards": self.shards, "fingerprint": self.fingerprint}, f)
+        os.replace(f"{done_path}.tmp", done_path)
+        self.shard = None
+
+    def abort(self):
+        if self.map_file is not None:
+            self.map_file.close()
+            self.statistics_file.close()
+
+    def check(self):
+        """Check that every shard has been converted, by the same conversion, so that they can be merged."""
+        done = {}
+        for path in glob.glob(os.path.join(self.path, "*.json")):
+            if re.fullmatch(r"\d+\.json", os.path.basename(path)) is not None:
+                with open(path) as f:
+                    state = json.load(f)
+                done[state["shard"]] = state
+        if len(done) == 0:
+            sys.exit(f"There are no converted shards to merge in {self.path}: convert them with --shard first.")
+        self.shards = next(iter(done.values()))["shards"]
+        fingerprints = set(state["fingerprint"] for state in done.values())
+        if len(fingerprints) > 1 or any(state["shards"] != self.shards for state in done.values()):
+            sys.exit(f"The shards in {self.path} weren't all converted from the same inputs, manifest, template and "
+                     f"mapping functions, into the same number of shards: convert them again.")
+        missing = [str(shard) for shard in range(self.shards) if shard not in done]
+        if len(missing) > 0:
+            sys.exit(f"Shards {', '.join(missing)} of {self.shards} haven't been converted yet: convert them with "
+                     f"--shard before merging.")
+
+    def identifier_registry(self):
+        """The IdentifierRegistry of all of the shards, in the order of the shards."""
+        registry = IdentifierRegistry()
+        for shard in range(self.shards):
+            registry.merge(IdentifierRegistry.load(self.part(shard, "_ids.bin")))
+        return registry
+
+    def records(self):
+        """Yield (map record, statistics record) for each donor of every shard, in the order that converting the
+        whole cohort at once would map them."""
+        files = []
+        try:
+            streams = []
+            for shard in range(self.shards):
+                map_file = open(self.part(shard, "_map.ndjson"), "rb")
+                statistics_file = open(self.part(shard, "_statistics.ndjson"), "rb")
+                files += [map_file, statistics_file]
+                streams.append(zip(map(serializer.decode, map_file), map(serializer.decode, statistics_file)))
+            yield from heapq.merge(*streams, key=lambda records: tuple(records[0]["order"]))
+        finally:
+            for f in files:
+                f.close()
+
+    def remove(self):
+        shutil.rmtree(self.path, ignore_errors=True)
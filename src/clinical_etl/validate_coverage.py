@@ -1,13 +1,17 @@
 import argparse
 import json
 import sys
-import mappings
 import importlib.util
 import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 # Include clinical_etl parent directory in the module search path for a later import.
 current_dir = os.path.dirname(os.path.abspath(__file__))
 parent_dir = os.path.dirname(current_dir)
 sys.path.append(parent_dir)
+from clinical_etl import mappings
+from clinical_etl import serializer
+from clinical_etl.schema import IdentifierRegistry, ValidationStats
 # from jsoncomparison import Compare
 # from copy import deepcopy
 # import yaml
@@ -22,6 +26,11 @@ def parse_args():
     parser.add_argument('--json', type=str, help="<input-file-path-name>_map.json file generated by CSVConvert.py.",
                         required=True)
     parser.add_argument('--verbose', '--v', action="store_true", help="Print extra information")
+    parser.add_argument('--workers', type=int, default=1, help="Number of processes to validate with. With more than "
+                        "one, donors are read from the file one at a time instead of loading all of it at once.")
+    parser.add_argument('--chunk-size', type=int, default=100, help="Number of donors sent to a worker at a time")
+    parser.add_argument('--ids', type=str, help="File of ids from previous validations to check for duplicates "
+                        "against. The ids in this mapping are added to it.")
     # parser.add_argument('--manifest', type=str, help="Path to a manifest file describing the mapping.", required=False)
     # parser.add_argument('--input', type=str, required=False, help="Directory to the raw clinical data used for creating the JSON file.")
     args = parser.parse_args()
@@ -205,13 +214,8 @@ def parse_args():
 #                     missing.append(comment_match.group(2))
 #     print("\n".join(missing))
 
-def validate_coverage(map_json, verbose=False):
-    if verbose:
-        mappings.VERBOSE = True
-
-    # read the schema and generate a scaffold
-    if "openapi_url" not in map_json:
-        return {"message": "No openapi_url schema available"}
+def load_schema(map_json):
+    """Return the schema for a map json (or its top-level members other than the donors)."""
     schema_class = "MoHSchemaV3"
     if "schema_class" in map_json:
         schema_class = map_json["schema_class"]
@@ -220,6 +224,271 @@ def validate_coverage(map_json, verbose=False):
 
     if schema.json_schema is None:
         sys.exit(f"Did not find an openapi schema at {map_json['openapi_url']}; please check the 'openapi_url' in the map json file.")
+    return schema
+
+
+def iter_json_members(fp, chunk_size=1 << 20):
+    """
+    Yield (key, value, is_item) for each member of the top-level object in a JSON file, without reading all of
+    the file into memory. Members whose value is a list are yielded an item at a time, with is_item True.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    pos = 0
+    eof = False
+
+    def fill():
+        nonlocal buffer, pos, eof
+        chunk = fp.read(chunk_size)
+        eof = chunk == ""
+        buffer = buffer[pos:] + chunk
+        pos = 0
+
+    def next_char():
+        # skip whitespace and return the next character, without consuming it
+        nonlocal pos
+        while True:
+            while pos < len(buffer) and buffer[pos] in " \t\r\n":
+                pos += 1
+            if pos < len(buffer):
+                return buffer[pos]
+            if eof:
+                raise ValueError("Unexpected end of JSON file")
+            fill()
+
+    def expect(chars):
+        nonlocal pos
+        char = next_char()
+        if char not in chars:
+            raise ValueError(f"Expected one of {chars} but found {char}")
+        pos += 1
+        return char
+
+    def decode():
+        nonlocal pos
+        next_char()
+        while True:
+            try:
+                value, end = decoder.raw_decode(buffer, pos)
+                # a number at the end of the buffer might continue in the next chunk
+                if end < len(buffer) or eof:
+                    pos = end
+                    return value
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            fill()
+
+    expect("{")
+    if next_char() == "}":
+        return
+    while True:
+        key = decode()
+        expect(":")
+        if next_char() == "[":
+            pos += 1
+            if next_char() == "]":
+                pos += 1
+            else:
+                while True:
+                    yield key, decode(), True
+                    if expect(",]") == "]":
+                        break
+        else:
+            yield key, decode(), False
+        if expect(",}") == "}":
+            return
+
+
+def iter_ndjson_members(fp):
+    """
+    Yield (key, value, is_item) for a newline-delimited JSON file with one donor per line, like iter_json_members.
+    A line with an openapi_url is not a donor: its members are yielded instead, with is_item False. Donors are
+    yielded with a key of None.
+    """
+    for line in fp:
+        if line.strip() == "":
+            continue
+        obj = serializer.decode(line)
+        if "openapi_url" in obj:
+            for key, value in obj.items():
+                yield key, value, False
+        else:
+            yield None, obj, True
+
+
+_worker_schema = None
+
+
+def _init_worker(map_json):
+    global _worker_schema
+    if _worker_schema is None:
+        _worker_schema = load_schema(map_json)
+
+
+def _validate_chunk(cases, start, return_cases=False):
+    """Validate a chunk of donors in a worker, returning the errors, warnings, statistics and identifier registry, and
+    the donors as validation left them if return_cases."""
+    schema = _worker_schema
+    schema.validation_errors = []
+    schema.validation_warnings = []
+    schema.identifier_registry = IdentifierRegistry()
+    schema.stack_location = []
+    schema.validation_stats = ValidationStats(schema.validation_schema.keys())
+    schema.validate_cases(cases, start)
+    result = schema.validation_errors, schema.validation_warnings, schema.validation_stats, schema.identifier_registry
+    if return_cases:
+        return result + (cases,)
+    return result
+
+
+def load_identifiers(ids_path):
+    """Return the IdentifierRegistry saved at ids_path, or an empty one if there isn't one yet."""
+    if ids_path is not None and os.path.exists(ids_path):
+        return IdentifierRegistry.load(ids_path)
+    return IdentifierRegistry()
+
+
+class ChunkValidator:
+    """
+    Validates chunks of donors in order, merging the results of each chunk into schema once all of the chunks before
+    it are merged. With workers, the chunks are validated in a pool of that many processes, and only a few chunks are
+    kept in flight: submit waits for the oldest one once the workers are behind. Without, each chunk is validated when
+    it's submitted. header is the map json's members other than the donors, for workers that can't inherit schema.
+    Validation removes required fields that are "Not available" from the donors, so if on_validated is given, it's
+    called with the donors of each chunk, as validation left them, once the chunk is merged.
+    """
+    def __init__(self, schema, header, workers=0, registry=None, on_validated=None):
+        global _worker_schema
+        self.schema = schema
+        self.workers = workers
+        self.errors = []
+        self.warnings = []
+        self.stats = ValidationStats(schema.validation_schema.keys())
+        self.registry = IdentifierRegistry() if registry is None else registry
+        self.on_validated = on_validated
+        self.pending = deque()
+        self.start = 0
+        # forked workers inherit this schema, instead of each one downloading it again
+        _worker_schema = schema
+        self.executor = None
+        if workers > 0:
+            self.executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(header,))
+            # start the workers now rather than when the first chunk is submitted, so that they're forked before the
+            # caller starts any threads: forking a process that has other threads running isn't safe
+            self.executor.submit(os.getpid).result()
+
+    def _collect(self, result):
+        chunk_errors, chunk_warnings, chunk_stats, chunk_registry = result[:4]
+        self.errors.extend(chunk_errors)
+        self.warnings.extend(chunk_warnings)
+        self.stats.merge(chunk_stats)
+        self.registry.merge(chunk_registry)
+        if self.on_validated is not None:
+            self.on_validated(result[4])
+
+    def submit(self, cases):
+        """Validate the next chunk of donors."""
+        start = self.start
+        self.start += len(cases)
+        return_cases = self.on_validated is not None
+        if self.executor is None:
+            self._collect(_validate_chunk(cases, start, return_cases))
+            return
+        self.pending.append(self.executor.submit(_validate_chunk, cases, start, return_cases))
+        while len(self.pending) > self.workers * 2:
+            self._collect(self.pending.popleft().result())
+
+    def finish(self):
+        """Wait for the chunks in flight, then set the errors, warnings, statistics and identifiers of all of them on
+        schema and check for duplicate ids."""
+        while len(self.pending) > 0:
+            self._collect(self.pending.popleft().result())
+        self.close()
+        self.schema.validation_errors = self.errors
+        self.schema.validation_warnings = self.warnings
+        self.schema.validation_stats = self.stats
+        self.schema.identifier_registry = self.registry
+        self.schema.check_duplicate_ids()
+
+    def close(self):
+        global _worker_schema
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+            self.executor = None
+        _worker_schema = None
+
+
+def validate_coverage_parallel(json_path, workers=1, chunk_size=100, verbose=False, ids_path=None):
+    """
+    Validate a map json, or ndjson, file without loading all of it: donors are validated in chunks across a pool of
+    workers and the results are merged in the order of the donors. If ids_path is specified, ids are also checked for
+    duplicates against the ids saved there, and saved back to it.
+    """
+    if verbose:
+        mappings.VERBOSE = True
+
+    header = {}
+    schema = None
+    validator = None
+    registry = load_identifiers(ids_path)
+
+    with serializer.open_input(json_path, text=True) as fp:
+        if serializer.strip_compression_suffix(json_path).endswith(".ndjson"):
+            members = iter_ndjson_members(fp)
+        else:
+            members = iter_json_members(fp)
+        chunk = []
+        root_schema = None
+        try:
+            for key, value, is_item in members:
+                if schema is None and is_item:
+                    if "openapi_url" not in header:
+                        return {"message": "No openapi_url schema available before the donors"}
+                    print("Validating the mapped schema...")
+                    schema = load_schema(header)
+                    root_schema = list(schema.validation_schema.keys())[0]
+                    validator = ChunkValidator(schema, header, workers if workers > 1 else 0, registry)
+                if not is_item or key not in [None, root_schema]:
+                    if is_item:
+                        header.setdefault(key, []).append(value)
+                    else:
+                        header[key] = value
+                    continue
+                # map files written by other tools can have fields that mapped to nothing
+                chunk.append(schema.prune(value))
+                if len(chunk) == chunk_size:
+                    validator.submit(chunk)
+                    chunk = []
+            if schema is None:
+                if "openapi_url" not in header:
+                    return {"message": "No openapi_url schema available"}
+                schema = load_schema(header)
+                validator = ChunkValidator(schema, header, 0, registry)
+            if len(chunk) > 0:
+                validator.submit(chunk)
+            validator.finish()
+        finally:
+            if validator is not None:
+                validator.close()
+
+    if ids_path is not None:
+        registry.dump(ids_path)
+    return {
+        "errors": schema.validation_errors,
+        "warnings": schema.validation_warnings,
+        "statistics": schema.statistics
+    }
+
+
+def validate_coverage(map_json, verbose=False, ids_path=None):
+    if verbose:
+        mappings.VERBOSE = True
+
+    # read the schema and generate a scaffold
+    if "openapi_url" not in map_json:
+        return {"message": "No openapi_url schema available"}
+    schema = load_schema(map_json)
 
     # if --input was specified, we can check data frame completeness coverage:
     # if input_path is not None:
@@ -231,7 +500,13 @@ def validate_coverage(map_json, verbose=False):
     #     check_completeness(raw_csv_dfs, schema)
 
     print("Validating the mapped schema...")
+    # map files written by other tools can have fields that mapped to nothing
+    for case in map_json.get(list(schema.validation_schema.keys())[0], []):
+        schema.prune(case)
+    schema.identifier_registry = load_identifiers(ids_path)
     schema.validate_ingest_map(map_json)
+    if ids_path is not None:
+        schema.identifier_registry.dump(ids_path)
     # print(json.dumps(schema.validation_results, indent=4))
     return {
         "errors": schema.validation_errors,
@@ -240,9 +515,21 @@ def validate_coverage(map_json, verbose=False):
     }
 
 def main(args):
+    verbose = True if args.verbose else False
+    if args.workers > 1 or serializer.strip_compression_suffix(args.json).endswith(".ndjson"):
+        try:
+            result = validate_coverage_parallel(args.json, args.workers, args.chunk_size, verbose, args.ids)
+        except FileNotFoundError as e:
+            print(e)
+            sys.exit("JSON file not found at provided path, please check your --json argument.")
+        if "message" in result:
+            sys.exit(f"{result['message']}, please check you are providing the right file and try again, it should "
+                     "end with '_map.json'.")
+        print_result(result)
+        return
+
     try:
-        with open(args.json) as fp:
-            map_json = json.load(fp)
+        map_json = serializer.load(args.json)
         map_json['openapi_url']
     except FileNotFoundError as e:
         print(e)
@@ -252,8 +539,11 @@ def main(args):
                  "try again, it should end with '_map.json'.")
 
     # input_path = args.input
-    verbose = True if args.verbose else False
-    result = validate_coverage(map_json, verbose)
+    result = validate_coverage(map_json, verbose, args.ids)
+    print_result(result)
+
+
+def print_result(result):
     if len(result["warnings"]) > 0:
         print("Mapping has missing data:")
         for line in result["warnings"]:
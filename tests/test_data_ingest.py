@@ -3,13 +3,23 @@ import yaml
 import os
 import sys
 import json
+import shutil
+import subprocess
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 # Include src/clinical_etl directory in the module search path.
 current_dir = os.path.dirname(os.path.abspath(__file__))
 parent_dir = os.path.dirname(current_dir)
 sys.path.append(os.sep.join([parent_dir, "src"]))
 from clinical_etl import CSVConvert
+from clinical_etl import codegen
 from clinical_etl import mappings
+from clinical_etl import serializer
+from clinical_etl import validate_coverage
+from clinical_etl.indexed_store import IndexedStore
 from clinical_etl.mohschemav3 import MoHSchemaV3
+from clinical_etl.schema import IdentifierRegistry
 
 # read sheet from given data pathway
 REPO_DIR = os.path.abspath(f"{os.path.dirname(os.path.realpath(__file__))}")
@@ -112,7 +122,7 @@ def test_validation(packets, schema):
     # "DONOR_1: PD_1 > TR_1: date_of_death cannot be earlier than treatment_end_date ",
     # "DONOR_1: PD_1 > TR_1: treatment_start_date cannot be after date_of_death ",
     # "DONOR_5: lost_to_followup_after_clinical_event_identifier cannot be present if is_deceased = Yes",
-    # "Duplicated IDs: in schema followups, FOLLOW_UP_4 occurs 2 times"
+    # "Duplicated IDs: in schema followups, FOLLOW_UP_4 occurs 2 times, in DONOR_1, DONOR_6"
 
     # there should be an item named DUPLICATE_ID in both followup and sample_registration
     print(json.dumps(schema.identifiers, indent=2))
@@ -120,6 +130,127 @@ def test_validation(packets, schema):
     assert schema.identifiers["primary_diagnoses"]["DUPLICATE_ID"] == 1
 
 
+def test_prune(packets, schema):
+    # mapped packets are already compact: the mapper doesn't add fields that mapped to nothing
+    for packet in packets:
+        assert schema.prune(json.loads(json.dumps(packet))) == packet
+
+    # map files from other tools are pruned before they're validated
+    donor = {
+        "submitter_donor_id": "DONOR_1",
+        "gender": None,
+        "cause_of_death": None,
+        "comorbidities": [],
+        "primary_diagnoses": [{
+            "submitter_primary_diagnosis_id": "PD_1",
+            "laterality": None,
+            "treatments": [{"submitter_treatment_id": "TR_1", "surgeries": [], "treatment_type": []}]
+        }],
+        "multisheet": {"placeholder": None}
+    }
+    schema.prune(donor)
+    # required fields are kept even if they're empty, as are empty lists of values and fields outside the schema
+    assert donor == {
+        "submitter_donor_id": "DONOR_1",
+        "gender": None,
+        "primary_diagnoses": [{
+            "submitter_primary_diagnosis_id": "PD_1",
+            "treatments": [{"submitter_treatment_id": "TR_1", "treatment_type": []}]
+        }],
+        "multisheet": {"placeholder": None}
+    }
+
+
+def test_validation_stats(packets, schema):
+    # stats for separately-validated halves of the donors merge into the stats for all of them
+    schema.validate_ingest_map({"donors": packets})
+    expected = schema.statistics
+    schema.validate_ingest_map({"donors": packets[:3]})
+    merged = schema.validation_stats
+    schema.validate_ingest_map({"donors": packets[3:]})
+    merged.merge(schema.validation_stats)
+    assert merged.to_json() == expected
+    assert expected["summary_cases"]["total_cases"] == len(packets)
+
+
+def test_identifier_registry(tmp_path):
+    registry = IdentifierRegistry()
+    registry.add("specimens", "SPECIMEN_1", "DONOR_1")
+    registry.add("specimens", "SPECIMEN_2", "DONOR_1")
+    previous = IdentifierRegistry()
+    previous.add("specimens", "SPECIMEN_1", "DONOR_2")
+    previous.dump(tmp_path / "ids.bin")
+    registry.merge(IdentifierRegistry.load(tmp_path / "ids.bin"))
+    expected = [("specimens", "SPECIMEN_1", 2, ["DONOR_1", "DONOR_2"])]
+    assert list(registry.duplicates()) == expected
+
+    # different ids with the same hash aren't duplicates
+    registry.schemas["specimens"]["hashes"][1] = registry.schemas["specimens"]["hashes"][0]
+    assert list(registry.duplicates()) == expected
+    assert registry.counts()["specimens"]["SPECIMEN_1"] == 2
+
+
+def test_serializer(tmp_path):
+    map_json = {
+        "openapi_url": "https://example.com/schema.yml",
+        "donors": [{"submitter_donor_id": "DONOR_1", "values": [1, 2.5, None]}, {"submitter_donor_id": "DONØR_2"}],
+        "empty": [],
+        "statistics": {"nested": {"fraction": 0.25}}
+    }
+    # every backend writes the same pretty json, which is json.dump's with an indent of 2, in UTF-8
+    expected = json.dumps(map_json, indent=2, ensure_ascii=False)
+    for backend in serializer.available_backends():
+        path = serializer.dump(map_json, tmp_path / "map.json", backend=backend)
+        assert path.read_text(encoding="utf-8") == expected
+        # and NaN is written as null
+        assert serializer.encode({"fraction": float("nan")}, backend=backend) == b'{"fraction":null}'
+    for backend in serializer.available_backends():
+        for pretty in [True, False]:
+            for compress in [None, "gzip"]:
+                path = serializer.dump(map_json, str(tmp_path / "map.json"), pretty=pretty, compress=compress,
+                                       backend=backend)
+                assert serializer.load(path, backend=backend) == map_json
+                with serializer.open_input(path, text=True) as fp:
+                    assert json.load(fp) == map_json
+    assert path == str(tmp_path / "map.json.gz")
+
+
+def test_stream_map_json(tmp_path):
+    # donors are read from a map json one at a time, even if they're split across reads
+    map_json = {
+        "openapi_url": "https://example.com/schema.yml",
+        "donors": [{"submitter_donor_id": "DONOR_1", "values": [1, 22, 333]}, {"submitter_donor_id": "DONOR_2"}],
+        "empty": [],
+        "statistics": {"fraction": 0.25}
+    }
+    json_path = tmp_path / "test_map.json"
+    json_path.write_text(json.dumps(map_json, indent=4))
+    with open(json_path) as fp:
+        members = list(validate_coverage.iter_json_members(fp, chunk_size=7))
+    assert members == [
+        ("openapi_url", "https://example.com/schema.yml", False),
+        ("donors", map_json["donors"][0], True),
+        ("donors", map_json["donors"][1], True),
+        ("statistics", {"fraction": 0.25}, False)
+    ]
+
+
+def test_validation_rules(schema):
+    # validation_rules are compiled into checkers, indexed by the field that triggers them
+    for check in schema.rule_checkers["treatments"]["treatment_type"]:
+        check({"treatment_type": ["Surgery"], "surgeries": []})
+    assert schema.validation_warnings == ["Treatment type Surgery should have one or more surgery submitted"]
+
+    for check in schema.rule_checkers["exposures"]["tobacco_type"]:
+        check({"tobacco_smoking_status": "Never smoked", "tobacco_type": ["Cigarettes"]})
+    for check in schema.rule_checkers["treatments"]["treatment_start_date"]:
+        check({"treatment_start_date": {"month_interval": 3}, "treatment_end_date": {"month_interval": 1}})
+    assert schema.validation_errors == [
+        "tobacco_type cannot be submitted for tobacco_smoking_status = Never smoked",
+        "Treatment start cannot be after treatment end."
+    ]
+
+
 # test mapping that uses values from multiple sheets:
 def test_multisheet_mapping(packets):
     for packet in packets:
@@ -141,3 +272,459 @@ def test_multisheet_mapping(packets):
                         assert len(s["multisheet"]["placeholder"]["submitter_specimen_id"]["Sample_Registration"]) == 0
                         assert len(s["multisheet"]["placeholder"]["extra"]["Sample_Registration"]) == 0
 
+
+
+def test_mapping_error(tmp_path, monkeypatch):
+    monkeypatch.setattr(mappings, "OUTPUT_FILE", str(tmp_path / "cohort"))
+    monkeypatch.setattr(mappings, "IDENTIFIER", "DONOR_1")
+    monkeypatch.setattr(mappings, "IDENTIFIER_FIELD", "submitter_donor_id")
+    monkeypatch.setattr(mappings, "INDEXED_DATA", {"data": {
+        "Donor": {"DONOR_1": {"date_of_birth": ["bad date"]}, "DONOR_2": {"date_of_birth": ["2000-01"]}},
+        "Treatment": {"DONOR_2": {"treatment_type": ["Surgery"]}}
+    }})
+    error = mappings.MappingError("Cannot parse date 'bad date'")
+    # formatting the error doesn't write anything
+    assert "DONOR_1" in str(error)
+    assert list(tmp_path.iterdir()) == []
+
+    report = mappings.ErrorReport()
+    report.add(error)
+    report.add(mappings.MappingError("Cannot parse date 'bad date'"))
+    # only the failing donor's rows are written, once
+    assert list(tmp_path.iterdir()) == [tmp_path / "cohort_DONOR_1_debug.json"]
+    with open(error.snapshot_path) as f:
+        assert json.load(f)["data"] == {"Donor": {"date_of_birth": ["bad date"]}}
+    summary = report.to_json()["summary"]
+    assert summary[0]["count"] == 2
+    assert summary[0]["donors"] == ["DONOR_1"]
+
+
+def copy_test_data(tmp_path):
+    for f in ["manifest.yml", "test2mohv3.csv", "testmap.py"]:
+        shutil.copy(f"{REPO_DIR}/{f}", tmp_path)
+    shutil.copytree(f"{REPO_DIR}/raw_data", tmp_path / "raw_data")
+
+
+def record_forks(monkeypatch):
+    # the number of threads running each time a process is forked
+    threads_at_fork = []
+    fork = os.fork
+
+    def recording_fork():
+        threads_at_fork.append(threading.active_count())
+        return fork()
+    monkeypatch.setattr(os, "fork", recording_fork)
+    return threads_at_fork
+
+
+def test_continue_on_error(tmp_path):
+    # DONOR_1 has a date of birth that can't be parsed: it's left out and the other donors are mapped
+    copy_test_data(tmp_path)
+    donor_csv = tmp_path / "raw_data" / "Donor.csv"
+    donor_csv.write_text(donor_csv.read_text().replace("DONOR_1,TEST_1,,,,Yes,Died of cancer,6/1/1954",
+                                                       "DONOR_1,TEST_1,,,,Yes,Died of cancer,not a date"))
+    mappings.INDEX_STACK = []
+    packets, errors = CSVConvert.csv_convert(str(tmp_path / "raw_data"), str(tmp_path / "manifest.yml"),
+                                             continue_on_error=True)
+    assert [p["submitter_donor_id"] for p in packets] == ["DONOR_2", "DONOR_3", "DONOR_4", "DONOR_5", "DONOR_6"]
+    with open(tmp_path / "raw_data_errors.json") as f:
+        report = json.load(f)
+    assert report["errors"][0]["identifier"] == "DONOR_1"
+    assert report["errors"][0]["field"] == "DONOR.INDEX.date_of_birth"
+    assert report["errors"][0]["method"] == "mappings.date_interval"
+
+
+def test_shards(tmp_path):
+    # converting the donors a shard at a time makes the same outputs as converting them all at once
+    copy_test_data(tmp_path)
+    input_path = str(tmp_path / "raw_data")
+    manifest_file = str(tmp_path / "manifest.yml")
+    outputs = []
+    for shards in [None, 3]:
+        mappings.INDEX_STACK = []
+        CSVConvert.csv_convert(input_path, manifest_file, shards=shards)
+        with open(tmp_path / "raw_data_map.json") as f:
+            map_json = json.load(f)
+        with open(tmp_path / "raw_data_validation_results.json") as f:
+            validation_results = json.load(f)
+        outputs.append((map_json, validation_results))
+    assert outputs[0] == outputs[1]
+    assert not os.path.exists(tmp_path / "raw_data_shards")
+
+
+def test_index_sheet_order():
+    # each donor's rows stay in the order they were read, however many rows the sheet has, so that a donor's rows
+    # are in the same order whichever shard they're indexed in
+    import pandas
+    mappings.IDENTIFIER_FIELD = "submitter_donor_id"
+    donors = [f"DONOR_{(i * 7919) % 50}" for i in range(2000)]
+    df = pandas.DataFrame({"submitter_donor_id": donors, "row": [str(i) for i in range(2000)]})
+    _, indexed = CSVConvert.index_sheet(df, "Followup", False)
+    for donor, rows in indexed.items():
+        assert rows["row"] == sorted(rows["row"], key=int)
+
+
+def test_donor_subset(tmp_path, capsys):
+    # converting some of the donors maps them as converting all of them would
+    copy_test_data(tmp_path)
+    input_path = str(tmp_path / "raw_data")
+    manifest_file = str(tmp_path / "manifest.yml")
+    mappings.INDEX_STACK = []
+    packets, _ = CSVConvert.csv_convert(input_path, manifest_file)
+    by_donor = {packet["submitter_donor_id"]: packet for packet in packets}
+    full_map = (tmp_path / "raw_data_map.json").read_text()
+    subset, _ = CSVConvert.csv_convert(input_path, manifest_file, donors=["DONOR_5", "DONOR_2"])
+    assert subset == [by_donor["DONOR_2"], by_donor["DONOR_5"]]
+    assert "Converting all of them would take about" in capsys.readouterr().out
+    # the outputs of the subset don't replace the outputs of all of the donors
+    assert (tmp_path / "raw_data_map.json").read_text() == full_map
+    with open(tmp_path / "raw_data_sample_map.json") as f:
+        assert json.load(f)["donors"] == subset
+    assert os.path.exists(tmp_path / "raw_data_sample_validation_results.json")
+
+    # a sample with the same seed is the same donors
+    samples = [CSVConvert.csv_convert(input_path, manifest_file, sample=3, seed=1)[0] for _ in range(2)]
+    assert samples[0] == samples[1]
+    assert len(samples[0]) == 3
+    assert all(packet == by_donor[packet["submitter_donor_id"]] for packet in samples[0])
+
+
+def test_shard_parts(tmp_path):
+    # converting the shards in separate jobs and merging them makes the same outputs as converting them all at once,
+    # including the ids that are duplicated in different shards (FOLLOW_UP_4 of DONOR_1 and DONOR_6)
+    copy_test_data(tmp_path)
+    input_path = str(tmp_path / "raw_data")
+    manifest_file = str(tmp_path / "manifest.yml")
+    donor_csv = tmp_path / "raw_data" / "Donor.csv"
+    donor_csv.write_text(donor_csv.read_text().replace("DONOR_4,TEST_1,,,,Yes,Not available,1/6/1984",
+                                                       "DONOR_4,TEST_1,,,,Yes,Not available,not a date"))
+    outputs = []
+    for distributed in [False, True]:
+        mappings.INDEX_STACK = []
+        if distributed:
+            CSVConvert.csv_convert(input_path, manifest_file, continue_on_error=True, shard=(1, 3))
+            with pytest.raises(SystemExit):
+                CSVConvert.merge_shards(input_path, manifest_file)
+            # the shards that haven't been started are taken one after another
+            CSVConvert.csv_convert(input_path, manifest_file, continue_on_error=True, shard=(None, 3))
+            assert sorted(os.listdir(tmp_path / "raw_data_parts"))[:3] == ["0.claim", "0.json", "0_ids.bin"]
+            CSVConvert.merge_shards(input_path, manifest_file)
+        else:
+            CSVConvert.csv_convert(input_path, manifest_file, continue_on_error=True)
+        output = []
+        for suffix in ["map", "validation_results", "errors"]:
+            with open(tmp_path / f"raw_data_{suffix}.json") as f:
+                output.append(f.read())
+        outputs.append(output)
+    assert outputs[0] == outputs[1]
+    assert "Duplicated IDs: in schema followups, FOLLOW_UP_4" in outputs[0][1]
+    assert not os.path.exists(tmp_path / "raw_data_parts")
+
+
+def test_pipeline(tmp_path, monkeypatch):
+    # validating and writing the packets while donors are mapped makes the same outputs, and processes are only
+    # forked while there are no other threads
+    threads_at_fork = record_forks(monkeypatch)
+    copy_test_data(tmp_path)
+    input_path = str(tmp_path / "raw_data")
+    manifest_file = str(tmp_path / "manifest.yml")
+    outputs = []
+    for shards, pipeline in [(None, False), (None, True), (2, True)]:
+        mappings.INDEX_STACK = []
+        packets, _ = CSVConvert.csv_convert(input_path, manifest_file, shards=shards, pipeline=pipeline)
+        with open(tmp_path / "raw_data_map.json") as f:
+            map_json = json.load(f)
+        with open(tmp_path / "raw_data_validation_results.json") as f:
+            validation_results = json.load(f)
+        outputs.append((map_json, validation_results))
+        if shards is None:
+            assert packets == map_json["donors"]
+    assert outputs[0] == outputs[1] == outputs[2]
+    assert not os.path.exists(tmp_path / "raw_data_map.partial.json")
+    assert len(threads_at_fork) > 0
+    assert set(threads_at_fork) == {1}
+
+
+def test_used_columns_only(tmp_path):
+    # reading only the columns that the template uses makes the same packets, even for rows that only differ in
+    # columns that aren't used, which are kept apart as they are when every column is kept
+    copy_test_data(tmp_path)
+    followup_csv = tmp_path / "raw_data" / "Followup.csv"
+    followup_row = next(line for line in followup_csv.read_text().splitlines() if line.startswith("FOLLOW_UP_3,"))
+    with open(followup_csv, "a") as f:
+        f.write(followup_row.replace(",T2(m),", ",T3,") + "\n")
+    input_path = str(tmp_path / "raw_data")
+    manifest_file = str(tmp_path / "manifest.yml")
+    outputs = []
+    for used_columns_only in [False, True]:
+        mappings.INDEX_STACK = []
+        packets, _ = CSVConvert.csv_convert(input_path, manifest_file, index_output=True,
+                                            used_columns_only=used_columns_only)
+        with open(tmp_path / "raw_data_indexed.json") as f:
+            outputs.append((packets, json.load(f)))
+    assert outputs[0][0] == outputs[1][0]
+    assert outputs[1][1]["data"]["Followup"]["DONOR_1"]["submitter_follow_up_id"].count("FOLLOW_UP_3") == 2
+    for options in [{"shards": 3}, {"sqlite": True}]:
+        mappings.INDEX_STACK = []
+        CSVConvert.csv_convert(input_path, manifest_file, used_columns_only=True, **options)
+        with open(tmp_path / "raw_data_map.json") as f:
+            assert json.load(f)["donors"] == outputs[0][0]
+    # Followup.relapse_type is used, Followup.recurrence_t_category isn't
+    assert "relapse_type" in outputs[1][1]["data"]["Followup"]["DONOR_1"]
+    assert "recurrence_t_category" in outputs[0][1]["data"]["Followup"]["DONOR_1"]
+    assert "recurrence_t_category" not in outputs[1][1]["data"]["Followup"]["DONOR_1"]
+
+    # int_to_date_interval_json reads Donor.date_resolution directly, so it's read even if nothing else uses it
+    scaffold = CSVConvert.create_scaffold_from_template([
+        "DONOR.INDEX, {indexed_on(Donor.submitter_donor_id)}",
+        "DONOR.INDEX.date_of_death, {int_to_date_interval_json(Donor.date_of_death)}"
+    ])
+    assert CSVConvert.used_columns(scaffold, {})["Donor"] == {"submitter_donor_id", "date_of_death", "date_resolution"}
+
+
+def test_input_formats(tmp_path):
+    # sheets that are compressed csvs, or parquet and arrow files if pyarrow is installed, make the same packets
+    copy_test_data(tmp_path)
+    input_path = str(tmp_path / "raw_data")
+    manifest_file = str(tmp_path / "manifest.yml")
+    mappings.INDEX_STACK = []
+    expected, _ = CSVConvert.csv_convert(input_path, manifest_file)
+    raw_data = tmp_path / "raw_data"
+    for sheet in ["Donor", "Treatment", "Followup"]:
+        with open(raw_data / f"{sheet}.csv", "rb") as f_in, serializer.open_output(raw_data / f"{sheet}.csv.gz", "gzip") as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        os.remove(raw_data / f"{sheet}.csv")
+    try:
+        import pandas
+        import pyarrow.feather
+        import pyarrow.parquet
+        for sheet, suffix in [("PrimaryDiagnosis", "parquet"), ("Specimen", "feather")]:
+            table = pyarrow.Table.from_pandas(pandas.read_csv(raw_data / f"{sheet}.csv", dtype=str), preserve_index=False)
+            if suffix == "parquet":
+                pyarrow.parquet.write_table(table, raw_data / f"{sheet}.parquet")
+            else:
+                pyarrow.feather.write_feather(table, raw_data / f"{sheet}.feather")
+            os.remove(raw_data / f"{sheet}.csv")
+    except ImportError:
+        pass
+    for shards in [None, 2]:
+        mappings.INDEX_STACK = []
+        packets, _ = CSVConvert.csv_convert(input_path, manifest_file, shards=shards)
+        if shards is not None:
+            with open(tmp_path / "raw_data_map.json") as f:
+                packets = json.load(f)["donors"]
+        assert packets == expected
+
+
+def test_interned_values():
+    # equal values in the indexed data are the same string, across sheets too
+    mappings.IDENTIFIER_FIELD = "submitter_donor_id"
+    raw_csv_dfs, _ = CSVConvert.ingest_raw_data(f"{REPO_DIR}/raw_data")
+    copied = CSVConvert.process_data(raw_csv_dfs, False, intern=False)
+    interned = CSVConvert.process_data(raw_csv_dfs, False)
+    assert copied == interned
+    donor_id = interned["data"]["Donor"]["DONOR_1"]["submitter_donor_id"][0]
+    assert interned["data"]["Treatment"]["DONOR_1"]["submitter_donor_id"][0] is donor_id
+
+
+def test_sqlite(tmp_path):
+    # keeping the indexed data in a database makes the same outputs as keeping it in memory, and the database is
+    # reused by the next conversion. FOLLOW_UP_3 is linked to PD_1, so the donor's INDEX function sets its
+    # submitter_donor_id to None, and that's kept once the next donor is read from the database.
+    copy_test_data(tmp_path)
+    followup_csv = tmp_path / "raw_data" / "Followup.csv"
+    followup_csv.write_text(followup_csv.read_text().replace("FOLLOW_UP_3,DONOR_1,,", "FOLLOW_UP_3,DONOR_1,PD_1,"))
+    template = tmp_path / "test2mohv3.csv"
+    template.write_text(template.read_text().replace(
+        "{moh_indexed_on_donor_if_others_absent(Followup.submitter_donor_id)}",
+        "{moh_indexed_on_donor_if_others_absent(Followup.submitter_donor_id, Followup.submitter_primary_diagnosis_id)}"))
+    input_path = str(tmp_path / "raw_data")
+    manifest_file = str(tmp_path / "manifest.yml")
+    outputs = []
+    for sqlite in [False, True, True]:
+        mappings.INDEX_STACK = []
+        packets, _ = CSVConvert.csv_convert(input_path, manifest_file, index_output=True, sqlite=sqlite)
+        with open(tmp_path / "raw_data_indexed.json") as f:
+            outputs.append((packets, json.load(f)))
+    assert outputs[0] == outputs[1] == outputs[2]
+    assert outputs[1][1]["data"]["Followup"]["DONOR_1"]["submitter_donor_id"] == [None, "DONOR_1"]
+
+    store = IndexedStore(str(tmp_path / "raw_data_indexed.db"))
+    data = store.indexed_data()
+    assert data["individuals"] == outputs[0][1]["individuals"]
+    assert "DONOR_1" in data["data"]["Donor"]
+    assert "DONOR_X" not in data["data"]["Donor"]
+    assert data["data"]["PrimaryDiagnosis"]["DONOR_1"] == outputs[0][1]["data"]["PrimaryDiagnosis"]["DONOR_1"]
+    indexes = [row[0] for row in store.connection.execute("SELECT name FROM sqlite_master WHERE type = 'index'")]
+    assert "Specimen_submitter_donor_id_submitter_primary_diagnosis_id" in indexes
+    store.close()
+
+
+def test_engines(tmp_path):
+    # mapping the donors a level at a time, or with code generated from the template, makes the same outputs as
+    # mapping them one at a time, and a donor that can't be mapped is reported in the same way
+    copy_test_data(tmp_path)
+    input_path = str(tmp_path / "raw_data")
+    manifest_file = str(tmp_path / "manifest.yml")
+    donor_csv = tmp_path / "raw_data" / "Donor.csv"
+    donor_csv.write_text(donor_csv.read_text().replace("DONOR_1,TEST_1,,,,Yes,Died of cancer,6/1/1954",
+                                                       "DONOR_1,TEST_1,,,,Yes,Died of cancer,not a date"))
+    outputs = []
+    for engine in ["donor", "level", "compiled", "compiled"]:
+        mappings.INDEX_STACK = []
+        packets, _ = CSVConvert.csv_convert(input_path, manifest_file, index_output=True, continue_on_error=True,
+                                            engine=engine)
+        with open(tmp_path / "raw_data_indexed.json") as f:
+            indexed = json.load(f)
+        with open(tmp_path / "raw_data_errors.json") as f:
+            errors = json.load(f)["errors"]
+        outputs.append((packets, indexed, [(e["identifier"], e["field"], e["method"]) for e in errors]))
+    assert outputs[0] == outputs[1] == outputs[2] == outputs[3]
+    assert outputs[0][2] == [("DONOR_1", "DONOR.INDEX.date_of_birth", "mappings.date_interval")]
+
+    # the generated module is cached next to the template, and reused
+    generated = list((tmp_path / "__pycache__").glob("test2mohv3_mapping_*.py"))
+    assert len(generated) == 1
+    assert "def map_scaffold():" in generated[0].read_text()
+
+    # conversions that generate it at the same time, like --shard jobs, each load the whole module
+    template_path = str(tmp_path / "test2mohv3.csv")
+    scaffold = CSVConvert.create_scaffold_from_template(CSVConvert.read_mapping_template(template_path))
+    context = multiprocessing.get_context("fork")
+    for _ in range(5):
+        generated[0].unlink()
+        with ProcessPoolExecutor(max_workers=8, mp_context=context) as executor:
+            paths = list(executor.map(load_generated, [scaffold] * 8, [template_path] * 8))
+        assert paths == [str(generated[0])] * 8
+        assert list((tmp_path / "__pycache__").glob("*.tmp")) == []
+
+
+def load_generated(mapping_scaffold, template_path):
+    return codegen.load(mapping_scaffold, template_path)[1]
+
+
+def test_workers(tmp_path, monkeypatch):
+    # mapping the donors in several processes, largest first, makes the same outputs, in the same order, as mapping
+    # them in one, and a donor that can't be mapped is reported in the same way
+    copy_test_data(tmp_path)
+    input_path = str(tmp_path / "raw_data")
+    manifest_file = str(tmp_path / "manifest.yml")
+    donor_csv = tmp_path / "raw_data" / "Donor.csv"
+    donor_csv.write_text(donor_csv.read_text().replace("DONOR_1,TEST_1,,,,Yes,Died of cancer,6/1/1954",
+                                                       "DONOR_1,TEST_1,,,,Yes,Died of cancer,not a date"))
+    outputs = []
+    for engine, workers in [("donor", 1), ("donor", 2), ("compiled", 3)]:
+        mappings.INDEX_STACK = []
+        packets, _ = CSVConvert.csv_convert(input_path, manifest_file, index_output=True, continue_on_error=True,
+                                            engine=engine, workers=workers)
+        with open(tmp_path / "raw_data_indexed.json") as f:
+            indexed = json.load(f)
+        with open(tmp_path / "raw_data_errors.json") as f:
+            errors = json.load(f)["errors"]
+        outputs.append((packets, indexed, [(e["identifier"], e["field"], e["method"]) for e in errors]))
+    assert outputs[0] == outputs[1] == outputs[2]
+    assert outputs[0][2] == [("DONOR_1", "DONOR.INDEX.date_of_birth", "mappings.date_interval")]
+
+    # with --pipeline, and --shards, the workers, validator and shard indexers are only forked while there are no
+    # other threads
+    threads_at_fork = record_forks(monkeypatch)
+    for shards in [None, 3]:
+        mappings.INDEX_STACK = []
+        CSVConvert.csv_convert(input_path, manifest_file, continue_on_error=True, shards=shards, pipeline=True,
+                               workers=2)
+        with open(tmp_path / "raw_data_map.json") as f:
+            assert json.load(f)["donors"] == outputs[0][0]
+    assert set(threads_at_fork) == {1}
+
+    # the largest donor is dispatched first, on its own, and the small ones together at the end
+    assert CSVConvert.schedule_donors({"A": 1, "B": 30, "C": 2, "D": 1}, 1) == [["B"], ["C"], ["A", "D"]]
+
+
+class Interrupted:
+    """A stand-in for tqdm that stops the conversion after a number of donors, as if it had been killed."""
+    def __init__(self, iterable, after, **kwargs):
+        self.iterable = iterable
+        self.after = after
+
+    def __iter__(self):
+        for i, item in enumerate(self.iterable):
+            if i == self.after:
+                raise KeyboardInterrupt
+            yield item
+
+    def set_postfix_str(self, s):
+        pass
+
+
+def test_resume(tmp_path, monkeypatch):
+    copy_test_data(tmp_path)
+    input_path = str(tmp_path / "raw_data")
+    manifest_file = str(tmp_path / "manifest.yml")
+    mappings.INDEX_STACK = []
+    expected, _ = CSVConvert.csv_convert(input_path, manifest_file, index_output=True)
+    with open(tmp_path / "raw_data_map.json") as f:
+        expected_map = json.load(f)
+    with open(tmp_path / "raw_data_indexed.json") as f:
+        expected_indexed = json.load(f)
+
+    # the checkpoint is saved after 2 donors; the third is mapped again when the conversion is resumed
+    with monkeypatch.context() as m:
+        m.setattr(CSVConvert, "tqdm", lambda iterable, **kwargs: Interrupted(iterable, 3))
+        with pytest.raises(KeyboardInterrupt):
+            CSVConvert.csv_convert(input_path, manifest_file, index_output=True, checkpoint_every=2)
+    assert os.path.exists(tmp_path / "raw_data_checkpoint" / "state.json")
+    packets, _ = CSVConvert.csv_convert(input_path, manifest_file, index_output=True, resume=True)
+    assert packets == expected
+    with open(tmp_path / "raw_data_map.json") as f:
+        assert json.load(f) == expected_map
+    with open(tmp_path / "raw_data_indexed.json") as f:
+        assert json.load(f) == expected_indexed
+    assert not os.path.exists(tmp_path / "raw_data_checkpoint")
+
+
+def test_index_stack():
+    stack = mappings.IndexStack()
+    with stack.frame("Donor", "submitter_donor_id", 0):
+        with stack.frame("PrimaryDiagnosis", "submitter_donor_id", 2) as frame:
+            assert stack.top is frame
+            assert stack.top.rownum == 2
+        assert stack.top.sheet == "Donor"
+    assert len(stack) == 0
+
+    # frames are popped even if the mapping inside the block fails
+    with pytest.raises(mappings.MappingError):
+        with stack.frame("Donor", "submitter_donor_id", 0):
+            raise mappings.MappingError("bad value")
+    assert len(stack) == 0
+    assert stack.pop() is None
+
+
+def test_lazy_imports():
+    # importing CSVConvert doesn't import its heavy dependencies: they're imported when they're first used
+    code = ("import sys; from clinical_etl import CSVConvert; print([m for m in "
+            "['pandas', 'numpy', 'dateparser', 'jsonschema', 'openapi_spec_validator', 'requests', 'tqdm'] "
+            "if type(sys.modules.get(m)).__name__ == 'module'])")
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                            env=dict(os.environ, PYTHONPATH=os.sep.join([parent_dir, "src"])))
+    assert result.stdout.strip() == "[]"
+    # the default date parser is still there for mapping functions that use it
+    assert mappings.DEFAULT_DATE_PARSER is mappings.default_date_parser()
+
+
+def test_benchmarks(monkeypatch, capsys):
+    # each benchmark still runs against the current code, at a tiny size
+    monkeypatch.syspath_prepend(os.sep.join([parent_dir, "benchmarks"]))
+    for name in ["INDEXED_DATA", "INDEX_STACK", "OUTPUT_FILE", "IDENTIFIER_FIELD", "DATE_FORMAT"]:
+        monkeypatch.setattr(mappings, name, getattr(mappings, name))
+    benchmarks = {
+        "import_benchmark": ["--runs", "1", "--top", "1"],
+        "mapping_benchmark": ["--copies", "1"],
+        "memory_benchmark": ["--copies", "1"],
+        "serialization_benchmark": ["--donors", "2"],
+        "validation_benchmark": ["--donors", "2", "--repeat", "1"]
+    }
+    for benchmark, args in benchmarks.items():
+        monkeypatch.setattr(sys, "argv", [benchmark] + args)
+        module = __import__(benchmark)
+        module.main(module.parse_args())
+        assert capsys.readouterr().out.strip() != ""